@@ -0,0 +1,71 @@
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from ChinaXivXiv.bench.fixtures import iter_corpus
+from ChinaXivXiv.http_cache import DiskCache
+from ChinaXivXiv.metadata_backfill import backfill, iter_cache_pages
+from ChinaXivXiv.workers.metadata_scraper import AbsPage, parse_authors_from_copyQuotation, parse_copyQuotation
+
+""" python -m ChinaXivXiv.bench.backfill_bench [--corpus DIR] [-n 2000] [--processes 1 4]
+1. copyQuotation 解析: 旧的逐字符版 vs parse_copyQuotation，先核对结果一致
+2. 把语料写进一个临时 DiskCache，跑 metadata_backfill (不写 Mongo)，比较不同进程数的 pages/s """
+
+
+def bench_copyQuotation(citations, repeat: int):
+    for citation in citations:
+        assert parse_copyQuotation(citation) == parse_authors_from_copyQuotation(citation), citation
+    results = {}
+    for name, func in (("legacy", parse_authors_from_copyQuotation), ("single-pass", parse_copyQuotation)):
+        start = time.process_time()
+        for _ in range(repeat):
+            for citation in citations:
+                func(citation)
+        cpu = time.process_time() - start
+        results[name] = cpu
+        n = len(citations) * repeat
+        print(f"copyQuotation {name:<12} {n:>8} citations  {cpu:8.3f}s CPU  {cpu / n * 1e6:8.2f} us/citation")
+    print(f"{'':<26} {results['legacy'] / results['single-pass']:.1f}x faster than legacy")
+
+
+def fill_cache(cache_dir: str, corpus) -> DiskCache:
+    cache = DiskCache(cache_dir)
+    for url, html in corpus:
+        cache.put(DiskCache.make_key("GET", url), {"method": "GET", "url": url, "status_code": 200, "headers": {},
+                                                   "stored_at": time.time()}, html)
+    # 回填时要跳过的非 abstract 条目
+    url = "https://global.chinaxiv.org/api/get_browse_db"
+    cache.put(DiskCache.make_key("POST", url, b"{}"), {"method": "POST", "url": url, "status_code": 200, "headers": {},
+                                                      "stored_at": time.time()}, b"{}")
+    return cache
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", help="目录，内含保存下来的 {csoaid}v{version}.html；不指定则使用合成页面")
+    parser.add_argument("-n", type=int, default=2000, help="合成页面数")
+    parser.add_argument("--repeat", type=int, default=20, help="copyQuotation 部分重复次数")
+    parser.add_argument("--processes", type=int, nargs="*", default=sorted({1, os.cpu_count() or 1}))
+    args = parser.parse_args()
+
+    corpus = list(iter_corpus(args.corpus, args.n))
+    citations = [AbsPage(html, url, with_core_html=False).copyQuotation for url, html in corpus]
+    bench_copyQuotation([c for c in citations if c is not None], args.repeat)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        fill_cache(cache_dir, corpus)
+        baseline = None
+        for processes in args.processes:
+            start = time.perf_counter()
+            stats = asyncio.run(backfill(iter_cache_pages(cache_dir), None, processes=processes, batch_size=500))
+            elapsed = time.perf_counter() - start
+            assert stats["pages"] == len(corpus), stats
+            baseline = baseline or elapsed
+            print(f"backfill processes={processes:<3} {stats['parsed']:>6} parsed  {stats['failed']:>4} failed  "
+                  f"{elapsed:8.2f}s  {stats['pages'] / elapsed:8.1f} pages/s  {baseline / elapsed:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
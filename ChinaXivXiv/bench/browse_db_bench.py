@@ -0,0 +1,62 @@
+import argparse
+import asyncio
+import time
+
+import httpx
+
+from ChinaXivXiv.bench.fake_chinaxiv import FakeChinaXiv
+from ChinaXivXiv.browse_db import BrowseDbCoalescer, post_browse_db
+from ChinaXivXiv.exceptions import EmptyContent
+
+""" python -m ChinaXivXiv.bench.browse_db_bench [-n 500] [--workers 20] """
+
+
+async def run(fake: FakeChinaXiv, n: int, workers: int, coalescer: BrowseDbCoalescer | None, client: httpx.AsyncClient):
+    url = f"{fake.base_url}/api/get_browse_db"
+    queue = list(range(1, n + 1))
+    missing = 0
+
+    async def worker():
+        nonlocal missing
+        while queue:
+            chinaxiv_id = f"chinaxiv_{queue.pop()}"
+            if coalescer is not None:
+                try:
+                    await coalescer.get(chinaxiv_id)
+                except EmptyContent:
+                    missing += 1
+            elif not await post_browse_db(client, [chinaxiv_id], url=url):
+                missing += 1
+
+    fake.requests.clear()
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(workers)])
+    return time.perf_counter() - start, fake.requests.get("browse_db", 0), missing
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=500, help="lookups")
+    parser.add_argument("--workers", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.05, help="假服务器每个请求的延迟(秒)")
+    parser.add_argument("--max-batch", type=int, default=20)
+    parser.add_argument("--max-wait", type=float, default=0.02)
+    args = parser.parse_args()
+
+    fake = FakeChinaXiv(latency=args.latency).start()
+    fake.missing = set(range(1, args.n + 1, 50))
+    try:
+        async with httpx.AsyncClient() as client:
+            elapsed, posts, missing = await run(fake, args.n, args.workers, None, client)
+            print(f"per-lookup POST: {posts:>5} POSTs  {elapsed:6.2f}s  {missing} missing")
+            coalescer = BrowseDbCoalescer(client, max_batch=args.max_batch, max_wait=args.max_wait,
+                                          url=f"{fake.base_url}/api/get_browse_db")
+            elapsed, posts, missing = await run(fake, args.n, args.workers, coalescer, client)
+            print(f"coalesced:       {posts:>5} POSTs  {elapsed:6.2f}s  {missing} missing")
+            print(f"saved {args.n - posts} of {args.n} requests ({(args.n - posts) / args.n:.0%})")
+    finally:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,324 @@
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+import httpx
+
+from ChinaXivXiv.bench.fake_chinaxiv import FakeChinaXiv
+from ChinaXivXiv.bench.fake_ia import FakeIA
+
+""" 离线端到端 benchmark: 假 chinaxiv.org / global.chinaxiv.org (OAI、get_browse_db) / IA (S3、搜索)，
+真的 OAI 收割、claim_task、IA_upload_worker (或流水线)、internetarchive 上传和 IA_verify_worker。
+
+    python -m ChinaXivXiv.bench.e2e_bench -n 200 --runner workers pipeline --workers 5 20 --pdf-size 262144 4194304
+
+每个配置在单独的 spawn 子进程里跑，peak RSS 按配置统计；假服务器在父进程里。
+MONGODB_URI 有值时用真 Mongo（每个配置一个临时库，跑完删掉），否则用 mongomock_motor """
+
+TERMINAL_EXCLUDED = ("TODO", "UPLOADTOIA_SPOOLED", "UPLOADTOIA_VERIFYING")
+""" 加上 LEASED_STATUSES: 还没跑完的状态 """
+
+
+@dataclass
+class BenchConfig:
+    runner: str
+    workers: int
+    pdf_size: int
+    tasks: int
+    parse_mode: str
+    ia_workers: int
+    origin_rate: float
+    origin_latency: float
+    origin_error_rate: float
+    ia_latency: float
+    ia_error_rate: float
+    ia_ready_delay: float
+    missing_rate: float
+    timeout: float
+    origin_concurrency: str = ""
+    ia_concurrency: str = ""
+    """ MIN:INIT:MAX 打开对应上游的 AIMD 并发控制，空着就是固定并发 """
+
+
+class RewriteTransport(httpx.AsyncBaseTransport):
+    """ 按 host 把请求转到本地假服务器。放在限速/缓存层下面，上层看到的仍是原来的 host """
+    def __init__(self, transport: httpx.AsyncBaseTransport, hosts: Dict[str, str]):
+        self.transport = transport
+        self.hosts = {host: httpx.URL(base_url) for host, base_url in hosts.items()}
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        base = self.hosts.get(request.url.host)
+        if base is not None:
+            request.url = request.url.copy_with(scheme=base.scheme, host=base.host, port=base.port)
+        return await self.transport.handle_async_request(request)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+async def open_mongo(mongodb_uri: Optional[str]):
+    """ -> (db, cleanup) """
+    if mongodb_uri:
+        import motor.motor_asyncio
+        m_client = motor.motor_asyncio.AsyncIOMotorClient(mongodb_uri)
+        name = f"chinaxivxiv_bench_{os.getpid()}"
+
+        async def cleanup():
+            await m_client.drop_database(name)
+        return m_client[name], cleanup
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+    except ImportError:
+        raise SystemExit("e2e_bench needs MONGODB_URI or `pip install mongomock-motor`")
+
+    async def noop():
+        pass
+    return AsyncMongoMockClient()["chinaxiv"], noop
+
+
+def percentile(values: List[float], q: int) -> Optional[float]:
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+async def bench(config: BenchConfig, chinaxiv_url: str, ia_url: str, mongodb_uri: Optional[str]) -> Dict:
+    # 子进程里 import: LEASE_DURATION 等从父进程设好的环境变量读
+    from ChinaXivXiv.browse_db import BrowseDbCoalescer
+    from ChinaXivXiv.concurrency import AIMDLimiter
+    from ChinaXivXiv.defines import LEASED_STATUSES
+    from ChinaXivXiv.http_client import HostProfileTransport, build_client, connection_stats, default_profiles
+    from ChinaXivXiv.ia_client import IAClient
+    from ChinaXivXiv.indexes import ArticleVersions, ensure_indexes
+    from ChinaXivXiv.metrics import REGISTRY, STEP_ERRORS, STEP_SECONDS
+    from ChinaXivXiv.mongo_ops import LeaseKeeper, lease_reaper_worker
+    from ChinaXivXiv.parse_executor import ParseExecutor
+    from ChinaXivXiv.spool import PdfSpool
+    from ChinaXivXiv.workers.IA_pipeline import IA_upload_pipeline
+    from ChinaXivXiv.workers.IA_spool import IA_prefetch_worker, IA_spool_upload_worker
+    from ChinaXivXiv.workers.IA_uploader import IA_upload_worker
+    from ChinaXivXiv.workers.IA_verifier import IA_verify_worker
+    from ChinaXivXiv.workers.oai_worker import HarvestState, generate_dates, harvest
+
+    db, cleanup = await open_mongo(mongodb_uri)
+    collection = db["global_chinaxiv"]
+    limiters = {}
+    if config.origin_concurrency:
+        limiters["chinaxiv"] = AIMDLimiter.from_spec("chinaxiv", config.origin_concurrency)
+    if config.ia_concurrency:
+        limiters["ia"] = AIMDLimiter.from_spec("ia", config.ia_concurrency, latency_tolerance=None)
+    hosts = {"chinaxiv.org": chinaxiv_url, "global.chinaxiv.org": chinaxiv_url, "archive.org": ia_url}
+    # 和线上一样按 host 分连接池，每个池下面再改写到假服务器
+    profiles = default_profiles(limiters["chinaxiv"].max_limit if "chinaxiv" in limiters else 100)
+    client = build_client(origin_rate_limit=config.origin_rate,
+                          transport=HostProfileTransport(profiles, wrap=lambda transport: RewriteTransport(transport, hosts)),
+                          origin_limiter=limiters.get("chinaxiv"))
+    result: Dict = {}
+    try:
+        start = time.perf_counter()
+        inserter = await harvest(client, collection, generate_dates(datetime.datetime(2020, 1, 1), 12),
+                                 state=HarvestState(db["oai_harvest_state"]))
+        result["harvest_seconds"] = time.perf_counter() - start
+        result["harvested"] = inserter.inserted
+        await ensure_indexes(collection)
+
+        article_versions = await ArticleVersions(collection).build()
+        parse_executor = ParseExecutor(config.parse_mode)
+        ia_client = IAClient(max_workers=config.ia_workers, keys=("bench", "bench"), base_url=ia_url,
+                             limiter=limiters.get("ia"))
+        lease_keeper = LeaseKeeper(collection)
+        browse_db = BrowseDbCoalescer(client)
+        crashes: List[str] = []
+        spool_dir: Optional[tempfile.TemporaryDirectory] = None
+
+        async def supervise(factory):
+            """ 和生产环境一样，IA_upload_worker 碰到没处理的异常就退出；这里记下来再拉起一个 """
+            while True:
+                try:
+                    return await factory()
+                except Exception as e:
+                    crashes.append(repr(e))
+
+        if config.runner == "pipeline":
+            runners = [IA_upload_pipeline(client, collection, parse_executor=parse_executor, lease_keeper=lease_keeper,
+                                          article_versions=article_versions, browse_db=browse_db,
+                                          ia_client=ia_client).run()]
+        elif config.runner == "spool":
+            lease_keeper.start()
+            spool_dir = tempfile.TemporaryDirectory(prefix="chinaxivxiv-spool-")
+            spool = PdfSpool(spool_dir.name)
+            runners = [supervise(lambda: IA_prefetch_worker(client, collection, spool, parse_executor=parse_executor,
+                                                            lease_keeper=lease_keeper, article_versions=article_versions,
+                                                            browse_db=browse_db))
+                       for _ in range(config.workers)]
+            runners += [supervise(lambda: IA_spool_upload_worker(collection, spool, ia_client=ia_client,
+                                                                 lease_keeper=lease_keeper))
+                        for _ in range(config.workers)]
+        else:
+            lease_keeper.start()
+            runners = [supervise(lambda: IA_upload_worker(client, collection, parse_executor=parse_executor,
+                                                          lease_keeper=lease_keeper, article_versions=article_versions,
+                                                          browse_db=browse_db, ia_client=ia_client))
+                       for _ in range(config.workers)]
+        runners.append(IA_verify_worker(client, collection, min_interval=0.2, max_interval=1))
+        runners.append(lease_reaper_worker(collection, interval=1))
+
+        unfinished = {"status": {"$in": [*TERMINAL_EXCLUDED, *LEASED_STATUSES]}}
+        start = time.perf_counter()
+        tasks = [asyncio.create_task(runner) for runner in runners]
+        try:
+            while await collection.count_documents(unfinished):
+                if time.perf_counter() - start > config.timeout:
+                    result["timed_out"] = True
+                    break
+                if failed := [t for t in tasks if t.done() and t.exception() is not None]:
+                    raise failed[0].exception() # type: ignore
+                await asyncio.sleep(0.1)
+            elapsed = time.perf_counter() - start
+        finally:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            lease_keeper.stop()
+            parse_executor.shutdown()
+            ia_client.shutdown()
+            if spool_dir is not None:
+                spool_dir.cleanup()
+
+        statuses: Dict[str, int] = {}
+        latencies = []
+        async for doc in collection.find({}, projection={"status": 1, "claim_at": 1, "uploaded_at": 1}):
+            statuses[str(doc["status"])] = statuses.get(str(doc["status"]), 0) + 1
+            if doc.get("claim_at") and doc.get("uploaded_at"):
+                latencies.append((doc["uploaded_at"] - doc["claim_at"]).total_seconds())
+        done = statuses.get("UPLOADTOIA_DONE", 0)
+        result.update({
+            "elapsed": elapsed,
+            "statuses": statuses,
+            "done": done,
+            "throughput": done / elapsed if elapsed else 0,
+            "latency_p50": percentile(latencies, 50),
+            "latency_p99": percentile(latencies, 99),
+            "steps": {s["labels"]["step"]: {"count": s["count"], "p50": s["p50"], "p99": s["p99"]}
+                      for s in REGISTRY.snapshot()[STEP_SECONDS.name]},
+            "step_errors": sum(value for _, value in STEP_ERRORS.items()),
+            "worker_crashes": len(crashes),
+            "crash_samples": sorted(set(crashes))[:5],
+            "limits": {name: limiter.stats() for name, limiter in limiters.items()},
+            "connections": connection_stats(),
+        })
+    finally:
+        await client.aclose()
+        await cleanup()
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    result["peak_rss_children_mb"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return result
+
+
+def run_config(config: BenchConfig, chinaxiv_url: str, ia_url: str, mongodb_uri: Optional[str],
+               results: multiprocessing.Queue, verbose: bool):
+    if not verbose: # worker 每个任务都会 print 好几行
+        sys.stdout = sys.stderr = open(os.devnull, "w")
+    try:
+        results.put(asyncio.run(bench(config, chinaxiv_url, ia_url, mongodb_uri)))
+    except BaseException as e:
+        results.put({"error": repr(e)})
+        raise
+
+
+def run(config: BenchConfig, mongodb_uri: Optional[str], verbose: bool) -> Dict:
+    fake_chinaxiv = FakeChinaXiv(latency=config.origin_latency, error_rate=config.origin_error_rate,
+                                 pdf_size=config.pdf_size, records=config.tasks)
+    fake_chinaxiv.missing = {n for n in range(1, config.tasks + 1) if (n * 2654435761) % 1000 < config.missing_rate * 1000}
+    fake_chinaxiv.start()
+    fake_ia = FakeIA(latency=config.ia_latency, error_rate=config.ia_error_rate, ready_delay=config.ia_ready_delay).start()
+    try:
+        ctx = multiprocessing.get_context("spawn")
+        results = ctx.Queue()
+        proc = ctx.Process(target=run_config, args=(config, fake_chinaxiv.base_url, fake_ia.base_url,
+                                                    mongodb_uri, results, verbose))
+        proc.start()
+        result = results.get()
+        proc.join()
+        result["requests"] = {**fake_chinaxiv.requests, **{f"ia{k}": v for k, v in fake_ia.requests.items()
+                                                           if not k.startswith("/metadata/")}}
+        return result
+    finally:
+        fake_chinaxiv.stop()
+        fake_ia.stop()
+
+
+def format_row(config: BenchConfig, result: Dict) -> str:
+    if "error" in result:
+        return f"{config.runner:<9}{config.workers:>4}{config.pdf_size // 1024:>8}  ERROR {result['error']}"
+    p50, p99 = result["latency_p50"], result["latency_p99"]
+    return (f"{config.runner:<9}{config.workers:>4}{config.pdf_size // 1024:>8}"
+            f"{result['done']:>6}/{config.tasks:<6}{result['elapsed']:>8.2f}{result['throughput']:>9.1f}"
+            f"{p50 if p50 is not None else float('nan'):>8.3f}{p99 if p99 is not None else float('nan'):>8.3f}"
+            f"{result['peak_rss_mb']:>8.0f}{result['worker_crashes'] + result['step_errors']:>7}"
+            f"{' TIMEOUT' if result.get('timed_out') else ''}"
+            + "".join(f" {name}_limit={stats['limit']}" for name, stats in result["limits"].items())
+            + "".join(f" {host}_reuse={stats['reuse_ratio']:.2f}" for host, stats in result["connections"].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m ChinaXivXiv.bench.e2e_bench")
+    parser.add_argument("-n", "--tasks", type=int, default=200, help="OAI 记录 / 任务数")
+    parser.add_argument("--runner", nargs="+", default=["workers"], choices=("workers", "pipeline", "spool"))
+    parser.add_argument("--workers", nargs="+", type=int, default=[5], help="runner=workers 的协程数，runner=spool 下载、上传各这么多")
+    parser.add_argument("--pdf-size", nargs="+", type=int, default=[256 * 1024], help="合成 PDF 的字节数")
+    parser.add_argument("--parse-mode", default="process", choices=("inline", "thread", "process"))
+    parser.add_argument("--ia-workers", type=int, default=5, help="IAClient 上传线程数")
+    parser.add_argument("--origin-rate", type=float, default=1e6, help="origin 限速 q/s，默认等于不限")
+    parser.add_argument("--origin-latency", type=float, default=0.0)
+    parser.add_argument("--origin-error-rate", type=float, default=0.0)
+    parser.add_argument("--ia-latency", type=float, default=0.0)
+    parser.add_argument("--ia-error-rate", type=float, default=0.0)
+    parser.add_argument("--ia-ready-delay", type=float, default=0.0, help="上传后多久 IA 上才能搜到")
+    parser.add_argument("--origin-concurrency", default="", metavar="MIN:INIT:MAX", help="打开 chinaxiv 的 AIMD 并发控制")
+    parser.add_argument("--ia-concurrency", default="", metavar="MIN:INIT:MAX", help="打开 IA 上传的 AIMD 并发控制")
+    parser.add_argument("--missing-rate", type=float, default=0.0, help="browse_db 查不到、abstract 404 的比例")
+    parser.add_argument("--lease-seconds", type=int, default=5, help="崩掉的 worker 手上的任务过多久被 reaper 放回 TODO")
+    parser.add_argument("--retry-backoff", type=float, default=1, help="临时失败后第一次重试前等几秒")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--json", help="每个配置的完整结果追加到这个 JSONL 文件")
+    parser.add_argument("-v", "--verbose", action="store_true", help="不屏蔽 worker 的输出")
+    args = parser.parse_args()
+
+    os.environ["CHINAXIVXIV_LEASE_SECONDS"] = str(args.lease_seconds)
+    os.environ["CHINAXIVXIV_RETRY_BACKOFF_SECONDS"] = str(args.retry_backoff)
+    os.environ["CHINAXIVXIV_HTTP_CACHE_DIR"] = ""
+    mongodb_uri = os.getenv("MONGODB_URI")
+    print(f"mongo: {'MONGODB_URI' if mongodb_uri else 'mongomock_motor (in-memory)'}")
+    print(f"{'runner':<9}{'wrk':>4}{'pdf_kb':>8}{'done':>13}{'secs':>8}{'tasks/s':>9}{'p50':>8}{'p99':>8}{'rss_mb':>8}{'errors':>7}")
+    for runner, workers, pdf_size in itertools.product(args.runner, args.workers, args.pdf_size):
+        if runner == "pipeline" and workers != args.workers[0]:
+            continue # 流水线的并发由 CHINAXIVXIV_PIPELINE_CONCURRENCY 控制，不随 --workers 变
+        config = BenchConfig(runner=runner, workers=workers, pdf_size=pdf_size, tasks=args.tasks,
+                             parse_mode=args.parse_mode, ia_workers=args.ia_workers, origin_rate=args.origin_rate,
+                             origin_latency=args.origin_latency, origin_error_rate=args.origin_error_rate,
+                             ia_latency=args.ia_latency, ia_error_rate=args.ia_error_rate,
+                             ia_ready_delay=args.ia_ready_delay, missing_rate=args.missing_rate, timeout=args.timeout,
+                             origin_concurrency=args.origin_concurrency, ia_concurrency=args.ia_concurrency)
+        result = run(config, mongodb_uri, args.verbose)
+        print(format_row(config, result), flush=True)
+        if args.json:
+            with open(args.json, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"config": asdict(config), "result": result}, default=str) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Set
+from urllib.parse import parse_qs, urlsplit
+from xml.sax.saxutils import escape
+
+from ChinaXivXiv.bench.fixtures import make_abs_page
+
+""" 本地假 chinaxiv.org + global.chinaxiv.org (get_browse_db、OAI-PMH)，供 benchmark 使用 """
+
+OAI_PAGE_SIZE = 100
+
+
+class BenchHTTPServer(ThreadingHTTPServer):
+    """ 默认 listen backlog 只有 5，benchmark 一下子开几十个连接会被 reset (httpx.ReadError) """
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def csoaid_of(n: int) -> str:
+    """ 合成数据里 chinaxiv_{n} 对应的 csoaid """
+    return f"2020{n % 12 + 1:02d}.{n:05d}"
+
+def datestamp_of(n: int) -> str:
+    """ 与 csoaid 同月 """
+    return f"2020-{n % 12 + 1:02d}-{n % 28 + 1:02d}"
+
+
+def oai_list_records(records: int, start: str, end: str, offset: int) -> bytes:
+    """ chinaxiv_1..chinaxiv_{records} 中 datestamp 落在 [start, end) 的记录，从 offset 起一页 """
+    matched = [n for n in range(1, records + 1) if start[:10] <= datestamp_of(n) < end[:10]]
+    page = matched[offset:offset + OAI_PAGE_SIZE]
+    if not matched:
+        return (b'<?xml version="1.0" encoding="UTF-8"?><OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">'
+                b'<error code="noRecordsMatch">no records</error></OAI-PMH>')
+    parts = ['<?xml version="1.0" encoding="UTF-8"?><OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><ListRecords>']
+    for n in page:
+        parts.append(
+            f"<record><header><identifier>localIdentifier:chinaxiv_{n}</identifier>"
+            f"<datestamp>{datestamp_of(n)}</datestamp></header><metadata><article>"
+            f"<title>{escape(f'title {n}')}</title><author>author {n}</author><keyword>keyword {n % 7}</keyword>"
+            f"<article-id>{csoaid_of(n)}</article-id></article></metadata></record>")
+    if offset + OAI_PAGE_SIZE < len(matched):
+        parts.append(f"<resumptionToken>{start}|{end}|{offset + OAI_PAGE_SIZE}</resumptionToken>")
+    parts.append("</ListRecords></OAI-PMH>")
+    return "".join(parts).encode("utf-8")
+
+
+class FakeChinaXiv:
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, pdf_size: int = 256 * 1024, records: int = 0):
+        self.latency = latency
+        """ 每个请求额外等待的秒数 """
+        self.error_rate = error_rate
+        """ 随机返回 503 的比例 """
+        self.pdf_size = pdf_size
+        self.records = records
+        """ OAI ListRecords 里的记录数: chinaxiv_1..chinaxiv_{records} """
+        self.missing: Set[int] = set()
+        """ 这些 chinaxiv_{n} 在 browse_db 里查不到、abstract 页面 404 """
+        self.requests: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.server: BenchHTTPServer | None = None
+
+    @property
+    def base_url(self) -> str:
+        assert self.server is not None
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, kind: str):
+        with self.lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+
+    def start(self) -> "FakeChinaXiv":
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_body(self, body: bytes, content_type: str, status: int = 200):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def unlucky(self) -> bool:
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if fake.error_rate and random.random() < fake.error_rate:
+                    self.send_body(b"Service Unavailable", "text/plain", 503)
+                    return True
+                return False
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if urlsplit(self.path).path != "/api/get_browse_db":
+                    return self.send_body(b"not found", "text/plain", 404)
+                fake.count("browse_db")
+                if self.unlucky():
+                    return
+                dbList = []
+                for domain in json.loads(body)["domains"]:
+                    n = int(domain["value"].removeprefix("chinaxiv_"))
+                    if n in fake.missing:
+                        continue
+                    dbList.append({"id": domain["value"], "version": "1", "year": "2020",
+                                   "title": f"title {n}", "authors": [f"author {n}"]})
+                self.send_body(json.dumps({"dbList": dbList}).encode("utf-8"), "application/json")
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                path = url.path
+                if path == "/oaiapi/getdata":
+                    # OAI 不注入错误，只加延迟: 收割是 benchmark 的前置步骤
+                    fake.count("oai")
+                    if fake.latency:
+                        time.sleep(fake.latency)
+                    query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                    if "resumptionToken" in query:
+                        start, end, offset = query["resumptionToken"].split("|")
+                    else:
+                        start, end, offset = query["startTime"], query["endTime"], "0"
+                    return self.send_body(oai_list_records(fake.records, start, end, int(offset)), "text/xml; charset=utf-8")
+                if m := re.fullmatch(r"/abs/(\d{6})\.(\d+)v(\d+)", path):
+                    fake.count("abs")
+                    if self.unlucky():
+                        return
+                    n = int(m.group(2))
+                    if n in fake.missing:
+                        return self.send_body(b"not found", "text/html", 404)
+                    page = make_abs_page(n, csoaid=f"{m.group(1)}.{m.group(2)}", version=int(m.group(3)))
+                    return self.send_body(page, "text/html; charset=utf-8")
+                if path.startswith("/businessFile/") and path.endswith(".pdf"):
+                    fake.count("pdf")
+                    if self.unlucky():
+                        return
+                    return self.send_body(b"%PDF-1.4\n" + b"0" * fake.pdf_size, "application/pdf")
+                self.send_body(b"not found", "text/plain", 404)
+
+        self.server = BenchHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
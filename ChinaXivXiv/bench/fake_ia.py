@@ -0,0 +1,277 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from ChinaXivXiv.bench.fake_chinaxiv import BenchHTTPServer
+
+""" 本地假 IA，供 verifier / IAItemIndex / benchmark 使用，不碰 archive.org。
+archive.org 和 s3.us.archive.org 共用一个端口: PUT 是 S3 上传，GET 按路径分。
+S3 multipart: POST ?uploads / PUT ?partNumber&uploadId / GET ?uploadId (ListParts) / POST ?uploadId / DELETE ?uploadId """
+
+S3_XMLNS = "http://s3.amazonaws.com/doc/2006-03-01/"
+
+
+class FakeIA:
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, ready_delay: float = 0.0, bandwidth: float = 0.0,
+                 search_lag: float = 0.0):
+        self.latency = latency
+        """ 每个 S3 PUT 额外等待的秒数 """
+        self.error_rate = error_rate
+        """ S3 PUT (包括 multipart 的每一块) 随机返回 503 SlowDown 的比例 """
+        self.bandwidth = bandwidth
+        """ 每个 PUT 连接的字节/秒上限，模拟单条 TCP 连接跑不满带宽；0 不限 """
+        self.uploads: Dict[str, Dict] = {}
+        """ multipart uploadId -> {"identifier", "name", "metadata", "parts": {part number: bytes}} """
+        self.ready_delay = ready_delay
+        """ 上传后过多久 item 才建好 (/metadata 能查到)，模拟 IA 建 item 的排队 """
+        self.search_lag = search_lag
+        """ item 建好之后再过多久 advancedsearch 才能搜到，模拟搜索索引的延迟 """
+        self.ready_at: Dict[str, float] = {}
+        self.items: Dict[str, Dict] = {}
+        """ identifier -> metadata """
+        self.files: Dict[str, List[Dict]] = {}
+        """ identifier -> [{"name", "md5", "source"}, ...] """
+        self.requests: Dict[str, int] = {}
+        """ path -> 请求次数 """
+        self.lock = threading.Lock()
+        self.server: BenchHTTPServer | None = None
+
+    def add_item(self, identifier: str, files: Optional[List[Dict]] = None, **metadata):
+        with self.lock:
+            self.items[identifier] = {"identifier": identifier, **metadata}
+            self.files[identifier] = files or []
+            self.ready_at[identifier] = 0.0
+
+    def visible(self, identifier: str) -> bool:
+        """ 调用方持有 lock """
+        return identifier in self.items and self.ready_at[identifier] <= time.monotonic()
+
+    def searchable(self, identifier: str) -> bool:
+        """ 调用方持有 lock """
+        return identifier in self.items and self.ready_at[identifier] + self.search_lag <= time.monotonic()
+
+    @property
+    def base_url(self) -> str:
+        assert self.server is not None
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeIA":
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, obj, status: int = 200):
+                body = json.dumps(obj).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_xml(self, body: str, status: int = 200, headers: Optional[Dict[str, str]] = None):
+                data = ('<?xml version="1.0" encoding="UTF-8"?>\n' + body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/xml")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def s3_target(self):
+                """ -> (identifier, file name, query)，路径不对返回 None """
+                url = urlsplit(self.path)
+                parts = url.path.strip("/").split("/", 1)
+                if len(parts) != 2:
+                    return None
+                return parts[0], unquote(parts[1]), parse_qs(url.query, keep_blank_values=True)
+
+            def read_body(self) -> bytes:
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if fake.bandwidth:
+                    time.sleep(len(body) / fake.bandwidth)
+                return body
+
+            def count(self, name: str):
+                with fake.lock:
+                    fake.requests[name] = fake.requests.get(name, 0) + 1
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                if "uploadId" in parse_qs(url.query):
+                    return self.list_parts()
+                with fake.lock:
+                    fake.requests[url.path] = fake.requests.get(url.path, 0) + 1
+                handler = getattr(self, "get_" + url.path.strip("/").split("/")[0].replace(".", "_"), None)
+                if handler is None:
+                    return self.send_json({"error": "not found"}, 404)
+                handler(url, parse_qs(url.query))
+
+            def metadata_headers(self) -> Dict[str, List[str]]:
+                metadata: Dict[str, List[str]] = {}
+                for key, value in self.headers.items():
+                    if m := re.fullmatch(r"x-archive-meta\d*-(.+)", key.lower()):
+                        metadata.setdefault(m.group(1).replace("--", "_"), []).append(value)
+                return metadata
+
+            def add_file(self, identifier: str, name: str, body: bytes, metadata: Dict[str, List[str]]):
+                md5 = hashlib.md5(body).hexdigest()
+                with fake.lock:
+                    if identifier not in fake.items:
+                        fake.items[identifier] = {"identifier": identifier,
+                                                  **{k: v[0] if len(v) == 1 else v for k, v in metadata.items()}}
+                        fake.files[identifier] = []
+                        fake.ready_at[identifier] = time.monotonic() + fake.ready_delay
+                    fake.files[identifier].append({"name": name, "md5": md5, "size": str(len(body)), "source": "original"})
+
+            def do_PUT(self):
+                # S3: PUT /{identifier}/{file name}，元数据在 x-archive-meta*-{key} 头里
+                body = self.read_body()
+                target = self.s3_target()
+                if target is not None and "uploadId" in target[2]:
+                    return self.upload_part(body, target[2])
+                self.count("s3_put")
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if fake.error_rate and random.random() < fake.error_rate:
+                    return self.send_json({"error": "SlowDown"}, 503)
+                if target is None:
+                    return self.send_json({"error": "InvalidURI"}, 400)
+                identifier, name, _ = target
+                md5 = hashlib.md5(body).hexdigest()
+                if self.headers.get("Content-MD5") and self.headers["Content-MD5"] != md5:
+                    return self.send_json({"error": "BadDigest"}, 400)
+                self.add_file(identifier, name, body, self.metadata_headers())
+                self.send_json({})
+
+            def do_POST(self):
+                body = self.read_body()
+                target = self.s3_target()
+                if target is None:
+                    return self.send_json({"error": "InvalidURI"}, 400)
+                identifier, name, query = target
+                if "uploads" in query: # InitiateMultipartUpload
+                    self.count("s3_initiate")
+                    upload_id = uuid.uuid4().hex
+                    with fake.lock:
+                        fake.uploads[upload_id] = {"identifier": identifier, "name": name,
+                                                   "metadata": self.metadata_headers(), "parts": {}}
+                    return self.send_xml(f'<InitiateMultipartUploadResult xmlns="{S3_XMLNS}"><Bucket>{identifier}</Bucket>'
+                                         f'<Key>{name}</Key><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>')
+                if "uploadId" in query: # CompleteMultipartUpload
+                    self.count("s3_complete")
+                    with fake.lock:
+                        upload = fake.uploads.get(query["uploadId"][0])
+                    if upload is None:
+                        return self.send_xml("<Error><Code>NoSuchUpload</Code></Error>", 404)
+                    wanted = [(int(number), etag.strip('"')) for number, etag in re.findall(
+                        r"<PartNumber>(\d+)</PartNumber>\s*<ETag>([^<]+)</ETag>", body.decode("utf-8"))]
+                    parts = upload["parts"]
+                    if [number for number, _ in wanted] != list(range(1, len(wanted) + 1)) or any(
+                            number not in parts or hashlib.md5(parts[number]).hexdigest() != etag for number, etag in wanted):
+                        return self.send_xml("<Error><Code>InvalidPart</Code></Error>", 400)
+                    self.add_file(identifier, name, b"".join(parts[number] for number, _ in wanted), upload["metadata"])
+                    with fake.lock:
+                        del fake.uploads[query["uploadId"][0]]
+                    etag = hashlib.md5(b"".join(hashlib.md5(parts[number]).digest() for number, _ in wanted)).hexdigest()
+                    return self.send_xml(f'<CompleteMultipartUploadResult xmlns="{S3_XMLNS}"><Bucket>{identifier}</Bucket>'
+                                         f'<Key>{name}</Key><ETag>"{etag}-{len(wanted)}"</ETag></CompleteMultipartUploadResult>')
+                self.send_json({"error": "not found"}, 404)
+
+            def upload_part(self, body: bytes, query: Dict[str, List[str]]):
+                self.count("s3_part")
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if fake.error_rate and random.random() < fake.error_rate:
+                    return self.send_xml("<Error><Code>SlowDown</Code></Error>", 503)
+                with fake.lock:
+                    upload = fake.uploads.get(query["uploadId"][0])
+                if upload is None:
+                    return self.send_xml("<Error><Code>NoSuchUpload</Code></Error>", 404)
+                md5 = hashlib.md5(body).hexdigest()
+                if self.headers.get("Content-MD5") and self.headers["Content-MD5"] != md5:
+                    return self.send_xml("<Error><Code>BadDigest</Code></Error>", 400)
+                with fake.lock:
+                    upload["parts"][int(query["partNumber"][0])] = body
+                self.send_xml("", headers={"ETag": f'"{md5}"'})
+
+            def list_parts(self):
+                target = self.s3_target()
+                assert target is not None
+                with fake.lock:
+                    upload = fake.uploads.get(target[2]["uploadId"][0])
+                    parts = sorted(upload["parts"].items()) if upload is not None else []
+                if upload is None:
+                    return self.send_xml("<Error><Code>NoSuchUpload</Code></Error>", 404)
+                self.send_xml(f'<ListPartsResult xmlns="{S3_XMLNS}"><IsTruncated>false</IsTruncated>' + "".join(
+                    f'<Part><PartNumber>{number}</PartNumber><ETag>"{hashlib.md5(data).hexdigest()}"</ETag>'
+                    f'<Size>{len(data)}</Size></Part>' for number, data in parts) + "</ListPartsResult>")
+
+            def do_DELETE(self):
+                target = self.s3_target()
+                if target is None or "uploadId" not in target[2]:
+                    return self.send_json({"error": "not found"}, 404)
+                self.count("s3_abort")
+                with fake.lock:
+                    fake.uploads.pop(target[2]["uploadId"][0], None)
+                self.send_response(204)
+                self.end_headers()
+
+            def get_advancedsearch_php(self, url, query):
+                # q=identifier:(A OR B OR C)
+                wanted = re.findall(r'"([^"]+)"', query.get("q", [""])[0])
+                with fake.lock:
+                    docs = [{"identifier": i} for i in wanted if fake.searchable(i)]
+                self.send_json({"response": {"numFound": len(docs), "start": 0, "docs": docs}})
+
+            def get_services(self, url, query):
+                # /services/search/v1/scrape?q=identifier:PREFIX*&fields=a,b&count=N&cursor=OFFSET
+                if url.path.rstrip("/") != "/services/search/v1/scrape":
+                    return self.send_json({"error": "not found"}, 404)
+                q = query.get("q", [""])[0]
+                m = re.fullmatch(r"identifier:([^*]*)\*", q)
+                fields = query.get("fields", ["identifier"])[0].split(",")
+                count = int(query.get("count", ["5000"])[0])
+                offset = int(query.get("cursor", ["0"])[0])
+                with fake.lock:
+                    matched = sorted(i for i in fake.items if fake.searchable(i) and (m is None or i.startswith(m.group(1))))
+                    page = [{f: fake.items[i][f] for f in fields if f in fake.items[i]} for i in matched[offset:offset + count]]
+                result = {"items": page, "count": len(page), "total": len(matched)}
+                if offset + count < len(matched):
+                    result["cursor"] = str(offset + count)
+                self.send_json(result)
+
+            def get_metadata(self, url, query):
+                # /metadata/{identifier} 或 /metadata/{identifier}/files
+                parts = url.path.strip("/").split("/")
+                with fake.lock:
+                    if len(parts) < 2 or not fake.visible(parts[1]):
+                        return self.send_json({}) # 和 IA 一样，不存在的 item 返回空对象
+                    metadata, files = dict(fake.items[parts[1]]), list(fake.files[parts[1]])
+                if len(parts) == 2:
+                    return self.send_json({"metadata": metadata, "files": files})
+                if parts[2] != "files":
+                    return self.send_json({})
+                self.send_json({"result": files})
+
+        self.server = BenchHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
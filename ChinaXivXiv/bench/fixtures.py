@@ -0,0 +1,82 @@
+import os
+import random
+from typing import Iterator, Tuple
+
+""" 合成的 abstract 页面，结构照抄 https://chinaxiv.org/abs/{csoaid}v{version} """
+
+ABS_PAGE_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>{title} - ChinaXiv</title></head>
+<body>
+<div class="header"><a href="/home.htm">首页</a>{nav}</div>
+<div class="paper">
+  <div class="flex_item side"><a href="/user/login.htm">登录</a></div>
+  <div class="flex_item content">
+    <div class="hd">
+      <h1>{title}</h1>
+      <div class="bd">
+        <p>{authors_links}</p>
+        <p><b>学科分类:</b> {subject_links}</p>
+        <p><b>关键词:</b> {keyword_links}</p>
+        <p><b>摘要:</b> {abstract}</p>
+        <p><b>推荐引用方式:</b> <span id="copyQuotation">{copyQuotation} </span><span id="copyBtn">点击复制</span></p>
+      </div>
+      <div id="journalSelect"><a href="/journal/list.htm">选择期刊</a></div>
+      <div class="ft"><b>版本历史</b> <a href="/user/download.htm?id={fileid}">下载全文</a></div>
+      <div class="ft"><b>相关论文推荐</b>{related}</div>
+    </div>
+  </div>
+</div>
+<div id="zzviewmode" style="display:none;">
+    <div class="content">
+        <form id="form1" action="" method="post">
+            <input type="hidden" id="id" name="id" value="{fileid}" />
+            <input type="hidden" id="email" name="email" value="" />
+            <input type="hidden" id="title" name="title" value="{title}" />
+            <input type="hidden" id="version" name="version" value="{version}" />
+            <input type="hidden" id="csoaid" name="csoaid" value="{csoaid}" />
+            <input type="hidden" id="starID1" name="starID1" />
+        </form>
+    </div>
+</div>
+<div class="footer">{footer}</div>
+</body>
+</html>
+"""
+
+def _words(rnd: random.Random, n: int) -> str:
+    return "".join(rnd.choice("的一是了我不人在他有这个上们来到时大地为子中你说生国年着就那和要") for _ in range(n))
+
+
+def make_abs_page(fileid: int, csoaid: str = "", version: int = 1, seed: int | None = None) -> bytes:
+    rnd = random.Random(fileid if seed is None else seed)
+    csoaid = csoaid or f"{rnd.randint(2016, 2024)}{rnd.randint(1, 12):02d}.{fileid % 100000:05d}"
+    title = _words(rnd, rnd.randint(10, 30))
+    authors = [_words(rnd, 3) for _ in range(rnd.randint(1, 8))]
+    subjects = [_words(rnd, 4) for _ in range(rnd.randint(1, 3))]
+    keywords = [_words(rnd, 4) for _ in range(rnd.randint(2, 6))]
+    journal = _words(rnd, 8)
+    copyQuotation = f"{','.join(authors)}.({csoaid[:4]}).{title}.{journal}.doi:10.12074/{csoaid}V{version}"
+    return ABS_PAGE_TEMPLATE.format(
+        title=title, fileid=fileid, csoaid=csoaid, version=version, copyQuotation=copyQuotation,
+        authors_links=", ".join(f'<a href="/search?field=author&value={a}">{a}</a>' for a in authors),
+        subject_links=" ".join(f'<a href="/search?field=subject&value={s}">{s}</a>' for s in subjects),
+        keyword_links=" ".join(f'<a href="/search?field=keywords&value={k}">{k}</a>' for k in keywords),
+        abstract=_words(rnd, rnd.randint(200, 800)),
+        related="".join(f'<p><a href="/abs/{rnd.randint(201601, 202412)}.{rnd.randint(0, 99999):05d}">{_words(rnd, 15)}</a></p>' for _ in range(10)),
+        nav="".join(f'<a href="/nav/{i}.htm">{_words(rnd, 2)}</a>' for i in range(30)),
+        footer="".join(f'<a href="/about/{i}.htm">{_words(rnd, 4)}</a>' for i in range(40)),
+    ).encode("utf-8")
+
+
+def iter_corpus(corpus_dir: str | None = None, n: int = 200) -> Iterator[Tuple[str, bytes]]:
+    """ -> (url, html)，corpus_dir 为空则生成 n 个合成页面；目录里的文件名为 {csoaid}v{version}.html """
+    if corpus_dir:
+        for name in sorted(os.listdir(corpus_dir)):
+            if not name.endswith(".html"):
+                continue
+            with open(os.path.join(corpus_dir, name), "rb") as f:
+                yield f"https://chinaxiv.org/abs/{name.removesuffix('.html')}", f.read()
+        return
+    for fileid in range(1, n + 1):
+        yield f"https://chinaxiv.org/abs/synthetic{fileid}v1", make_abs_page(fileid)
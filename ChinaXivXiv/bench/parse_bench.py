@@ -0,0 +1,53 @@
+import argparse
+import time
+
+from ChinaXivXiv.bench.fixtures import iter_corpus
+from ChinaXivXiv.workers.metadata_scraper import (PARSER_BACKENDS, get_copyQuotation, get_core_html, parse_abs_page,
+                                                  parse_authors_from_copyQuotation, parse_info_from_html,
+                                                  parse_keywords, parse_subjects)
+
+""" python -m ChinaXivXiv.bench.parse_bench [--corpus DIR] """
+
+
+def legacy_parse(html: bytes, url: str):
+    """ 旧流程: 每篇论文建 6 次 BeautifulSoup """
+    parse_info_from_html(html)
+    parse_authors_from_copyQuotation(get_copyQuotation(html))
+    get_core_html(html, url)
+    parse_subjects(html)
+    parse_keywords(html)
+    return get_core_html(html, url)
+
+
+def bench(name: str, func, corpus, repeat: int):
+    start = time.process_time()
+    for _ in range(repeat):
+        for url, html in corpus:
+            func(html, url)
+    cpu = time.process_time() - start
+    pages = len(corpus) * repeat
+    print(f"{name:<16} {pages:>6} pages  {cpu:8.3f}s CPU  {cpu / pages * 1000:8.3f} ms/page")
+    return cpu
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", help="目录，内含保存下来的 {csoaid}v{version}.html；不指定则使用合成页面")
+    parser.add_argument("-n", type=int, default=200, help="合成页面数")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--backends", nargs="*", default=list(PARSER_BACKENDS))
+    args = parser.parse_args()
+
+    corpus = list(iter_corpus(args.corpus, args.n))
+    baseline = bench("legacy (6 soups)", legacy_parse, corpus, args.repeat)
+    for backend in args.backends:
+        try:
+            cpu = bench(backend, lambda html, url: parse_abs_page(html, url, backend=backend), corpus, args.repeat)
+        except ImportError as e:
+            print(f"{backend:<16} skipped: {e}")
+            continue
+        print(f"{'':<16} {baseline / cpu:.1f}x faster than legacy")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import asyncio
+import json
+import time
+from typing import Dict, List, Optional, Set
+
+import httpx
+
+from ChinaXivXiv.exceptions import EmptyContent
+from ChinaXivXiv.http_cache import DiskCache
+
+BROWSE_DB_URL = "https://global.chinaxiv.org/api/get_browse_db"
+
+
+async def post_browse_db(client: httpx.AsyncClient, chinaxiv_ids: List[str], url: str = BROWSE_DB_URL) -> List[Dict]:
+    # curl 'https://global.chinaxiv.org/api/get_browse_db' -X POST -H 'Accept: application/json, text/plain, */*' -H 'Content-Type: application/json; charset=UTF-8' --data-raw '{"domains":[{"value":"chinaxiv_48172","select_value":"id"}],"dbs":["chinaxiv"]}' | jq
+    r = await client.post(url, json={
+        "domains": [{"value": chinaxiv_id, "select_value": "id"} for chinaxiv_id in chinaxiv_ids], # chinaxiv_34185
+        "dbs": ["chinaxiv"]
+    })
+    r.raise_for_status()
+    return r.json()["dbList"]
+
+
+class BrowseDbCoalescer:
+    """ 把并发 worker 的 get_browse_db 查询攒 max_wait 秒或 max_batch 个合成一次 POST，
+    再按 id 把 dbList 分发回各个调用者。dbList 里没有的 id 抛 EmptyContent。
+    批量 POST 的 body 每次都不一样，transport 层的缓存命中不了，所以有 cache 时按 id 单独缓存 dbList 条目 """
+    def __init__(self, client: httpx.AsyncClient, max_batch: int = 20, max_wait: float = 0.02, url: str = BROWSE_DB_URL,
+                 cache: Optional[DiskCache] = None, max_age: float = 7 * 24 * 3600):
+        self.client = client
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.url = url
+        self.cache = cache
+        self.max_age = max_age
+        self.pending: Dict[str, List[asyncio.Future]] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._sends: Set[asyncio.Task] = set()
+        """ 在途的批量 POST。event loop 只弱引用 task，不留着的话可能被回收，等它的 get() 就永远挂着 """
+        self.posts = 0
+        self.lookups = 0
+
+    def _cache_key(self, chinaxiv_id: str) -> str:
+        return DiskCache.make_key("POST", self.url, json.dumps({"id": chinaxiv_id}).encode())
+
+    async def get(self, chinaxiv_id: str) -> Dict:
+        """ chinaxiv_id: chinaxiv_34185 """
+        self.lookups += 1
+        if self.cache is not None:
+            cached = await asyncio.to_thread(self.cache.get, self._cache_key(chinaxiv_id))
+            if cached is not None and time.time() - cached[0]["stored_at"] < self.max_age:
+                return json.loads(cached[1])
+        future = asyncio.get_running_loop().create_future()
+        self.pending.setdefault(chinaxiv_id, []).append(future)
+        if len(self.pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.pending:
+            batch, self.pending = self.pending, {}
+            task = asyncio.create_task(self._send(batch))
+            self._sends.add(task)
+            task.add_done_callback(self._sends.discard)
+
+    async def _send(self, batch: Dict[str, List[asyncio.Future]]):
+        self.posts += 1
+        try:
+            dbList = await post_browse_db(self.client, list(batch), url=self.url)
+        except Exception as e:
+            for futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        found = {item.get("id"): item for item in dbList}
+        if self.cache is not None:
+            for chinaxiv_id in batch:
+                if chinaxiv_id in found:
+                    meta = {"method": "POST", "url": self.url, "status_code": 200, "headers": {},
+                            "stored_at": time.time(), "browse_db_id": chinaxiv_id}
+                    await asyncio.to_thread(self.cache.put, self._cache_key(chinaxiv_id), meta,
+                                            json.dumps(found[chinaxiv_id], ensure_ascii=False).encode("utf-8"))
+        for chinaxiv_id, futures in batch.items():
+            for future in futures:
+                if future.done(): # 调用者已取消
+                    continue
+                if chinaxiv_id in found:
+                    future.set_result(found[chinaxiv_id])
+                else:
+                    future.set_exception(EmptyContent(f"{chinaxiv_id} not in get_browse_db dbList"))
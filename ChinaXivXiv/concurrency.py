@@ -0,0 +1,235 @@
+import asyncio
+import collections
+import contextlib
+import time
+from typing import AsyncIterator, Deque, Dict, Optional, Tuple
+
+import httpx
+import requests
+
+from ChinaXivXiv.metrics import CONCURRENCY_CHANGES, CONCURRENCY_LIMIT, IN_FLIGHT
+
+""" 按上游 (chinaxiv / ia) 自适应的并发上限。worker 数只是天花板，真正同时在请求某个上游的数量由 AIMDLimiter 决定:
+每个窗口的请求都成功就 +increase，遇到过载信号 (429/5xx/超时/连不上，或者延迟明显上升) 就乘 decrease """
+
+OVERLOAD_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+
+def parse_limits(spec: str) -> Tuple[int, int, int]:
+    """ "min:initial:max" -> (min, initial, max) """
+    min_limit, initial, max_limit = (int(x) for x in spec.split(":"))
+    assert 1 <= min_limit <= initial <= max_limit, f"expected 1 <= min <= initial <= max, got {spec!r}"
+    return min_limit, initial, max_limit
+
+
+def is_overload(e: BaseException) -> bool:
+    """ 上游忙不过来的信号。404、解析失败之类与负载无关的错误不算 """
+    if isinstance(e, (httpx.TimeoutException, httpx.NetworkError)):
+        return True
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in OVERLOAD_STATUS_CODES
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(e, requests.exceptions.HTTPError):
+        return e.response is not None and e.response.status_code in OVERLOAD_STATUS_CODES
+    return False
+
+
+class AIMDLimiter:
+    """ 动态上限的信号量。limit 在 [min_limit, max_limit] 之间按 AIMD 调整，当前值写进 chinaxivxiv_concurrency_limit。
+    latency_tolerance: 延迟 EWMA 超过历史最低的这么多倍就当作过载；None 不看延迟 (IA 上传耗时跟文件大小走，不可比) """
+    def __init__(self, name: str, initial: int, min_limit: int = 1, max_limit: int = 64,
+                 increase: float = 1.0, decrease: float = 0.5, latency_tolerance: Optional[float] = 3.0):
+        assert 1 <= min_limit <= initial <= max_limit
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.limit = float(initial)
+        self.in_flight = 0
+        self.latency_ewma: Optional[float] = None
+        self.latency_baseline: Optional[float] = None
+        self.decreased_at = 0.0
+        self._waiters: Deque[asyncio.Future] = collections.deque()
+        CONCURRENCY_LIMIT.set(initial, upstream=name)
+
+    @classmethod
+    def from_spec(cls, name: str, spec: str, **kwargs) -> "AIMDLimiter":
+        min_limit, initial, max_limit = parse_limits(spec)
+        return cls(name, initial, min_limit=min_limit, max_limit=max_limit, **kwargs)
+
+    async def acquire(self):
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self._take()
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            await future # _wake 已经替我们占好了位置
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                self._waiters.remove(future)
+            raise
+
+    def _take(self):
+        self.in_flight += 1
+        IN_FLIGHT.set(self.in_flight, queue=self.name)
+
+    def release(self):
+        self.in_flight -= 1
+        IN_FLIGHT.set(self.in_flight, queue=self.name)
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.in_flight < int(self.limit):
+            future = self._waiters.popleft()
+            if not future.done():
+                self._take()
+                future.set_result(None)
+
+    def _set_limit(self, limit: float):
+        limit = min(self.max_limit, max(self.min_limit, limit))
+        if int(limit) != int(self.limit):
+            CONCURRENCY_CHANGES.inc(upstream=self.name, direction="up" if limit > self.limit else "down")
+            CONCURRENCY_LIMIT.set(int(limit), upstream=self.name)
+        self.limit = limit
+        self._wake()
+
+    def on_success(self, latency: float):
+        if self.latency_tolerance is not None:
+            self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+            if self.latency_baseline is None or self.latency_ewma < self.latency_baseline:
+                self.latency_baseline = self.latency_ewma
+            if self.latency_ewma > self.latency_tolerance * self.latency_baseline + 0.1: # 对面开始排队了
+                self.on_overload()
+                self.latency_ewma = None # 重新观察
+                return
+        # 每个成功加 increase/limit，整个窗口都成功合计 +increase
+        self._set_limit(self.limit + self.increase / self.limit)
+
+    def on_overload(self):
+        """ 同一窗口里一起失败的请求只减一次 """
+        now = time.monotonic()
+        if now - self.decreased_at < max(self.latency_ewma or 0, 1.0):
+            return
+        self.decreased_at = now
+        self._set_limit(self.limit * self.decrease)
+
+    @contextlib.asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """ async with limiter.slot(): ... 正常退出算成功，抛过载类异常算过载，其他异常不计 """
+        await self.acquire()
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            if is_overload(e):
+                self.on_overload()
+            raise
+        else:
+            self.on_success(time.monotonic() - start)
+        finally:
+            self.release()
+
+    def stats(self) -> Dict:
+        return {"limit": int(self.limit), "in_flight": self.in_flight, "waiting": len(self._waiters)}
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    """ body 读完/关闭时才归还并发名额，流式下载 PDF 的整个过程都占着一个位置 """
+    def __init__(self, stream: httpx.AsyncByteStream, limiter: AIMDLimiter):
+        self.stream = stream
+        self.limiter = limiter
+        self.released = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            if not self.released:
+                self.released = True
+                self.limiter.release()
+
+
+class ConcurrencyLimitedTransport(httpx.AsyncBaseTransport):
+    """ 按 host 限制同时在途的请求数，用响应码和首字节延迟给对应的 AIMDLimiter 反馈 """
+    def __init__(self, transport: httpx.AsyncBaseTransport, limiters: Dict[str, AIMDLimiter], hosts: Dict[str, str]):
+        self.transport = transport
+        self.limiters = limiters
+        self.hosts = hosts
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        limiter_name = self.hosts.get(request.url.host)
+        if limiter_name is None:
+            return await self.transport.handle_async_request(request)
+        limiter = self.limiters[limiter_name]
+        await limiter.acquire()
+        start = time.monotonic()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException as e:
+            if isinstance(e, Exception) and is_overload(e):
+                limiter.on_overload()
+            limiter.release()
+            raise
+        if response.status_code in OVERLOAD_STATUS_CODES:
+            limiter.on_overload()
+        else:
+            limiter.on_success(time.monotonic() - start)
+        assert isinstance(response.stream, httpx.AsyncByteStream)
+        return httpx.Response(response.status_code, headers=response.headers,
+                              stream=_ReleasingStream(response.stream, limiter), extensions=response.extensions)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+if __name__ == "__main__":
+    async def test_aimd_limiter():
+        limiter = AIMDLimiter("test", initial=2, min_limit=1, max_limit=8, latency_tolerance=None)
+        peak = 0
+
+        async def job(fail: bool):
+            nonlocal peak
+            async with limiter.slot():
+                peak = max(peak, limiter.in_flight)
+                await asyncio.sleep(0.01)
+                if fail:
+                    raise httpx.ConnectError("overloaded")
+
+        await asyncio.gather(*(job(False) for _ in range(200)))
+        assert limiter.limit == 8 and peak == 8, (limiter.limit, peak) # 加性增长到上限
+        results = await asyncio.gather(*(job(True) for _ in range(8)), return_exceptions=True)
+        assert all(isinstance(r, httpx.ConnectError) for r in results)
+        assert limiter.limit == 4, limiter.limit # 同一窗口的失败只减半一次
+        assert limiter.in_flight == 0 and not limiter._waiters
+
+        # transport: 503 减半，body 读完才归还名额
+        codes = iter([200] * 20 + [503] + [200] * 3)
+
+        def handler(request: httpx.Request):
+            return httpx.Response(next(codes), content=b"x" * 10)
+
+        origin = AIMDLimiter("origin", initial=4, max_limit=16, latency_tolerance=None)
+        transport = ConcurrencyLimitedTransport(httpx.MockTransport(handler), {"origin": origin}, {"chinaxiv.org": "origin"})
+        async with httpx.AsyncClient(transport=transport) as client:
+            for _ in range(20):
+                async with client.stream("GET", "https://chinaxiv.org/") as r:
+                    assert origin.in_flight == 1
+                    await r.aread()
+            assert origin.in_flight == 0 and origin.limit > 4, origin.stats()
+            before = origin.limit
+            await client.get("https://chinaxiv.org/")
+            assert origin.limit == before / 2, origin.stats()
+            await client.get("https://archive.org/") # 不限
+        print("ok")
+
+    asyncio.run(test_aimd_limiter())
@@ -1,5 +1,6 @@
+import os
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Dict, List, Optional
 from bson import ObjectId
 
@@ -8,6 +9,70 @@ DEFAULT_HEADERS = {
     "User-Agent": "ChinaXiv Archive Mirror Project/0.2.0 (STW; SaveTheWeb; +github.com/saveweb; saveweb@saveweb.org) (qos-rate-limit: 3q/s)",
 }
 DEBUG = 1
+ORIGIN_RATE_LIMIT = float(os.getenv("CHINAXIVXIV_ORIGIN_RATE_LIMIT", "3"))
+""" 对 chinaxiv.org 与 global.chinaxiv.org 合计的 q/s，与 User-Agent 里承诺的一致 """
+ORIGIN_HOSTS = ("chinaxiv.org", "global.chinaxiv.org")
+HTTP_CACHE_DIR = os.getenv("CHINAXIVXIV_HTTP_CACHE_DIR", ".http_cache")
+""" abstract 页面与 get_browse_db 响应的磁盘缓存目录，留空关闭缓存 """
+HTTP_CACHE_MAX_BYTES = int(os.getenv("CHINAXIVXIV_HTTP_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+HTTP2 = os.getenv("CHINAXIVXIV_HTTP2", "auto")
+""" auto: 装了 h2 (pip install httpx[http2]) 就对 chinaxiv / archive.org 协商 HTTP/2，不支持的服务器自动退回 HTTP/1.1 | on | off """
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("CHINAXIVXIV_HTTP_KEEPALIVE_SECONDS", "15"))
+""" 到 chinaxiv / archive.org 的空闲连接保留多久，应小于对面的 keep-alive 超时 """
+RATE_COORDINATION = os.getenv("CHINAXIVXIV_RATE_COORDINATION", "")
+""" "mongo": 多进程/多机通过 Mongo 共享 ORIGIN_RATE_LIMIT；留空则每个进程各自限速 """
+HTML_PARSER = os.getenv("CHINAXIVXIV_HTML_PARSER", "auto")
+""" abstract 页面解析后端: auto | lxml | selectolax | html.parser """
+PARSE_MODE = os.getenv("CHINAXIVXIV_PARSE_MODE", "process")
+""" abstract 页面在哪解析: inline (直接在 event loop 里) | thread | process """
+PDF_SPOOL_MAX_SIZE = int(os.getenv("CHINAXIVXIV_PDF_SPOOL_MAX_SIZE", str(8 * 1024 * 1024)))
+""" PDF 下载超过这个大小就从内存落盘 """
+PARSE_WORKERS = int(os.getenv("CHINAXIVXIV_PARSE_WORKERS", "0")) or (os.cpu_count() or 1)
+PROCESSES = int(os.getenv("CHINAXIVXIV_PROCESSES", "1"))
+""" ChinaXivXiv.main 启动的进程数，每个进程领一个分片 """
+UPLOAD_WORKERS = int(os.getenv("CHINAXIVXIV_UPLOAD_WORKERS", "16"))
+""" runner=workers 时每个进程的 IA_upload_worker 协程数。只是上限，同时请求 chinaxiv / IA 的数量由下面两个 AIMD 上限决定 """
+ORIGIN_CONCURRENCY = os.getenv("CHINAXIVXIV_ORIGIN_CONCURRENCY", "1:4:16")
+""" min:initial:max，每个进程同时在途的 chinaxiv.org 请求数 (PDF 下载整个过程占一个)，按响应码和延迟自动调整 """
+IA_CONCURRENCY = os.getenv("CHINAXIVXIV_IA_CONCURRENCY", "1:5:16")
+""" min:initial:max，每个进程同时进行的 IA 上传数，遇到 503 SlowDown 等减半 """
+SHARD = os.getenv("CHINAXIVXIV_SHARD", "0/1")
+""" I/K: 多台机器分队列时本机是第 I 台，共 K 台 """
+RUNNER = os.getenv("CHINAXIVXIV_RUNNER", "workers")
+""" workers: N 个 IA_upload_worker | pipeline: 分阶段流水线 | spool: 下载到本机 spool 和从 spool 上传 IA 各跑 N 个 worker """
+SPOOL_DIR = os.getenv("CHINAXIVXIV_SPOOL_DIR", ".spool")
+""" runner=spool 的本地缓冲目录，第 i 个进程用其下的 i/ 子目录。重启后接着上传里面已下载好的任务，
+--processes 调小后多出来的子目录由 i 号进程并进自己的 (子目录序号 % 进程数 == i) """
+SPOOL_MAX_BYTES = int(os.getenv("CHINAXIVXIV_SPOOL_MAX_BYTES", str(20 * 1024 ** 3)))
+""" 每个进程的 spool 超过这么大就暂停下载，等上传腾出空间 """
+SPOOL_STALE_AFTER = timedelta(hours=float(os.getenv("CHINAXIVXIV_SPOOL_STALE_HOURS", "24")))
+""" UPLOADTOIA_SPOOLED 的任务 spool.spooled_at 之后这么久还没传上去 (那台机器没了、spool 目录被删了)，
+reaper 放回 TODO 让别的机器重新下载。要比 RETRY_BACKOFF_MAX 长，不然退避中的任务也会被放回 """
+PIPELINE_CONCURRENCY = os.getenv("CHINAXIVXIV_PIPELINE_CONCURRENCY", "")
+""" 覆盖各阶段并发数，例如 "pdf=3,upload=8" """
+LEASE_DURATION = timedelta(seconds=int(os.getenv("CHINAXIVXIV_LEASE_SECONDS", "600")))
+""" 领取任务后的租约时长，worker 心跳续租，过期由 reaper 放回 TODO """
+MAX_ATTEMPTS = int(os.getenv("CHINAXIVXIV_MAX_ATTEMPTS", "5"))
+""" 临时失败最多重试几次，之后记 *_FAIL """
+RETRY_BACKOFF = float(os.getenv("CHINAXIVXIV_RETRY_BACKOFF_SECONDS", "60"))
+""" 第 n 次失败后等 RETRY_BACKOFF * 2^(n-1) 秒（最多 RETRY_BACKOFF_MAX）再让任务可以被领取 """
+RETRY_BACKOFF_MAX = float(os.getenv("CHINAXIVXIV_RETRY_BACKOFF_MAX_SECONDS", str(6 * 3600)))
+IA_UPLOAD_WORKERS = int(os.getenv("CHINAXIVXIV_IA_UPLOAD_WORKERS", "5"))
+""" IA 上传线程池大小，也是 session 池的上限 """
+IA_MULTIPART_THRESHOLD = int(os.getenv("CHINAXIVXIV_IA_MULTIPART_THRESHOLD", str(64 * 1024 * 1024)))
+""" PDF 不小于这么大就走 S3 multipart 分块并发上传，0 关闭 """
+IA_MULTIPART_PART_SIZE = int(os.getenv("CHINAXIVXIV_IA_MULTIPART_PART_SIZE", str(16 * 1024 * 1024)))
+""" 每块的字节数。S3 要求除最后一块外不小于 5 MiB """
+IA_MULTIPART_PARALLELISM = int(os.getenv("CHINAXIVXIV_IA_MULTIPART_PARALLELISM", "4"))
+""" 一个文件同时上传几块。内存占用约 IA_MULTIPART_PART_SIZE * IA_MULTIPART_PARALLELISM """
+METRICS_PORT = int(os.getenv("CHINAXIVXIV_METRICS_PORT", "0"))
+""" Prometheus /metrics 端口，0 关闭；多进程时第 i 个进程用 METRICS_PORT + i """
+METRICS_JSONL = os.getenv("CHINAXIVXIV_METRICS_JSONL", "")
+""" 非空时每 METRICS_JSONL_INTERVAL 秒往这个文件追加一行指标快照 """
+METRICS_JSONL_INTERVAL = float(os.getenv("CHINAXIVXIV_METRICS_JSONL_INTERVAL", "60"))
+IA_SEARCH_URL = os.getenv("CHINAXIVXIV_IA_SEARCH_URL", "https://archive.org/advancedsearch.php")
+IA_SCRAPE_URL = os.getenv("CHINAXIVXIV_IA_SCRAPE_URL", "https://archive.org/services/search/v1/scrape")
+IA_METADATA_URL = os.getenv("CHINAXIVXIV_IA_METADATA_URL", "https://archive.org/metadata")
 
 class Status:
     TODO = "TODO"
@@ -34,21 +99,57 @@ class Status:
 
     # UPLOADTOIA_TODO = "UPLOADTOIA_TODO"
     UPLOADTOIA_PROCESSING = "UPLOADTOIA_PROCESSING"
+    UPLOADTOIA_SPOOLED = "UPLOADTOIA_SPOOLED"
+    """ abstract 页面、browse_db 记录和 PDF 已下载到某台机器的 spool (spool.id)，等待那台机器上传 """
+    UPLOADTOIA_UPLOADING = "UPLOADTOIA_UPLOADING"
+    """ 正在从 spool 上传 """
+    UPLOADTOIA_VERIFYING = "UPLOADTOIA_VERIFYING"
+    """ 已上传，等待 IA item 创建完成 """
     UPLOADTOIA_DONE = "UPLOADTOIA_DONE"
+    UPLOADTOIA_EMPTY = "UPLOADTOIA_EMPTY"
+    """ browse_db 查不到 / abstract 或 PDF 404 """
     UPLOADTOIA_FAIL = "UPLOADTOIA_FAIL"
+    """ 永久失败，或临时失败重试 MAX_ATTEMPTS 次仍未成功 """
 
 
-@dataclass
+LEASED_STATUSES = {
+    Status.PROCESSING: Status.TODO,
+    Status.DOWNLOAD_PROCESSING: Status.TODO,
+    Status.METADATA_PROCESSING: Status.TODO,
+    Status.UPLOADTOIA_PROCESSING: Status.TODO,
+    Status.UPLOADTOIA_UPLOADING: Status.UPLOADTOIA_SPOOLED,
+}
+""" 带租约的处理中状态 -> 租约过期后放回的状态 """
+
+
+STATUSES = frozenset(value for name, value in vars(Status).items() if not name.startswith("_"))
+""" 所有合法的 status，只算一次 """
+
+
+@dataclass(slots=True)
 class Task:
     _id: ObjectId
     identifier: str
     """ localIdentifier:chinaxiv_1041 """
     status: Status
     datestamp: str
-    metadata: Dict
+    metadata: Optional[Dict] = None
+    """ OAI metadata。领取任务时不取，要用的阶段用 mongo_ops.load_tasks_metadata 只取需要的字段 """
+    attempts: int = 0
+    """ 已经失败过几次，决定下次退避多久 """
+    worker_id: Optional[str] = None
+    """ 领取它的 worker。提交结果时带上它和 status，租约被收回、任务被别人领走之后就写不进去了 """
 
     def __post_init__(self):
-        assert self.status in Status.__dict__.values()
+        assert self.status in STATUSES, self.status
+
+    @classmethod
+    def from_doc(cls, doc: Dict) -> "Task":
+        """ 忽略文档里的其他字段 (claim_at、lease_token、bucket ...) """
+        return cls(**{name: doc[name] for name in TASK_FIELDS if name in doc})
+
+
+TASK_FIELDS = tuple(Task.__dataclass_fields__)
 
 
 '''
@@ -1,3 +1,25 @@
 class EmptyContent(Exception):
     """empty content 404"""
-    pass
\ No newline at end of file
+    pass
+
+
+class PermanentFailure(Exception):
+    """上游返回的内容不对（id 对不上、不是 PDF ...），重试也没用"""
+    pass
+
+
+class OAIError(Exception):
+    """OAI-PMH error response"""
+    def __init__(self, code: str | None, message: str | None):
+        super().__init__(f"OAI-PMH error {code}: {message}")
+        self.code = code
+
+
+class ItemNotCreated(Exception):
+    """上传后等了 VERIFY_TIMEOUT，/metadata 里仍然没有这个 item，重新上传"""
+    pass
+
+
+class ChecksumMismatch(Exception):
+    """上传后 IA 返回的 ETag 和本地算的 MD5 对不上，重传"""
+    pass
@@ -0,0 +1,87 @@
+import datetime
+import random
+from typing import Dict
+
+import httpx
+import requests
+
+from ChinaXivXiv.defines import MAX_ATTEMPTS, RETRY_BACKOFF, RETRY_BACKOFF_MAX, Status, Task
+from ChinaXivXiv.exceptions import EmptyContent, PermanentFailure
+from ChinaXivXiv.metrics import TASK_FAILURES
+from ChinaXivXiv.mongo_ops import utcnow
+
+""" 任务失败分三类:
+- empty: 上游没有这篇 (browse_db 查不到、404)，记 *_EMPTY，不再重试
+- permanent: 上游内容不对、数据不符合预期，记 *_FAIL，不再重试
+- transient: 超时、连不上、5xx、限流，以及没见过的异常。放回 TODO 并写 next_attempt_at 指数退避，
+  claim 时跳过还没到点的；失败 MAX_ATTEMPTS 次后记 *_FAIL """
+
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+EMPTY = "empty"
+
+RETRYABLE_4XX = frozenset({401, 403, 408, 429})
+""" 鉴权问题多半是配置错了，修好之后应该能重试成功 """
+
+
+def _classify_status_code(status_code: int) -> str:
+    if 400 <= status_code < 500 and status_code not in RETRYABLE_4XX:
+        return PERMANENT
+    return TRANSIENT
+
+
+def classify_failure(e: BaseException) -> str:
+    if isinstance(e, EmptyContent):
+        return EMPTY
+    if isinstance(e, (PermanentFailure, AssertionError)): # 数据不符合预期，同样的数据再来一遍还是一样
+        return PERMANENT
+    if isinstance(e, httpx.HTTPStatusError):
+        if e.response.status_code in (404, 410):
+            return EMPTY
+        return _classify_status_code(e.response.status_code)
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        return _classify_status_code(e.response.status_code)
+    return TRANSIENT
+
+
+def retry_delay(attempts: int, base: float = RETRY_BACKOFF, cap: float = RETRY_BACKOFF_MAX) -> float:
+    """ 第 attempts 次失败之后等多久。带 ±20% 抖动，同一批失败的任务不会同时回来 """
+    delay = min(cap, base * 2 ** (attempts - 1))
+    return delay * random.uniform(0.8, 1.2)
+
+
+def failure_task_fields(TASK: Task, e: BaseException, fail_status: str = Status.UPLOADTOIA_FAIL,
+                        empty_status: str = Status.UPLOADTOIA_EMPTY, retry_status: str = Status.TODO) -> Dict:
+    """ -> update_task 的 status 和字段。retry_status: 临时失败放回哪个状态 (从 spool 上传失败的放回 SPOOLED) """
+    kind = classify_failure(e)
+    attempts = TASK.attempts + 1
+    TASK_FAILURES.inc(kind=kind, error=type(e).__name__)
+    fields = {"attempts": attempts, "last_error": repr(e)[:500], "failure": kind, "failed_at": utcnow()}
+    if kind == EMPTY:
+        return {"status": empty_status, **fields}
+    if kind == PERMANENT or attempts >= MAX_ATTEMPTS:
+        return {"status": fail_status, **fields}
+    next_attempt_at = utcnow() + datetime.timedelta(seconds=retry_delay(attempts))
+    return {"status": retry_status, "next_attempt_at": next_attempt_at, **fields}
+
+
+if __name__ == "__main__":
+    from bson import ObjectId
+
+    def test_failure_task_fields():
+        TASK = Task(_id=ObjectId(), identifier="localIdentifier:chinaxiv_1", status=Status.UPLOADTOIA_PROCESSING,
+                    datestamp="2020-01-01")
+        request = httpx.Request("GET", "https://chinaxiv.org/abs/202001.00001v1")
+        assert failure_task_fields(TASK, EmptyContent("chinaxiv_1 not in dbList"))["status"] == Status.UPLOADTOIA_EMPTY
+        assert failure_task_fields(TASK, httpx.HTTPStatusError("404", request=request,
+                                                               response=httpx.Response(404)))["status"] == Status.UPLOADTOIA_EMPTY
+        assert failure_task_fields(TASK, PermanentFailure("not a PDF"))["status"] == Status.UPLOADTOIA_FAIL
+        fields = failure_task_fields(TASK, httpx.HTTPStatusError("503", request=request, response=httpx.Response(503)))
+        assert fields["status"] == Status.TODO and fields["attempts"] == 1 and fields["failure"] == TRANSIENT, fields
+        TASK.attempts = MAX_ATTEMPTS - 1
+        assert failure_task_fields(TASK, httpx.ConnectTimeout("timeout"))["status"] == Status.UPLOADTOIA_FAIL
+        for n, expected in enumerate([60, 120, 240, 480, 600, 600], start=1):
+            assert 0.8 * expected <= retry_delay(n, base=60, cap=600) <= 1.2 * expected, n
+        print("ok")
+
+    test_failure_task_fields()
@@ -0,0 +1,262 @@
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import time
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+import httpx
+
+HOP_BY_HOP_HEADERS = {"content-encoding", "transfer-encoding", "content-length", "connection", "keep-alive"}
+""" 缓存的是解码后的 body，这些头不能原样回放 """
+
+
+RESCAN_RATIO = 0.01
+""" 本进程写入累计超过 max_bytes 的这个比例就重新扫一遍目录 """
+
+ENTRY_SUFFIX = ".entry"
+LEGACY_SUFFIXES = (".json", ".body")
+
+
+class DiskCache:
+    """ 内容寻址的磁盘缓存: key = sha256(method + url + body)，每条是一个 {key}.entry 文件:
+    第一行是 JSON 元数据，后面是 body，写临时文件后一次 os.replace 发布，读者要么看到旧条目要么看到新条目。
+    命中时 touch 文件的 mtime，超过 max_bytes 时按 mtime 淘汰最久未用的 (LRU)。
+    多个进程共用一个目录: total_bytes 只是本进程的估计，定期和淘汰前都按目录实际大小重算 """
+    def __init__(self, directory: str, max_bytes: int = 2 * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._remove_legacy()
+        self.total_bytes = sum(size for _, _, size in self._scan())
+        self._written_since_scan = 0
+
+    @staticmethod
+    def make_key(method: str, url: str, body: bytes = b"") -> str:
+        return hashlib.sha256(method.upper().encode() + b" " + url.encode() + b"\n" + body).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ENTRY_SUFFIX)
+
+    def _subdirs(self) -> Iterator[str]:
+        for sub in os.listdir(self.directory):
+            subdir = os.path.join(self.directory, sub)
+            if os.path.isdir(subdir):
+                yield subdir
+
+    def _remove_legacy(self):
+        """ 旧版本分开存的 {key}.json + {key}.body 不再读，也不会被淘汰，启动时清掉 """
+        for subdir in self._subdirs():
+            for name in os.listdir(subdir):
+                if name.endswith(LEGACY_SUFFIXES):
+                    try:
+                        os.remove(os.path.join(subdir, name))
+                    except FileNotFoundError:
+                        pass
+
+    def _scan(self) -> Iterator[Tuple[str, float, int]]:
+        """ -> (key, mtime, size) """
+        for subdir in self._subdirs():
+            for name in os.listdir(subdir):
+                if not name.endswith(ENTRY_SUFFIX):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(subdir, name))
+                except FileNotFoundError:
+                    continue
+                yield name.removesuffix(ENTRY_SUFFIX), stat.st_mtime, stat.st_size
+
+    def get(self, key: str, touch: bool = True) -> Optional[Tuple[Dict, bytes]]:
+        entry = self._load(key)
+        if entry is None:
+            return None
+        if touch:
+            try:
+                os.utime(self._path(key)) # LRU
+            except FileNotFoundError: # 刚被别的进程淘汰，这次照样算命中
+                pass
+        return entry
+
+    def _load(self, key: str, predicate: Optional[Callable[[Dict], bool]] = None) -> Optional[Tuple[Dict, bytes]]:
+        """ predicate 不满足时只读了第一行元数据就返回 None，不读 body """
+        try:
+            with open(self._path(key), "rb") as f:
+                meta = json.loads(f.readline())
+                if predicate is not None and not predicate(meta):
+                    return None
+                body = f.read()
+        except (FileNotFoundError, ValueError):
+            return None
+        if hashlib.md5(body).hexdigest() != meta.get("body_md5"): # 截断/损坏的文件
+            return None
+        return meta, body
+
+    def put(self, key: str, meta: Dict, body: bytes):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        meta = {**meta, "body_md5": hashlib.md5(body).hexdigest()}
+        # json.dumps 会把字符串里的换行转义，第一行就是完整的元数据
+        header = json.dumps(meta, ensure_ascii=False).encode("utf-8") + b"\n"
+        try:
+            old_size = os.path.getsize(path)
+        except FileNotFoundError:
+            old_size = 0
+        # 同一进程里也可能有几个 to_thread 同时写同一个 key，临时文件各用各的
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(header)
+            f.write(body)
+        os.replace(tmp_path, path)
+        written = len(header) + len(body)
+        self.total_bytes += written - old_size
+        self._written_since_scan += written
+        if self.total_bytes > self.max_bytes or self._written_since_scan > self.max_bytes * RESCAN_RATIO:
+            self.evict()
+
+    def delete(self, key: str):
+        path = self._path(key)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            self.total_bytes -= size
+        except FileNotFoundError: # 别的进程已经删了
+            pass
+
+    def evict(self, target_ratio: float = 0.9):
+        """ 先按目录实际大小重算 total_bytes (其他进程的写入和淘汰)，超了就一次淘汰到 max_bytes 的 90%，摊薄扫描目录的开销 """
+        entries = sorted(self._scan(), key=lambda entry: entry[1])
+        self.total_bytes = sum(size for _, _, size in entries)
+        self._written_since_scan = 0
+        if self.total_bytes <= self.max_bytes:
+            return
+        target = self.max_bytes * target_ratio
+        for key, _, _ in entries:
+            if self.total_bytes <= target:
+                break
+            self.delete(key)
+
+    def iter_entries(self, predicate: Optional[Callable[[Dict], bool]] = None) -> Iterator[Tuple[Dict, bytes]]:
+        """ 只读遍历，不 touch mtime。predicate 按元数据过滤，不满足的不读 body """
+        for key, _, _ in self._scan():
+            entry = self._load(key, predicate)
+            if entry is not None:
+                yield entry
+
+
+class CachingTransport(httpx.AsyncBaseTransport):
+    """ 缓存 cacheable(request) 为真的 200 响应。max_age 以内直接返回缓存，不发请求；
+    过期后带 If-None-Match / If-Modified-Since 重新验证，304 则继续用缓存 """
+    def __init__(self, transport: httpx.AsyncBaseTransport, cache: DiskCache,
+                 cacheable: Callable[[httpx.Request], bool], max_age: float = 7 * 24 * 3600):
+        self.transport = transport
+        self.cache = cache
+        self.cacheable = cacheable
+        self.max_age = max_age
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    @staticmethod
+    def _to_response(request: httpx.Request, meta: Dict, body: bytes) -> httpx.Response:
+        return httpx.Response(meta["status_code"], headers=meta["headers"], content=body, request=request,
+                              extensions={"from_cache": True})
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if not self.cacheable(request):
+            return await self.transport.handle_async_request(request)
+
+        key = DiskCache.make_key(request.method, str(request.url), await request.aread())
+        cached = await asyncio.to_thread(self.cache.get, key)
+        if cached is not None:
+            meta, body = cached
+            if time.time() - meta["stored_at"] < self.max_age:
+                self.hits += 1
+                return self._to_response(request, meta, body)
+            if meta.get("etag"):
+                request.headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                request.headers["If-Modified-Since"] = meta["last_modified"]
+
+        response = await self.transport.handle_async_request(request)
+        if cached is not None and response.status_code == 304:
+            await response.aclose()
+            self.revalidated += 1
+            meta, body = cached
+            meta["stored_at"] = time.time()
+            await asyncio.to_thread(self.cache.put, key, meta, body)
+            return self._to_response(request, meta, body)
+        if response.status_code != 200:
+            return response
+
+        self.misses += 1
+        body = await response.aread()
+        headers = {k: v for k, v in response.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+        meta = {
+            "method": request.method,
+            "url": str(request.url),
+            "status_code": response.status_code,
+            "headers": headers,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "stored_at": time.time(),
+        }
+        await asyncio.to_thread(self.cache.put, key, meta, body)
+        return self._to_response(request, meta, body)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    async def test_caching_transport():
+        calls = []
+
+        def handler(request: httpx.Request):
+            calls.append(request)
+            if request.headers.get("If-None-Match") == '"v1"':
+                return httpx.Response(304)
+            return httpx.Response(200, headers={"ETag": '"v1"'}, content=b"<html>" + request.content + b"</html>")
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = DiskCache(directory, max_bytes=10 * 1024)
+            transport = CachingTransport(httpx.MockTransport(handler), cache, lambda request: True)
+            async with httpx.AsyncClient(transport=transport) as client:
+                for _ in range(3):
+                    assert (await client.post("https://global.chinaxiv.org/api/get_browse_db", content=b"a")).content == b"<html>a</html>"
+                assert (await client.post("https://global.chinaxiv.org/api/get_browse_db", content=b"b")).content == b"<html>b</html>"
+                assert len(calls) == 2, calls # 不同 body 不同 key
+
+                transport.max_age = 0 # 过期 -> 条件请求
+                assert (await client.post("https://global.chinaxiv.org/api/get_browse_db", content=b"a")).content == b"<html>a</html>"
+                assert calls[-1].headers["If-None-Match"] == '"v1"' and transport.revalidated == 1
+
+                for i in range(100): # 触发淘汰
+                    await client.get(f"https://chinaxiv.org/abs/{i}")
+                assert cache.total_bytes <= cache.max_bytes
+
+            # 另一个进程往同一目录写: 淘汰时按目录实际大小算
+            other = DiskCache(directory, max_bytes=10 * 1024)
+            for i in range(100):
+                other.put(DiskCache.make_key("GET", f"https://chinaxiv.org/other/{i}"), {"stored_at": 0}, b"x" * 200)
+            cache.put(DiskCache.make_key("GET", "https://chinaxiv.org/last"), {"stored_at": 0}, b"y")
+            assert sum(size for _, _, size in cache._scan()) <= cache.max_bytes
+
+            # 同一个 key 并发写、边写边读: 每次都读到某一个写者完整的元数据 + body
+            key = DiskCache.make_key("GET", "https://chinaxiv.org/same")
+            cache.put(key, {"n": -1}, b"-1")
+
+            def read_loop():
+                for _ in range(200):
+                    meta, body = cache.get(key)
+                    assert body == str(meta["n"]).encode() * (1000 if meta["n"] >= 0 else 1), meta
+            await asyncio.gather(asyncio.to_thread(read_loop),
+                                 *(asyncio.to_thread(cache.put, key, {"n": n}, str(n).encode() * 1000) for n in range(20)))
+            meta, body = cache.get(key)
+            assert body == str(meta["n"]).encode() * 1000, meta
+            assert not [name for _, _, names in os.walk(directory) for name in names if name.endswith(".tmp")]
+        print("ok")
+
+    asyncio.run(test_caching_transport())
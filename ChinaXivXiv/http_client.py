@@ -0,0 +1,232 @@
+import importlib.util
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+from ChinaXivXiv.concurrency import AIMDLimiter, ConcurrencyLimitedTransport
+from ChinaXivXiv.defines import DEFAULT_HEADERS, HTTP2, HTTP_KEEPALIVE_EXPIRY, ORIGIN_HOSTS, ORIGIN_RATE_LIMIT
+from ChinaXivXiv.http_cache import CachingTransport, DiskCache
+from ChinaXivXiv.metrics import HTTP_CONNECTIONS, HTTP_HANDSHAKE_SECONDS, record_response
+from ChinaXivXiv.ratelimit import MongoRateCoordinator, RateLimitedTransport, TokenBucket
+
+IA_HOSTS = ("archive.org",)
+""" 走 httpx 的 IA 请求 (search / scrape / metadata)。上传走 internetarchive 自己的 requests session """
+
+
+def is_cacheable(request: httpx.Request) -> bool:
+    """ 只缓存 abstract 页面和 get_browse_db，PDF 不缓存 """
+    if request.method == "GET" and request.url.host == "chinaxiv.org":
+        return request.url.path.startswith("/abs/")
+    if request.method == "POST" and request.url.host == "global.chinaxiv.org":
+        return request.url.path == "/api/get_browse_db"
+    return False
+
+
+def http2_enabled(setting: str = HTTP2) -> bool:
+    """ HTTP2: auto | on | off。h2 是可选依赖 """
+    if setting == "off":
+        return False
+    available = importlib.util.find_spec("h2") is not None
+    if setting == "on" and not available:
+        raise ImportError("CHINAXIVXIV_HTTP2=on needs h2: pip install httpx[http2]")
+    return available
+
+
+@dataclass(frozen=True)
+class HostProfile:
+    """ 一类上游的连接池参数 """
+    name: str
+    hosts: Tuple[str, ...]
+    http2: bool = False
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 5.0
+    close_head: bool = False
+    """ HEAD 单独走一个不保留空闲连接的 HTTP/1.1 池，并带 Connection: close """
+
+    def transport(self, retries: int = 3) -> httpx.AsyncHTTPTransport:
+        return httpx.AsyncHTTPTransport(http2=self.http2, retries=retries, limits=httpx.Limits(
+            max_connections=self.max_connections, max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry))
+
+    def head_transport(self, retries: int = 3) -> httpx.AsyncHTTPTransport:
+        return httpx.AsyncHTTPTransport(retries=retries, limits=httpx.Limits(
+            max_connections=self.max_connections, max_keepalive_connections=0))
+
+
+def default_profiles(origin_max_connections: int = 100, http2: Optional[bool] = None) -> List[HostProfile]:
+    """ origin_max_connections: 有 AIMD 上限时取它的 max_limit，在途请求数不会超过它，空闲连接也都留着复用 """
+    http2 = http2_enabled() if http2 is None else http2
+    return [
+        # 对面服务器有点奇葩，HEAD 不会关闭连接……GET 正常复用
+        HostProfile("chinaxiv", ORIGIN_HOSTS, http2=http2, max_connections=origin_max_connections,
+                    max_keepalive_connections=origin_max_connections, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+                    close_head=True),
+        HostProfile("ia", IA_HOSTS, http2=http2, max_connections=32, max_keepalive_connections=32,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+    ]
+
+
+class HostProfileTransport(httpx.AsyncBaseTransport):
+    """ 按 host 选连接池: 每个 HostProfile 一个池，其余 host 用 default。
+    wrap: 给每个池再包一层，benchmark 用它把请求转到本地假服务器 """
+    def __init__(self, profiles: List[HostProfile], default: Optional[httpx.AsyncBaseTransport] = None, retries: int = 3,
+                 wrap: Callable[[httpx.AsyncBaseTransport], httpx.AsyncBaseTransport] = lambda transport: transport):
+        self.default = wrap(default or httpx.AsyncHTTPTransport(retries=retries))
+        self.routes: Dict[str, httpx.AsyncBaseTransport] = {}
+        self.head_routes: Dict[str, httpx.AsyncBaseTransport] = {}
+        self.transports = [self.default]
+        for profile in profiles:
+            transport = wrap(profile.transport(retries))
+            self.transports.append(transport)
+            self.routes.update({host: transport for host in profile.hosts})
+            if profile.close_head:
+                head_transport = wrap(profile.head_transport(retries))
+                self.transports.append(head_transport)
+                self.head_routes.update({host: head_transport for host in profile.hosts})
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if request.method == "HEAD" and request.url.host in self.head_routes:
+            request.headers["Connection"] = "close"
+            return await self.head_routes[request.url.host].handle_async_request(request)
+        return await self.routes.get(request.url.host, self.default).handle_async_request(request)
+
+    async def aclose(self):
+        for transport in self.transports:
+            await transport.aclose()
+
+
+class ConnectionTracingTransport(httpx.AsyncBaseTransport):
+    """ 用 httpcore 的 trace 扩展记下每个请求是新建连接还是复用已有连接 (HTTP/2 多路复用也算复用)，
+    以及新连接 TCP 连接 / TLS 握手的耗时 """
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        host = request.url.host # 下层可能改写 url
+        started: Dict[str, float] = {}
+        elapsed: Dict[str, float] = {}
+        parent = request.extensions.get("trace")
+
+        async def trace(name: str, info: Dict):
+            if name.startswith("connection."): # connection.connect_tcp.started / .complete ...
+                event, _, stage = name[len("connection."):].rpartition(".")
+                if stage == "started":
+                    started[event] = time.monotonic()
+                elif stage == "complete" and event in started:
+                    elapsed[event] = time.monotonic() - started[event]
+            if parent is not None:
+                await parent(name, info)
+
+        request.extensions = {**request.extensions, "trace": trace}
+        response = await self.transport.handle_async_request(request)
+        for phase, seconds in elapsed.items():
+            if phase in ("connect_tcp", "start_tls"):
+                HTTP_HANDSHAKE_SECONDS.observe(seconds, host=host, phase=phase)
+        http_version = response.extensions.get("http_version", b"")
+        HTTP_CONNECTIONS.inc(host=host, connection="new" if "connect_tcp" in started else "reused",
+                             http_version=http_version.decode("ascii", "replace") if isinstance(http_version, bytes)
+                             else str(http_version))
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def connection_stats() -> Dict[str, Dict]:
+    """ host -> {new, reused, reuse_ratio, handshake_p50} """
+    stats: Dict[str, Dict] = {}
+    for (host, connection, _), value in HTTP_CONNECTIONS.items():
+        entry = stats.setdefault(host, {"new": 0, "reused": 0})
+        entry[connection] += value
+    for host, entry in stats.items():
+        entry["reuse_ratio"] = entry["reused"] / ((entry["new"] + entry["reused"]) or 1)
+        entry["handshake_p50"] = HTTP_HANDSHAKE_SECONDS.quantile(0.5, host=host, phase="connect_tcp")
+    return stats
+
+
+def build_client(rate_coordinator: Optional[MongoRateCoordinator] = None,
+                 origin_rate_limit: float = ORIGIN_RATE_LIMIT,
+                 cache: Optional[DiskCache] = None,
+                 transport: Optional[httpx.AsyncBaseTransport] = None,
+                 origin_limiter: Optional[AIMDLimiter] = None) -> httpx.AsyncClient:
+    """ 所有 worker 共用的 httpx 客户端: 对 origin 限速，其余 host（IA 等）不限。
+    有 cache 时缓存层在限速层外面，命中缓存不消耗 origin 的配额。
+    transport: 最底层的 transport，默认按 default_profiles 分 host 建连接池 (HostProfileTransport)；
+    benchmark 用它把请求转到本地假服务器
+    origin_limiter: 限制同时在途的 origin 请求数，放在限速层里面，等令牌的时间不算进延迟 """
+    if transport is None:
+        transport = HostProfileTransport(default_profiles(origin_limiter.max_limit if origin_limiter is not None else 100))
+    transport = ConnectionTracingTransport(transport)
+    if origin_limiter is not None:
+        transport = ConcurrencyLimitedTransport(transport, {"chinaxiv": origin_limiter},
+                                                {host: "chinaxiv" for host in ORIGIN_HOSTS})
+    transport = RateLimitedTransport(
+        transport,
+        buckets={"chinaxiv": TokenBucket(rate=origin_rate_limit)},
+        hosts={host: "chinaxiv" for host in ORIGIN_HOSTS},
+        coordinator=rate_coordinator,
+    )
+    if cache is not None:
+        transport = CachingTransport(transport, cache, is_cacheable)
+    h_client = httpx.AsyncClient(timeout=60, transport=transport, event_hooks={"response": [record_response]})
+    h_client.headers.update(DEFAULT_HEADERS)
+    return h_client
+
+
+if __name__ == "__main__":
+    import asyncio
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    from ChinaXivXiv.bench.e2e_bench import RewriteTransport
+
+    def test_host_profiles():
+        seen_connection_headers = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                seen_connection_headers.append(self.headers.get("Connection"))
+                self.send_response(200)
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"ok")
+
+            def do_HEAD(self):
+                seen_connection_headers.append(self.headers.get("Connection"))
+                self.send_response(200)
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+        async def run():
+            transport = HostProfileTransport(default_profiles(4, http2=False), wrap=lambda transport: RewriteTransport(
+                transport, {"chinaxiv.org": base_url, "archive.org": base_url}))
+            async with httpx.AsyncClient(transport=ConnectionTracingTransport(transport)) as client:
+                for _ in range(10):
+                    assert (await client.get("http://chinaxiv.org/abs/1")).status_code == 200
+                for _ in range(3):
+                    assert (await client.head("http://chinaxiv.org/abs/1")).status_code == 200
+                await client.get("http://archive.org/metadata/x")
+
+        asyncio.run(run())
+        server.shutdown()
+        stats = connection_stats()
+        # 10 个 GET 复用一条连接，HEAD 每次新建并带 Connection: close
+        assert stats["chinaxiv.org"]["new"] == 4 and stats["chinaxiv.org"]["reused"] == 9, stats
+        assert seen_connection_headers.count("close") == 3, seen_connection_headers
+        assert stats["archive.org"]["new"] == 1 and stats["chinaxiv.org"]["handshake_p50"] is not None, stats
+        assert http2_enabled("off") is False
+        print("ok", stats)
+
+    test_host_profiles()
@@ -0,0 +1,136 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import queue
+import threading
+from typing import Callable, Dict, Iterator, Optional, Tuple, TypeVar
+from urllib.parse import urlsplit
+
+import internetarchive
+import requests.adapters
+from internetarchive.session import ArchiveSession
+
+from ChinaXivXiv.concurrency import AIMDLimiter
+from ChinaXivXiv.defines import IA_MULTIPART_PARALLELISM, IA_UPLOAD_WORKERS
+
+T = TypeVar("T")
+
+
+def load_ia_keys():
+    """ key_acc, key_sec """
+    with open(".ia_keys", "r") as f:
+        keys = f.read().splitlines()
+    if len(keys) > 2:
+        print("load_ia_keys:", keys[2])
+    return (keys[0], keys[1])
+
+
+class RedirectAdapter(requests.adapters.HTTPAdapter):
+    """ 把 archive.org / s3.us.archive.org 的请求都转到 base_url（本地假 IA）。
+    internetarchive 把 s3.us.archive.org 写死在代码里，只改 session.host 不够。
+    原来的 host 放在 X-Original-Host 里 """
+    def __init__(self, base_url: str, **kwargs):
+        super().__init__(**kwargs)
+        self.base = urlsplit(base_url)
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        request.headers["X-Original-Host"] = url.netloc
+        request.url = url._replace(scheme=self.base.scheme, netloc=self.base.netloc).geturl()
+        return super().send(request, **kwargs)
+
+
+class IAClient:
+    """ 持有一组已认证、保持长连接的 ArchiveSession，上传在自己的线程池里跑，和其他阻塞操作互不抢线程。
+    .ia_keys 只在创建时读一次 """
+    def __init__(self, max_workers: int = IA_UPLOAD_WORKERS, keys: Optional[Tuple[str, str]] = None,
+                 base_url: Optional[str] = None, limiter: Optional[AIMDLimiter] = None):
+        """ base_url: 所有 IA 请求改发到这里，benchmark 用
+        limiter: 同时进行的上传数按 AIMD 调整，线程池按它的上限开 """
+        self.access_key, self.secret_key = keys or load_ia_keys()
+        self.base_url = base_url
+        self.limiter = limiter
+        if limiter is not None:
+            max_workers = max(max_workers, limiter.max_limit)
+        self.max_workers = max_workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ia-upload")
+        self._sessions: queue.LifoQueue[ArchiveSession] = queue.LifoQueue()
+        """ LIFO: 优先复用刚用过、连接还热着的 session """
+        self._created = 0
+        self._lock = threading.Lock()
+        self.queued = 0
+        """ 已提交、等待线程的任务数 """
+        self.in_flight = 0
+        """ 正在执行的任务数 """
+
+    def _new_session(self) -> ArchiveSession:
+        ia = internetarchive.get_session()
+        ia.access_key, ia.secret_key = self.access_key, self.secret_key
+        # internetarchive 默认给每个请求带 Connection: close，分块上传每块都要重新握手，去掉才能复用连接
+        ia.headers.pop("Connection", None)
+        if self.base_url:
+            # 分块上传时一个 session 同时有 IA_MULTIPART_PARALLELISM 个连接，池子小了多出来的连接用完就被丢掉
+            adapter = RedirectAdapter(self.base_url, pool_maxsize=max(self.max_workers, IA_MULTIPART_PARALLELISM))
+            # session 自己给 https://archive.org 挂了带重试的 adapter，前缀更长会优先匹配，要一起换掉
+            for prefix in {"https://", "http://", *ia.adapters}:
+                ia.mount(prefix, adapter)
+        return ia
+
+    @contextlib.contextmanager
+    def session(self) -> Iterator[ArchiveSession]:
+        try:
+            ia = self._sessions.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                self._created += 1
+            ia = self._new_session()
+        try:
+            yield ia
+        finally:
+            self._sessions.put(ia)
+
+    def _call(self, func: Callable[..., T], *args) -> T:
+        with self._lock:
+            self.queued -= 1
+            self.in_flight += 1
+        try:
+            with self.session() as ia:
+                return func(ia, *args)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    async def run(self, func: Callable[..., T], *args) -> T:
+        """ 在上传线程池里执行 func(session, *args) """
+        if self.limiter is None:
+            return await self._submit(func, *args)
+        async with self.limiter.slot():
+            return await self._submit(func, *args)
+
+    async def _submit(self, func: Callable[..., T], *args) -> T:
+        with self._lock:
+            self.queued += 1
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._call, func, *args)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "sessions": self._created,
+            "max_workers": self.max_workers,
+            "limit": int(self.limiter.limit) if self.limiter is not None else self.max_workers,
+        }
+
+    def shutdown(self, wait: bool = True):
+        self.executor.shutdown(wait=wait)
+        while not self._sessions.empty():
+            self._sessions.get_nowait().close()
+
+
+_default_ia_client: Optional[IAClient] = None
+
+def get_ia_client() -> IAClient:
+    global _default_ia_client
+    if _default_ia_client is None:
+        _default_ia_client = IAClient()
+    return _default_ia_client
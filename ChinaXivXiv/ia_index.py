@@ -0,0 +1,185 @@
+import asyncio
+import datetime
+from typing import Dict, List, Optional
+
+import httpx
+import motor.motor_asyncio
+from pymongo import UpdateOne
+
+from ChinaXivXiv.defines import IA_METADATA_URL, IA_SCRAPE_URL
+from ChinaXivXiv.indexes import IA_ITEMS_INDEXES, ensure_indexes
+
+IA_ITEMS_QUERY = "identifier:ChinaXiv-*"
+SCRAPE_FIELDS = ("identifier", "chinaxiv", "chinaxiv_id")
+
+
+def parse_chinaxiv_id(value) -> Optional[int]:
+    """ "localIdentifier:chinaxiv_34185" / "chinaxiv_34185" / "34185" / 34185 -> 34185 """
+    if value is None:
+        return None
+    if isinstance(value, list): # IA 的 metadata 字段可能是数组
+        return parse_chinaxiv_id(value[0] if value else None)
+    value = str(value).removeprefix("localIdentifier:").removeprefix("chinaxiv_")
+    return int(value) if value.isdigit() else None
+
+
+def ia_identifier_of(csoaid: str, version: str | int) -> str:
+    """ 与 build_ia_upload 生成的 identifier 一致 """
+    return f"ChinaXiv-{csoaid}V{version}"
+
+
+def pdf_name_of(identifier: str) -> Optional[str]:
+    """ ChinaXiv-202001.00003V1 -> 202001.00003v1.pdf，与 build_ia_upload 上传的文件名一致 """
+    csoaid, sep, version = identifier.removeprefix("ChinaXiv-").rpartition("V")
+    if not sep or not csoaid or not version.isdigit():
+        return None
+    return f"{csoaid}v{version}.pdf"
+
+
+def archived_pdf(item: Dict, md5: Optional[str] = None) -> Optional[Dict]:
+    """ item 的文件列表里有期望的 {csoaid}v{version}.pdf 才算已归档 (item 建了但 PDF 没传上去的不算)。
+    md5: 调用方知道期望的 PDF md5 时传入，和索引里记的 md5 都有时必须一致 """
+    name = pdf_name_of(item["_id"])
+    for f in item.get("files") or []:
+        if f.get("name") == name:
+            if md5 is not None and f.get("md5") is not None and f["md5"] != md5:
+                return None
+            return f
+    return None
+
+
+class IAItemIndex:
+    """ 本地的 IA item 索引 (Mongo ia_items 集合): identifier -> chinaxiv(csoaid), chinaxiv_id, files(name+md5)。
+    上传前先查这里，已经在 IA 上的就不用再下载 PDF、再上传一遍。
+    用 scrape API 批量灌满，fill_files 补文件列表，每次 IA_verify_worker 确认上传成功后补一条 """
+    def __init__(self, collection: motor.motor_asyncio.AsyncIOMotorCollection):
+        self.collection = collection
+        self.hits = 0
+        self.misses = 0
+
+    async def ensure_indexes(self) -> "IAItemIndex":
+        await ensure_indexes(self.collection, IA_ITEMS_INDEXES)
+        return self
+
+    async def find_by_chinaxiv_id(self, chinaxiv_id) -> Optional[Dict]:
+        """ chinaxiv_id 每个版本唯一，任务的 identifier 里就有，不需要请求任何上游 """
+        chinaxiv_id = parse_chinaxiv_id(chinaxiv_id)
+        if chinaxiv_id is None:
+            return None
+        return self._count(await self.collection.find_one({"chinaxiv_id": chinaxiv_id}))
+
+    async def find_by_identifier(self, identifier: str) -> Optional[Dict]:
+        return self._count(await self.collection.find_one({"_id": identifier}))
+
+    def _count(self, item: Optional[Dict]) -> Optional[Dict]:
+        if item is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return item
+
+    async def record(self, identifier: str, chinaxiv: Optional[str] = None, chinaxiv_id=None,
+                     files: Optional[List[Dict]] = None):
+        await self.record_many([{"identifier": identifier, "chinaxiv": chinaxiv, "chinaxiv_id": chinaxiv_id, "files": files}])
+
+    async def record_many(self, items: List[Dict]) -> int:
+        """ items: [{"identifier", "chinaxiv", "chinaxiv_id", "files"}, ...]，为 None 的字段不覆盖已有值 """
+        if not items:
+            return 0
+        now = datetime.datetime.now(datetime.timezone.utc)
+        requests = []
+        for item in items:
+            fields = {"indexed_at": now}
+            if item.get("chinaxiv"):
+                fields["chinaxiv"] = item["chinaxiv"][0] if isinstance(item["chinaxiv"], list) else item["chinaxiv"]
+            chinaxiv_id = parse_chinaxiv_id(item.get("chinaxiv_id"))
+            if chinaxiv_id is not None:
+                fields["chinaxiv_id"] = chinaxiv_id
+            if item.get("files") is not None:
+                fields["files"] = [{"name": f["name"], "md5": f.get("md5")} for f in item["files"]]
+            requests.append(UpdateOne({"_id": item["identifier"]}, {"$set": fields}, upsert=True))
+        await self.collection.bulk_write(requests, ordered=False)
+        return len(requests)
+
+    async def fill(self, client: httpx.AsyncClient, scrape_url: str = IA_SCRAPE_URL,
+                   query: str = IA_ITEMS_QUERY, page_size: int = 10000) -> int:
+        """ 用 scrape API 翻页拉取全部 ChinaXiv item，每页一次 bulk upsert。
+        scrape 不返回文件列表，MD5 由 fill_files 补 """
+        total = 0
+        cursor = None
+        while True:
+            params = {"q": query, "fields": ",".join(SCRAPE_FIELDS), "count": page_size}
+            if cursor:
+                params["cursor"] = cursor
+            r = await client.get(scrape_url, params=params)
+            r.raise_for_status()
+            page = r.json()
+            total += await self.record_many(page.get("items", []))
+            print(f"IAItemIndex.fill: {total}/{page.get('total', '?')} items")
+            cursor = page.get("cursor")
+            if not cursor:
+                return total
+
+    async def fill_files(self, client: httpx.AsyncClient, metadata_url: str = IA_METADATA_URL,
+                         concurrency: int = 8, limit: int = 0) -> int:
+        """ 给还没有文件列表的 item 逐个查 /metadata/{identifier}/files，记录 name+md5 """
+        identifiers = [doc["_id"] async for doc in self.collection.find({"files": {"$exists": False}},
+                                                                         projection={"_id": 1}, limit=limit)]
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(identifier: str) -> Optional[Dict]:
+            try:
+                async with semaphore:
+                    r = await client.get(f"{metadata_url}/{identifier}/files")
+                r.raise_for_status()
+            except httpx.HTTPError as e: # 单个 item 查失败不影响其他的，下次再查
+                print(f"IAItemIndex.fill_files: {identifier}: {e!r}")
+                return None
+            result = r.json().get("result")
+            if result is None: # item 不存在或还没建好，下次再查
+                return None
+            return {"identifier": identifier, "files": [f for f in result if f.get("source") != "metadata"]}
+
+        items = [item for item in await asyncio.gather(*(fetch(i) for i in identifiers)) if item is not None]
+        await self.record_many(items)
+        print(f"IAItemIndex.fill_files: {len(items)}/{len(identifiers)} items")
+        return len(items)
+
+
+if __name__ == "__main__":
+    from mongomock_motor import AsyncMongoMockClient
+
+    from ChinaXivXiv.bench.fake_ia import FakeIA
+
+    async def test_ia_item_index():
+        fake_ia = FakeIA().start()
+        try:
+            for n in range(25):
+                fake_ia.add_item(f"ChinaXiv-202001.{n:05d}V1", files=[
+                    {"name": f"202001.{n:05d}v1.pdf", "md5": f"{n:032x}", "source": "original"},
+                    {"name": f"ChinaXiv-202001.{n:05d}V1_meta.xml", "md5": "0" * 32, "source": "metadata"},
+                ], chinaxiv=f"202001.{n:05d}", chinaxiv_id=str(30000 + n))
+            fake_ia.add_item("something-else")
+            index = await IAItemIndex(AsyncMongoMockClient()["chinaxiv"]["ia_items"]).ensure_indexes()
+            async with httpx.AsyncClient() as client:
+                assert await index.fill(client, scrape_url=f"{fake_ia.base_url}/services/search/v1/scrape", page_size=10) == 25
+                assert fake_ia.requests["/services/search/v1/scrape"] == 3 # 10 + 10 + 5
+                assert await index.fill_files(client, metadata_url=f"{fake_ia.base_url}/metadata", limit=5) == 5
+                assert await index.fill_files(client, metadata_url=f"{fake_ia.base_url}/metadata") == 20
+            item = await index.find_by_chinaxiv_id("localIdentifier:chinaxiv_30003")
+            assert item is not None and item["_id"] == "ChinaXiv-202001.00003V1", item
+            assert item["files"] == [{"name": "202001.00003v1.pdf", "md5": f"{3:032x}"}], item["files"]
+            assert archived_pdf(item) == item["files"][0] and archived_pdf(item, md5=f"{3:032x}") is not None
+            assert archived_pdf(item, md5="0" * 32) is None
+            assert archived_pdf({"_id": "ChinaXiv-202001.00003V1"}) is None # 还没有文件列表
+            assert archived_pdf({"_id": "ChinaXiv-202001.00003V2", "files": item["files"]}) is None # 别的版本的 PDF
+            assert await index.find_by_chinaxiv_id("chinaxiv_40000") is None
+            await index.record("ChinaXiv-202002.00001V2", chinaxiv="202002.00001", chinaxiv_id=40000,
+                               files=[{"name": "202002.00001v2.pdf", "md5": "f" * 32}])
+            assert (await index.find_by_identifier(ia_identifier_of("202002.00001", 2)))["chinaxiv_id"] == 40000
+            assert (index.hits, index.misses) == (2, 1)
+        finally:
+            fake_ia.stop()
+        print("ok")
+
+    asyncio.run(test_ia_item_index())
@@ -0,0 +1,289 @@
+import concurrent.futures
+import hashlib
+import json
+import mmap
+import os
+import random
+import threading
+import time
+import xml.etree.ElementTree as ET
+from typing import IO, Dict, List, Optional, Tuple, Union
+from urllib.parse import quote
+
+import requests
+from internetarchive.auth import S3Auth
+from internetarchive.iarequest import S3Request
+from internetarchive.session import ArchiveSession
+
+from ChinaXivXiv.defines import IA_MULTIPART_PARALLELISM, IA_MULTIPART_PART_SIZE
+from ChinaXivXiv.exceptions import ChecksumMismatch
+from ChinaXivXiv.metrics import IA_MULTIPART_PARTS
+
+""" IA S3 的 multipart 上传: 大 PDF 分块并发 PUT，哪块失败只重传哪块。
+每块带 Content-MD5 并核对返回的 ETag，complete 之后再核对整个对象的 multipart ETag (各块 MD5 拼起来再 MD5，加 -块数)。
+给了 state_path 就把 uploadId 记在那里，进程重启后用 ListParts 查出已经传上去的块，接着传剩下的 """
+
+RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+PART_TIMEOUT = 300
+
+
+class _RetryablePartError(Exception):
+    pass
+
+
+def s3_url(ia: ArchiveSession, identifier: str, key: str) -> str:
+    return f"{ia.protocol}//s3.us.archive.org/{identifier}/{quote(key)}"
+
+
+def plan_parts(size: int, part_size: int) -> List[Tuple[int, int, int]]:
+    """ -> [(part number 从 1 开始, offset, length)] """
+    assert size > 0 and part_size > 0
+    return [(number, offset, min(part_size, size - offset))
+            for number, offset in enumerate(range(0, size, part_size), start=1)]
+
+
+def multipart_etag(part_md5s: List[str]) -> str:
+    return hashlib.md5(b"".join(bytes.fromhex(md5) for md5 in part_md5s)).hexdigest() + f"-{len(part_md5s)}"
+
+
+def _xml_children(root: ET.Element, tag: str) -> List[ET.Element]:
+    """ 忽略 S3 的 xmlns """
+    return [element for element in root.iter() if element.tag.rsplit("}", 1)[-1] == tag]
+
+
+def _xml_text(root: ET.Element, tag: str) -> Optional[str]:
+    elements = _xml_children(root, tag)
+    return elements[0].text if elements else None
+
+
+def _read_part(file: Union[IO[bytes], mmap.mmap], offset: int, length: int, lock: threading.Lock) -> bytes:
+    if isinstance(file, mmap.mmap):
+        return file[offset:offset + length] # 不动文件位置，不用锁
+    with lock:
+        file.seek(offset)
+        return file.read(length)
+
+
+def _load_state(state_path: Optional[str]) -> Optional[Dict]:
+    if state_path is None:
+        return None
+    try:
+        with open(state_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _save_state(state_path: Optional[str], state: Dict):
+    if state_path is None:
+        return
+    tmp_path = f"{state_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+
+def _remove_state(state_path: Optional[str]):
+    if state_path is not None:
+        try:
+            os.remove(state_path)
+        except FileNotFoundError:
+            pass
+
+
+def initiate(ia: ArchiveSession, url: str, metadata: Optional[Dict], size: int, queue_derive: bool = True) -> str:
+    """ item 元数据跟在 initiate 上，和单个 PUT 一样会自动建 item。-> uploadId """
+    request = S3Request(method="POST", url=url, params={"uploads": ""}, metadata=metadata or {},
+                        headers={"x-archive-size-hint": str(size)}, queue_derive=queue_derive,
+                        access_key=ia.access_key, secret_key=ia.secret_key)
+    r = ia.send(request.prepare(), timeout=PART_TIMEOUT)
+    r.raise_for_status()
+    upload_id = _xml_text(ET.fromstring(r.content), "UploadId")
+    assert upload_id, r.text
+    return upload_id
+
+
+def list_parts(ia: ArchiveSession, url: str, upload_id: str) -> Optional[Dict[int, str]]:
+    """ -> {part number: ETag}，uploadId 已失效 (完成/放弃/过期) 返回 None """
+    auth = S3Auth(ia.access_key, ia.secret_key)
+    parts: Dict[int, str] = {}
+    marker = "0"
+    while True:
+        r = ia.get(url, params={"uploadId": upload_id, "part-number-marker": marker}, auth=auth, timeout=PART_TIMEOUT)
+        if r.status_code == 404:
+            return None
+        r.raise_for_status()
+        root = ET.fromstring(r.content)
+        for part in _xml_children(root, "Part"):
+            parts[int(_xml_text(part, "PartNumber") or 0)] = (_xml_text(part, "ETag") or "").strip('"')
+        if _xml_text(root, "IsTruncated") != "true":
+            return parts
+        marker = _xml_text(root, "NextPartNumberMarker") or str(max(parts, default=0))
+
+
+def abort(ia: ArchiveSession, url: str, upload_id: str):
+    try:
+        ia.delete(url, params={"uploadId": upload_id}, auth=S3Auth(ia.access_key, ia.secret_key), timeout=PART_TIMEOUT)
+    except requests.RequestException as e:
+        print(f"abort multipart upload {upload_id} failed: {e!r}")
+
+
+def upload_part(ia: ArchiveSession, url: str, upload_id: str, number: int, data: bytes, retries: int = 5) -> str:
+    """ 失败只重试这一块。-> 这块的 MD5 """
+    md5 = hashlib.md5(data).hexdigest()
+    auth = S3Auth(ia.access_key, ia.secret_key)
+    for attempt in range(retries):
+        try:
+            r = ia.put(url, params={"partNumber": str(number), "uploadId": upload_id}, data=data,
+                       headers={"Content-MD5": md5}, auth=auth, timeout=PART_TIMEOUT)
+            if r.status_code in RETRYABLE_STATUS_CODES:
+                raise _RetryablePartError(f"part {number}: status_code {r.status_code}")
+            r.raise_for_status()
+            etag = r.headers.get("ETag", "").strip('"')
+            if etag and etag != md5:
+                raise ChecksumMismatch(f"part {number}: ETag {etag} != MD5 {md5}")
+            IA_MULTIPART_PARTS.inc(result="uploaded")
+            return md5
+        except (requests.ConnectionError, requests.Timeout, _RetryablePartError, ChecksumMismatch) as e:
+            if attempt + 1 >= retries:
+                raise
+            IA_MULTIPART_PARTS.inc(result="retried")
+            delay = min(30.0, 2.0 ** attempt) * random.uniform(0.5, 1.0)
+            print(f"multipart {upload_id}: {e!r}, retrying part {number} in {delay:.1f}s")
+            time.sleep(delay)
+    raise AssertionError("unreachable")
+
+
+def complete(ia: ArchiveSession, url: str, upload_id: str, part_md5s: List[str]) -> requests.Response:
+    body = "<CompleteMultipartUpload>" + "".join(
+        f"<Part><PartNumber>{number}</PartNumber><ETag>\"{md5}\"</ETag></Part>"
+        for number, md5 in enumerate(part_md5s, start=1)
+    ) + "</CompleteMultipartUpload>"
+    r = ia.post(url, params={"uploadId": upload_id}, data=body.encode("utf-8"),
+                auth=S3Auth(ia.access_key, ia.secret_key), timeout=PART_TIMEOUT)
+    r.raise_for_status()
+    # S3 有可能 200 里包着 <Error>
+    root = ET.fromstring(r.content)
+    if root.tag.rsplit("}", 1)[-1] == "Error":
+        raise requests.HTTPError(f"complete multipart upload {upload_id}: {r.text}", response=r)
+    etag = (_xml_text(root, "ETag") or r.headers.get("ETag", "")).strip('"')
+    expected = multipart_etag(part_md5s)
+    if etag and etag != expected:
+        raise ChecksumMismatch(f"multipart ETag {etag} != {expected}")
+    return r
+
+
+def multipart_upload(ia: ArchiveSession, identifier: str, key: str, file: Union[IO[bytes], mmap.mmap], size: int,
+                     md5: str, metadata: Optional[Dict] = None, part_size: int = IA_MULTIPART_PART_SIZE,
+                     parallelism: int = IA_MULTIPART_PARALLELISM, part_retries: int = 5,
+                     state_path: Optional[str] = None, queue_derive: bool = True) -> requests.Response:
+    """ 在 IAClient 的上传线程里调用，各块再用 parallelism 个线程共用这个 session 并发上传。
+    md5: 整个文件的 MD5，用来确认断点记录对应的是同一个文件。
+    state_path: 断点记录。没有的话失败时 abort，放弃已上传的块 """
+    url = s3_url(ia, identifier, key)
+    done: Dict[int, str] = {}
+    state = _load_state(state_path)
+    upload_id = None
+    if state is not None and state.get("url") == url and state.get("md5") == md5 and state.get("part_size") == part_size:
+        parts = list_parts(ia, url, state["upload_id"])
+        if parts is not None:
+            upload_id, done = state["upload_id"], parts
+            print(f"multipart {identifier}/{key}: resuming {upload_id}, {len(done)} parts already uploaded")
+    if upload_id is None:
+        upload_id = initiate(ia, url, metadata, size, queue_derive=queue_derive)
+        _save_state(state_path, {"upload_id": upload_id, "url": url, "md5": md5, "part_size": part_size})
+
+    lock = threading.Lock()
+
+    def send(number: int, offset: int, length: int) -> str:
+        data = _read_part(file, offset, length, lock)
+        part_md5 = hashlib.md5(data).hexdigest()
+        if done.get(number) == part_md5:
+            IA_MULTIPART_PARTS.inc(result="resumed")
+            return part_md5
+        return upload_part(ia, url, upload_id, number, data, retries=part_retries)
+
+    parts = plan_parts(size, part_size)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix="ia-part") as pool:
+        futures = [pool.submit(send, *part) for part in parts]
+        concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+        for future in futures:
+            future.cancel() # 有一块彻底失败了，还没开始的不用传了
+        try:
+            part_md5s = [future.result() for future in futures]
+        except BaseException:
+            if state_path is None:
+                abort(ia, url, upload_id)
+            raise
+    try:
+        r = complete(ia, url, upload_id, part_md5s)
+    except ChecksumMismatch:
+        abort(ia, url, upload_id)
+        _remove_state(state_path)
+        raise
+    _remove_state(state_path)
+    print(f"multipart {identifier}/{key}: {len(parts)} parts, {size} bytes, ETag {multipart_etag(part_md5s)}")
+    return r
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    from ChinaXivXiv.bench.fake_ia import FakeIA
+    from ChinaXivXiv.ia_client import IAClient
+    from ChinaXivXiv.metrics import IA_MULTIPART_PARTS
+
+    def test_multipart_upload():
+        assert plan_parts(10, 4) == [(1, 0, 4), (2, 4, 4), (3, 8, 2)]
+        assert multipart_etag([hashlib.md5(b"a").hexdigest()]) == hashlib.md5(hashlib.md5(b"a").digest()).hexdigest() + "-1"
+
+        fake = FakeIA().start()
+        ia_client = IAClient(max_workers=1, keys=("test", "test"), base_url=fake.base_url)
+        data = os.urandom(1024 * 1024 + 123)
+        md5 = hashlib.md5(data).hexdigest()
+        try:
+            with ia_client.session() as ia, tempfile.TemporaryDirectory() as directory:
+                state_path = os.path.join(directory, "multipart.json")
+                with open(os.path.join(directory, "a.pdf"), "wb") as f:
+                    f.write(data)
+                with open(os.path.join(directory, "a.pdf"), "rb") as f:
+                    pdf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+                # 一半的块失败且不重试: 中断，断点记录留着
+                fake.error_rate = 0.5
+                try:
+                    multipart_upload(ia, "test-item", "a.pdf", pdf, len(data), md5, metadata={"title": "t"},
+                                     part_size=64 * 1024, parallelism=4, part_retries=1, state_path=state_path)
+                except _RetryablePartError:
+                    pass
+                else:
+                    raise AssertionError("expected some parts to fail")
+                assert os.path.exists(state_path) and not fake.files.get("test-item")
+                uploaded = len(next(iter(fake.uploads.values()))["parts"])
+
+                # 接着传: 只补上缺的块
+                fake.error_rate = 0.0
+                fake.requests.clear()
+                multipart_upload(ia, "test-item", "a.pdf", pdf, len(data), md5, metadata={"title": "t"},
+                                 part_size=64 * 1024, parallelism=4, state_path=state_path)
+                assert fake.requests.get("s3_initiate", 0) == 0
+                assert fake.requests["s3_part"] == len(plan_parts(len(data), 64 * 1024)) - uploaded, (fake.requests, uploaded)
+                assert fake.files["test-item"] == [{"name": "a.pdf", "md5": md5, "size": str(len(data)), "source": "original"}]
+                assert fake.items["test-item"]["title"] == "t" and not os.path.exists(state_path) and not fake.uploads
+
+                # 不可恢复的失败 (没有 state_path) 放弃整个 upload
+                fake.error_rate = 1.0
+                try:
+                    multipart_upload(ia, "test-item-2", "a.pdf", io.BytesIO(data), len(data), md5,
+                                     part_size=256 * 1024, parallelism=2, part_retries=1)
+                except _RetryablePartError:
+                    pass
+                assert not fake.uploads and fake.requests["s3_abort"] == 1
+                pdf.close()
+        finally:
+            ia_client.shutdown()
+            fake.stop()
+        print("ok", {values[0]: value for values, value in IA_MULTIPART_PARTS.items()})
+
+    import io
+    test_multipart_upload()
@@ -0,0 +1,108 @@
+import asyncio
+import os
+from typing import Dict, List, Optional, Tuple
+
+import motor.motor_asyncio
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+GLOBAL_CHINAXIV_INDEXES = [
+    # claim_task / claim_tasks: {"status": ..., "next_attempt_at": {"$not": {"$gt": now}}} sort _id desc，
+    # next_attempt_at 放在最后，退避中的任务在索引里就被过滤掉，不用回表
+    IndexModel([("status", ASCENDING), ("_id", DESCENDING), ("next_attempt_at", ASCENDING)],
+               name="status_id_next_attempt_at"),
+    # 分片运行时: 再加 "bucket": {"$in": [...]}
+    IndexModel([("status", ASCENDING), ("bucket", ASCENDING), ("_id", DESCENDING), ("next_attempt_at", ASCENDING)],
+               name="status_bucket_id_next_attempt_at"),
+    # runner=spool: 上传 worker 只领 {"status": UPLOADTOIA_SPOOLED, "spool.id": 本机 spool}，reconcile_spool 同理
+    IndexModel([("status", ASCENDING), ("spool.id", ASCENDING), ("_id", DESCENDING), ("next_attempt_at", ASCENDING)],
+               name="status_spool_id_id_next_attempt_at"),
+    # reap_expired_leases: {"status": ..., "lease_until": {"$lt": now}}
+    IndexModel([("status", ASCENDING), ("lease_until", ASCENDING)], name="status_lease_until"),
+    # requeue_stale_spooled: {"status": UPLOADTOIA_SPOOLED, "spool.spooled_at": {"$lt": ...}}
+    IndexModel([("status", ASCENDING), ("spool.spooled_at", ASCENDING)], name="status_spool_spooled_at"),
+    # IA_verify_worker: {"status": VERIFYING} sort verify_checked_at
+    IndexModel([("status", ASCENDING), ("verify_checked_at", ASCENDING)], name="status_verify_checked_at"),
+    # claim_tasks 按 lease_token 取回
+    IndexModel([("lease_token", ASCENDING)], name="lease_token", sparse=True),
+    # count_versions
+    IndexModel([("metadata.article-id", ASCENDING)], name="metadata_article_id"),
+    # OAI 收割去重 / upsert。用默认名 identifier_1，线上库可能已经手动建过
+    IndexModel([("identifier", ASCENDING)], unique=True),
+    # find_max_datestamp: 增量收割的起点
+    IndexModel([("datestamp", DESCENDING)], name="datestamp"),
+]
+""" global_chinaxiv 上 worker 查询用到的全部索引 """
+
+IA_ITEMS_INDEXES = [
+    # IAItemIndex.find_by_chinaxiv_id: 领取任务后、请求任何上游之前的预检
+    IndexModel([("chinaxiv_id", ASCENDING)], name="chinaxiv_id"),
+]
+""" ia_items (本地 IA item 索引) 上的索引，_id 就是 IA identifier """
+
+
+async def ensure_indexes(collection: motor.motor_asyncio.AsyncIOMotorCollection,
+                         indexes: List[IndexModel] = GLOBAL_CHINAXIV_INDEXES):
+    """ 启动时调用，已存在的同名索引 create_indexes 不会重建。
+    逐个创建，建不了的 (已有数据违反 unique、同键/同名索引选项不同) 只打日志，不影响启动 """
+    names = []
+    for index in indexes:
+        try:
+            names += await collection.create_indexes([index])
+        except DuplicateKeyError as e:
+            print(f"index {index.document['name']} on {collection.name} not created, "
+                  f"existing documents have duplicate keys, dedupe them first: {e!r}")
+        except OperationFailure as e: # IndexOptionsConflict / IndexKeySpecsConflict 等
+            print(f"index {index.document['name']} on {collection.name} not created: {e!r}")
+    print(f"ensured indexes on {collection.name}: {names}")
+
+
+class ArticleVersions:
+    """ article-id -> 版本数，一次聚合建好，之后按 _id 增量刷新，查询 O(1)。
+    key 与 count_documents({"metadata.article-id": article_id}) 一致，是整个 article-id 数组 """
+    def __init__(self, collection: motor.motor_asyncio.AsyncIOMotorCollection):
+        self.collection = collection
+        self.versions: Dict[Tuple[str, ...], int] = {}
+        self.max_id: Optional[ObjectId] = None
+        self._lock = asyncio.Lock()
+
+    async def build(self) -> "ArticleVersions":
+        versions = {}
+        max_id = None
+        async for group in self.collection.aggregate([
+            {"$match": {"metadata.article-id": {"$exists": True}}},
+            {"$group": {"_id": "$metadata.article-id", "versions": {"$sum": 1}, "max_id": {"$max": "$_id"}}},
+        ], allowDiskUse=True):
+            versions[tuple(group["_id"])] = group["versions"]
+            if max_id is None or group["max_id"] > max_id:
+                max_id = group["max_id"]
+        async with self._lock:
+            self.versions, self.max_id = versions, max_id
+        print(f"ArticleVersions: {len(versions)} articles")
+        return self
+
+    async def refresh(self):
+        """ 只扫 _id 比上次大的新文档 """
+        async with self._lock:
+            query = {"metadata.article-id": {"$exists": True}}
+            if self.max_id is not None:
+                query["_id"] = {"$gt": self.max_id}
+            async for doc in self.collection.find(query, projection={"metadata.article-id": 1}, sort=[("_id", 1)]):
+                key = tuple(doc["metadata"]["article-id"])
+                self.versions[key] = self.versions.get(key, 0) + 1
+                self.max_id = doc["_id"]
+
+    async def count(self, article_id: List[str]) -> int:
+        key = tuple(article_id)
+        if key not in self.versions: # 可能是刚收割进来的
+            await self.refresh()
+        return self.versions.get(key, 0)
+
+    async def refresh_worker(self, interval: float = 600):
+        while not os.path.exists("stop"):
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh()
+            except Exception as e: # refresh 是增量的，下一轮从 max_id 接着扫
+                print(f"ArticleVersions.refresh_worker: {e!r}")
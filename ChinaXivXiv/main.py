@@ -1,28 +1,251 @@
+import argparse
 import asyncio
+import multiprocessing
 import os
-import motor.motor_asyncio
+import signal
+import sys
+from typing import List, Optional, Tuple
+
 import httpx
+import motor.motor_asyncio
 
-from ChinaXivXiv.defines import DEFAULT_HEADERS
+from ChinaXivXiv.browse_db import BrowseDbCoalescer
+from ChinaXivXiv.concurrency import AIMDLimiter, parse_limits
+from ChinaXivXiv.defines import (HTTP_CACHE_DIR, HTTP_CACHE_MAX_BYTES, IA_CONCURRENCY, METRICS_JSONL,
+                                 METRICS_JSONL_INTERVAL, METRICS_PORT, ORIGIN_CONCURRENCY, PARSE_WORKERS, PROCESSES,
+                                 RATE_COORDINATION, RUNNER, SHARD, SPOOL_DIR, SPOOL_MAX_BYTES, UPLOAD_WORKERS)
+from ChinaXivXiv.http_cache import DiskCache
+from ChinaXivXiv.http_client import build_client
+from ChinaXivXiv.ia_client import IAClient
+from ChinaXivXiv.ia_index import IAItemIndex
+from ChinaXivXiv.indexes import ArticleVersions, ensure_indexes
+from ChinaXivXiv.metrics import IN_FLIGHT, QUEUE_DEPTH, REGISTRY, jsonl_sink_worker, serve_metrics
+from ChinaXivXiv.mongo_ops import (SHARD_BUCKETS, LeaseKeeper, backfill_buckets, lease_reaper_worker,
+                                   migrate_legacy_statuses, shard_buckets)
+from ChinaXivXiv.parse_executor import ParseExecutor
+from ChinaXivXiv.ratelimit import MongoRateCoordinator
+from ChinaXivXiv.spool import PdfSpool
+from ChinaXivXiv.workers.IA_pipeline import run_IA_upload_pipeline
+from ChinaXivXiv.workers.IA_spool import IA_prefetch_worker, IA_spool_upload_worker, merge_spool, reconcile_spool
 from ChinaXivXiv.workers.IA_uploader import IA_upload_worker
+from ChinaXivXiv.workers.IA_verifier import IA_verify_worker
+
+
+def parse_shard(spec: str) -> Tuple[int, int]:
+    """ "I/K" -> (I, K) """
+    try:
+        index, count = (int(x) for x in spec.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected I/K, got {spec!r}")
+    if not (0 <= index < count):
+        raise argparse.ArgumentTypeError(f"shard index must be in 0..{count - 1}, got {spec!r}")
+    return index, count
+
+
+def parse_limit_spec(spec: str) -> str:
+    try:
+        parse_limits(spec)
+    except (ValueError, AssertionError) as e:
+        raise argparse.ArgumentTypeError(f"expected MIN:INIT:MAX with 1 <= MIN <= INIT <= MAX, got {spec!r}") from e
+    return spec
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m ChinaXivXiv.main",
+                                     description="把 global_chinaxiv 里的任务上传到 IA。默认值都可以用环境变量覆盖")
+    parser.add_argument("--processes", type=int, default=PROCESSES,
+                        help="进程数，每个进程领一个分片 (CHINAXIVXIV_PROCESSES, default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=UPLOAD_WORKERS,
+                        help="runner=workers 时每个进程的协程数上限；runner=spool 时下载、上传各这么多 "
+                             "(CHINAXIVXIV_UPLOAD_WORKERS, default: %(default)s)")
+    parser.add_argument("--origin-concurrency", type=parse_limit_spec, default=ORIGIN_CONCURRENCY, metavar="MIN:INIT:MAX",
+                        help="每个进程同时在途的 chinaxiv 请求数，AIMD 调整 (CHINAXIVXIV_ORIGIN_CONCURRENCY, default: %(default)s)")
+    parser.add_argument("--ia-concurrency", type=parse_limit_spec, default=IA_CONCURRENCY, metavar="MIN:INIT:MAX",
+                        help="每个进程同时进行的 IA 上传数，AIMD 调整 (CHINAXIVXIV_IA_CONCURRENCY, default: %(default)s)")
+    parser.add_argument("--runner", choices=("workers", "pipeline", "spool"), default=RUNNER,
+                        help="(CHINAXIVXIV_RUNNER, default: %(default)s)")
+    parser.add_argument("--shard", type=parse_shard, default=parse_shard(SHARD), metavar="I/K",
+                        help="多台机器分队列时本机是第 I 台，共 K 台，各台 --processes 要一致 (CHINAXIVXIV_SHARD, default: 0/1)")
+    parser.add_argument("--mongodb-uri", default=os.getenv("MONGODB_URI"), help="(MONGODB_URI)")
+    args = parser.parse_args(argv)
+    if args.processes < 1 or args.workers < 1:
+        parser.error("--processes and --workers must be >= 1")
+    if args.shard[1] * args.processes > SHARD_BUCKETS:
+        parser.error(f"machines x processes must be <= {SHARD_BUCKETS}")
+    return args
+
+
+async def prepare(args: argparse.Namespace):
+    """ 所有进程启动前在父进程里做一次: 建索引、给老任务补 bucket、迁移老的 status、填充 IA item 索引 (首次用 scrape，之后每次补缺的文件列表) """
+    m_client = motor.motor_asyncio.AsyncIOMotorClient(args.mongodb_uri)
+    db = m_client["chinaxiv"]
+    global_chinaxiv_collection = db["global_chinaxiv"]
+    await ensure_indexes(global_chinaxiv_collection)
+    await backfill_buckets(global_chinaxiv_collection)
+    await migrate_legacy_statuses(global_chinaxiv_collection)
+    ia_index = await IAItemIndex(db["ia_items"]).ensure_indexes()
+    async with build_client() as h_client:
+        try:
+            if await ia_index.collection.estimated_document_count() == 0:
+                await ia_index.fill(h_client)
+            # scrape 不带文件列表，没有文件列表的 item 不算已归档；每次启动补上还缺的
+            await ia_index.fill_files(h_client)
+        except httpx.HTTPError as e:
+            print(f"IAItemIndex.fill failed, starting without the archived pre-check data: {e!r}")
+
 
+def orphan_spool_dirs(spool_dir: str, processes: int, process_index: int) -> List[str]:
+    """ spool_dir 下序号 >= processes 的子目录 (上次 --processes 更大时留下的) 没有进程会打开，
+    按 序号 % processes 分给现有的进程，每个子目录只归一个进程 """
+    try:
+        names = os.listdir(spool_dir)
+    except FileNotFoundError:
+        return []
+    return sorted(os.path.join(spool_dir, name) for name in names
+                  if name.isdigit() and int(name) >= processes and int(name) % processes == process_index
+                  and os.path.isdir(os.path.join(spool_dir, name)))
 
-async def main():
-    transport = httpx.AsyncHTTPTransport(retries=3)
-    h_client = httpx.AsyncClient(timeout=60, transport=transport)
-    h_client.headers.update(DEFAULT_HEADERS)
-    m_client = motor.motor_asyncio.AsyncIOMotorClient(os.getenv("MONGODB_URI"))
+
+async def serve(args: argparse.Namespace, buckets: Optional[List[int]], process_index: int = 0):
+    # SIGINT/SIGTERM: 取消主任务，走下面的 finally 清理；手上任务的租约过期后由 reaper 放回
+    main_task = asyncio.current_task()
+    assert main_task is not None
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(sig, main_task.cancel)
+
+    m_client = motor.motor_asyncio.AsyncIOMotorClient(args.mongodb_uri)
 
     db = m_client["chinaxiv"]
+    cache = DiskCache(HTTP_CACHE_DIR, max_bytes=HTTP_CACHE_MAX_BYTES) if HTTP_CACHE_DIR else None
+    # 并发跟着上游的实际承受能力走，worker 数只是上限
+    origin_limiter = AIMDLimiter.from_spec("chinaxiv", args.origin_concurrency)
+    ia_limiter = AIMDLimiter.from_spec("ia", args.ia_concurrency, latency_tolerance=None)
+    h_client = build_client(rate_coordinator=MongoRateCoordinator(db["rate_limits"]) if RATE_COORDINATION == "mongo" else None,
+                            cache=cache, origin_limiter=origin_limiter)
     global_chinaxiv_collection = db["global_chinaxiv"]
+    article_versions = await ArticleVersions(global_chinaxiv_collection).build()
+    # 多进程时每个进程的解析进程池分一份 CPU
+    parse_executor = ParseExecutor(max_workers=max(1, PARSE_WORKERS // args.processes))
+    lease_keeper = LeaseKeeper(global_chinaxiv_collection).start()
+    browse_db = BrowseDbCoalescer(h_client, cache=cache)
+    ia_client = IAClient(limiter=ia_limiter)
+    ia_index = IAItemIndex(db["ia_items"])
+
+    def collect_metrics():
+        QUEUE_DEPTH.set(ia_client.queued, queue="ia_upload")
+        IN_FLIGHT.set(ia_client.in_flight, queue="ia_upload")
+        QUEUE_DEPTH.set(len(browse_db.pending), queue="browse_db")
+        IN_FLIGHT.set(len(lease_keeper.held), queue="leased_tasks")
+    REGISTRY.add_collector(collect_metrics)
+    metrics_server = await serve_metrics(METRICS_PORT + process_index) if METRICS_PORT else None
+
+    if args.runner == "pipeline":
+        cors = [run_IA_upload_pipeline(h_client, global_chinaxiv_collection, parse_executor=parse_executor,
+                                       lease_keeper=lease_keeper, article_versions=article_versions,
+                                       browse_db=browse_db, ia_client=ia_client, ia_index=ia_index,
+                                       buckets=buckets)]
+    elif args.runner == "spool":
+        # 每个进程一个 spool 子目录，重启时按进程序号接回自己的；--processes 调小后没人用的子目录并进来
+        spool = PdfSpool(os.path.join(SPOOL_DIR, str(process_index)), max_bytes=SPOOL_MAX_BYTES)
+        for directory in orphan_spool_dirs(SPOOL_DIR, args.processes, process_index):
+            await merge_spool(global_chinaxiv_collection, spool, PdfSpool(directory))
+        await reconcile_spool(global_chinaxiv_collection, spool)
+        REGISTRY.add_collector(lambda: QUEUE_DEPTH.set(len(spool), queue="spool"))
+        cors = [
+            IA_prefetch_worker(
+                client=h_client,
+                collection=global_chinaxiv_collection,
+                spool=spool,
+                parse_executor=parse_executor,
+                lease_keeper=lease_keeper,
+                article_versions=article_versions,
+                browse_db=browse_db,
+                ia_index=ia_index,
+                buckets=buckets,
+            ) for _ in range(args.workers)]
+        cors += [IA_spool_upload_worker(collection=global_chinaxiv_collection, spool=spool, ia_client=ia_client,
+                                        lease_keeper=lease_keeper) for _ in range(args.workers)]
+        cors.append(IA_verify_worker(client=h_client, collection=global_chinaxiv_collection, ia_index=ia_index,
+                                     buckets=buckets))
+    else:
+        cors = [
+            IA_upload_worker(
+                client=h_client,
+                collection=global_chinaxiv_collection,
+                parse_executor=parse_executor,
+                lease_keeper=lease_keeper,
+                article_versions=article_versions,
+                browse_db=browse_db,
+                ia_client=ia_client,
+                ia_index=ia_index,
+                buckets=buckets,
+            ) for _ in range(args.workers)]
+        cors.append(IA_verify_worker(client=h_client, collection=global_chinaxiv_collection, ia_index=ia_index,
+                                     buckets=buckets))
+    cors.append(lease_reaper_worker(global_chinaxiv_collection, buckets=buckets))
+    cors.append(article_versions.refresh_worker())
+    if METRICS_JSONL:
+        cors.append(jsonl_sink_worker(METRICS_JSONL, METRICS_JSONL_INTERVAL))
+    try:
+        await asyncio.gather(*cors)
+    finally:
+        lease_keeper.stop()
+        parse_executor.shutdown()
+        ia_client.shutdown()
+        await h_client.aclose()
+        if metrics_server is not None:
+            metrics_server.close()
+
+
+def run_shard(args: argparse.Namespace, shard_index: int, shard_count: int) -> int:
+    buckets = shard_buckets(shard_index, shard_count)
+    print(f"[pid {os.getpid()}] shard {shard_index}/{shard_count}, buckets: {buckets if buckets is not None else 'all'}")
+    try:
+        asyncio.run(serve(args, buckets, process_index=shard_index % args.processes))
+    except asyncio.CancelledError:
+        print(f"[pid {os.getpid()}] stopped by signal")
+    return 0
+
+
+def _shard_process(args: argparse.Namespace, shard_index: int, shard_count: int):
+    sys.exit(run_shard(args, shard_index, shard_count))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    asyncio.run(prepare(args))
+
+    machine_index, machines = args.shard
+    shard_count = machines * args.processes
+    if args.processes == 1:
+        return run_shard(args, machine_index, shard_count)
+
+    # spawn: 子进程不继承父进程里 motor 的线程和 socket
+    ctx = multiprocessing.get_context("spawn")
+    procs = [
+        ctx.Process(target=_shard_process, name=f"ChinaXivXiv-{p}",
+                    args=(args, machine_index * args.processes + p, shard_count))
+        for p in range(args.processes)
+    ]
+    for proc in procs:
+        proc.start()
+
+    def stop_all(signum, frame):
+        print(f"got signal {signum}, stopping {len(procs)} processes...")
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+
+    signal.signal(signal.SIGINT, stop_all)
+    signal.signal(signal.SIGTERM, stop_all)
 
-    cors = [
-        IA_upload_worker(
-            client=h_client,
-            collection=global_chinaxiv_collection,
-        ) for _ in range(5)]
-    await asyncio.gather(*cors)
+    for proc in procs:
+        proc.join()
+    failed = [(proc.name, proc.exitcode) for proc in procs if proc.exitcode != 0]
+    for name, exitcode in failed:
+        print(f"{name} exited with {exitcode}")
+    return 1 if failed else 0
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    sys.exit(main())
@@ -0,0 +1,163 @@
+import argparse
+import asyncio
+import datetime
+import functools
+import itertools
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from dataclasses import asdict
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import motor.motor_asyncio
+from pymongo import UpdateOne
+
+from ChinaXivXiv.defines import HTTP_CACHE_DIR, PARSE_WORKERS
+from ChinaXivXiv.http_cache import DiskCache
+from ChinaXivXiv.workers.metadata_scraper import AbsPage
+
+""" 用本地保存的 abstract 页面 (HTTP 缓存目录或 WARC) 重新解析 ChinaXivHtmlMetadata，bulk upsert 进 Mongo。
+解析器修好以后用它回填已经处理过的论文，不用重新爬。
+
+python -m ChinaXivXiv.metadata_backfill [--cache-dir DIR] [--warc a.warc.gz ...] [--processes N] [--dry-run] """
+
+HTML_METADATA_COLLECTION = "chinaxiv_html_metadata"
+""" _id = chinaxiv_id """
+
+
+def is_abs_page(url: str) -> bool:
+    return urlsplit(url).path.startswith("/abs/")
+
+
+def iter_cache_pages(cache_dir: str) -> Iterator[Tuple[str, bytes]]:
+    """ -> (url, html)，只读 abstract 页面的 body """
+    cache = DiskCache(cache_dir)
+    for meta, body in cache.iter_entries(lambda meta: meta.get("method") == "GET" and meta.get("status_code") == 200
+                                         and is_abs_page(meta.get("url", ""))):
+        yield meta["url"], body
+
+
+def iter_warc_pages(paths: Iterable[str]) -> Iterator[Tuple[str, bytes]]:
+    """ -> (url, html)，WARC 里 200 的 abstract 页面 response 记录 """
+    try:
+        from warcio.archiveiterator import ArchiveIterator
+    except ImportError as e:
+        raise ImportError("reading WARC files needs warcio: pip install warcio") from e
+    for path in paths:
+        with open(path, "rb") as f:
+            for record in ArchiveIterator(f):
+                if record.rec_type != "response" or record.http_headers is None:
+                    continue
+                if record.http_headers.get_statuscode() != "200":
+                    continue
+                url = record.rec_headers.get_header("WARC-Target-URI")
+                if url and is_abs_page(url):
+                    yield url, record.content_stream().read() # 已去掉 chunked / gzip
+
+
+def parse_page(page: Tuple[str, bytes], backend: Optional[str] = None) -> Tuple[str, Optional[Dict], Optional[str]]:
+    """ 在子进程里跑。-> (url, asdict(metadata), None) 或 (url, None, 错误) """
+    url, html = page
+    try:
+        metadata = AbsPage(html, url, backend=backend, with_core_html=False).metadata()
+    except Exception as e:
+        return url, None, repr(e)
+    return url, asdict(metadata), None
+
+
+def _bounded(pages: Iterable, semaphore: threading.Semaphore, stop: threading.Event) -> Iterator:
+    """ Pool.imap 会把输入一口气读完塞进任务队列；每取一页先拿信号量，结果被消费后再释放 """
+    for page in pages:
+        while not semaphore.acquire(timeout=1):
+            if stop.is_set(): # 主流程出错退出了，别让 Pool 的任务线程卡在这里
+                return
+        yield page
+
+
+async def backfill(pages: Iterable[Tuple[str, bytes]], collection: Optional[motor.motor_asyncio.AsyncIOMotorCollection],
+                   processes: int = PARSE_WORKERS, batch_size: int = 500, backend: Optional[str] = None,
+                   chunksize: int = 8) -> Dict[str, int]:
+    """ collection=None: 只解析不写 (--dry-run)。
+    子进程解析的同时，当前进程攒够 batch_size 条就 bulk upsert 一次 """
+    stats = {"pages": 0, "parsed": 0, "failed": 0, "written": 0}
+    start = time.perf_counter()
+    semaphore = threading.Semaphore(processes * chunksize * 4)
+    stop = threading.Event()
+    # spawn: 不继承 motor 的线程和 socket
+    with multiprocessing.get_context("spawn").Pool(processes) as pool:
+        results = pool.imap_unordered(functools.partial(parse_page, backend=backend), _bounded(pages, semaphore, stop),
+                                      chunksize=chunksize)
+
+        def next_batch() -> List[Tuple[str, Optional[Dict], Optional[str]]]:
+            batch = []
+            for result in itertools.islice(results, batch_size):
+                semaphore.release() # 攒 batch 的同时要放行后面的页，否则 batch_size 大于信号量时会卡住
+                batch.append(result)
+            return batch
+
+        try:
+            await _write_batches(next_batch, collection, stats, start)
+        finally:
+            stop.set()
+    return stats
+
+
+async def _write_batches(next_batch, collection: Optional[motor.motor_asyncio.AsyncIOMotorCollection],
+                         stats: Dict[str, int], start: float):
+    while batch := await asyncio.to_thread(next_batch):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        requests = []
+        for url, metadata, error in batch:
+            stats["pages"] += 1
+            if metadata is None:
+                stats["failed"] += 1
+                print(f"metadata_backfill: {url} {error}")
+                continue
+            stats["parsed"] += 1
+            requests.append(UpdateOne({"_id": metadata["chinaxiv_id"]},
+                                      {"$set": {**metadata, "url": url, "parsed_at": now}}, upsert=True))
+        if requests and collection is not None:
+            await collection.bulk_write(requests, ordered=False)
+            stats["written"] += len(requests)
+        elapsed = time.perf_counter() - start
+        print(f"metadata_backfill: {stats['parsed']} parsed, {stats['failed']} failed, "
+              f"{stats['written']} written, {stats['pages'] / elapsed:.1f} pages/s")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m ChinaXivXiv.metadata_backfill",
+                                     description=f"重新解析本地保存的 abstract 页面，回填 chinaxiv.{HTML_METADATA_COLLECTION}")
+    parser.add_argument("--cache-dir", default=HTTP_CACHE_DIR,
+                        help="HTTP 缓存目录 (CHINAXIVXIV_HTTP_CACHE_DIR, default: %(default)s)")
+    parser.add_argument("--warc", nargs="*", default=[], help="改为读这些 WARC 文件 (需要 warcio)")
+    parser.add_argument("--processes", type=int, default=PARSE_WORKERS,
+                        help="解析进程数 (CHINAXIVXIV_PARSE_WORKERS, default: %(default)s)")
+    parser.add_argument("--batch-size", type=int, default=500, help="每次 bulk upsert 的条数 (default: %(default)s)")
+    parser.add_argument("--backend", default=None, help="html parser backend (default: CHINAXIVXIV_HTML_PARSER)")
+    parser.add_argument("--limit", type=int, default=0, help="最多处理多少页，0 不限")
+    parser.add_argument("--dry-run", action="store_true", help="只解析，不写 Mongo")
+    parser.add_argument("--mongodb-uri", default=os.getenv("MONGODB_URI"), help="(MONGODB_URI)")
+    args = parser.parse_args(argv)
+    if args.processes < 1 or args.batch_size < 1:
+        parser.error("--processes and --batch-size must be >= 1")
+    return args
+
+
+async def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    pages = iter_warc_pages(args.warc) if args.warc else iter_cache_pages(args.cache_dir)
+    if args.limit:
+        pages = itertools.islice(pages, args.limit)
+    collection = None
+    if not args.dry_run:
+        collection = motor.motor_asyncio.AsyncIOMotorClient(args.mongodb_uri)["chinaxiv"][HTML_METADATA_COLLECTION]
+    stats = await backfill(pages, collection, processes=args.processes, batch_size=args.batch_size, backend=args.backend)
+    print(f"metadata_backfill done: {stats}")
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
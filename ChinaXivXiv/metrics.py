@@ -0,0 +1,348 @@
+import asyncio
+import bisect
+import contextlib
+import json
+import math
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+""" 进程内指标: 计数器 / 仪表 / 直方图，Prometheus 文本格式暴露，也可以定期写 JSONL。
+大多在 event loop 里更新，但 IA 上传线程 (分块上传) 也会更新，所以每个指标一把锁；
+热路径上就是一次没人抢的 acquire 加一次 dict 查找和几次整数运算。读的时候先在锁里拷一份 """
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900, 3600)
+""" 秒；上限覆盖到 IA 建 item 的等待 """
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(labelnames: Tuple[str, ...], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, object]) -> LabelValues:
+        assert len(labels) == len(self.labelnames), f"{self.name}: expected labels {self.labelnames}, got {tuple(labels)}"
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterator[Tuple[str, LabelValues, str, float]]:
+        """ -> (suffix, label values, extra label, value) """
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, values, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, values, extra)} {_format_value(value)}")
+        return lines
+
+    def snapshot(self) -> List[Dict]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+    def items(self) -> List[Tuple[LabelValues, float]]:
+        """ 当前值的拷贝，遍历时不怕别的线程同时插入新的 label 组合 """
+        with self._lock:
+            return list(self.values.items())
+
+    def samples(self):
+        for values, value in self.items():
+            yield "", values, "", value
+
+    def snapshot(self):
+        return [{"labels": dict(zip(self.labelnames, values)), "value": value} for values, value in self.items()]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.values: Dict[LabelValues, List] = {}
+        """ label values -> [每个桶的计数 (非累计，最后一个是 +Inf), sum, count] """
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def items(self) -> List[Tuple[LabelValues, List]]:
+        """ 各 label 组合的 [桶计数, sum, count] 拷贝 """
+        with self._lock:
+            return [(values, [list(counts), total, count]) for values, (counts, total, count) in self.values.items()]
+
+    def _state(self, labels: Dict[str, object]) -> Optional[List]:
+        key = self._key(labels)
+        with self._lock:
+            state = self.values.get(key)
+            return [list(state[0]), state[1], state[2]] if state else None
+
+    def count(self, **labels) -> int:
+        state = self._state(labels)
+        return state[2] if state else 0
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        """ 按桶上界估算分位数 """
+        return self._quantile(self._state(labels), q)
+
+    def _quantile(self, state: Optional[List], q: float) -> Optional[float]:
+        if not state or not state[2]:
+            return None
+        rank = q * state[2]
+        seen = 0
+        for upper, n in zip(self.buckets + (math.inf,), state[0]):
+            seen += n
+            if seen >= rank:
+                return upper
+        return math.inf
+
+    def samples(self):
+        for values, (counts, total, count) in self.items():
+            cumulative = 0
+            for upper, n in zip(self.buckets + (math.inf,), counts):
+                cumulative += n
+                yield "_bucket", values, f'le="{_format_value(float(upper)) if upper != math.inf else "+Inf"}"', cumulative
+            yield "_sum", values, "", total
+            yield "_count", values, "", count
+
+    def snapshot(self):
+        return [{
+            "labels": dict(zip(self.labelnames, values)),
+            "count": state[2],
+            "sum": state[1],
+            "p50": self._quantile(state, 0.5),
+            "p99": self._quantile(state, 0.99),
+        } for values, state in self.items()]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self.collectors: List[Callable[[], None]] = []
+
+    def _get_or_create(self, cls, name: str, help: str, labelnames: Tuple[str, ...], **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, help, labelnames, **kwargs)
+        assert isinstance(metric, cls) and metric.labelnames == tuple(labelnames), f"{name} registered differently"
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self._get_or_create(Counter, name, help, labelnames)
+
+    def gauge(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, help, labelnames)
+
+    def histogram(self, name: str, help: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help, labelnames, buckets=buckets)
+
+    def add_collector(self, collector: Callable[[], None]) -> Callable[[], None]:
+        """ collector 在每次 render/snapshot 前调用，用来把队列长度之类的现值写进 Gauge。返回注销函数 """
+        self.collectors.append(collector)
+        return lambda: self.collectors.remove(collector) if collector in self.collectors else None
+
+    def collect(self):
+        for collector in list(self.collectors):
+            try:
+                collector()
+            except Exception as e:
+                print(f"metrics collector {collector!r} failed: {e!r}")
+
+    def render(self) -> str:
+        self.collect()
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, List[Dict]]:
+        self.collect()
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+
+REGISTRY = Registry()
+
+STEP_SECONDS = REGISTRY.histogram("chinaxivxiv_step_seconds", "Wall time of each task step", ("step",))
+STEP_ERRORS = REGISTRY.counter("chinaxivxiv_step_errors_total", "Exceptions raised by each task step", ("step", "error"))
+BYTES = REGISTRY.counter("chinaxivxiv_bytes_total", "Payload bytes moved by each step", ("step", "direction"))
+HTTP_RESPONSES = REGISTRY.counter("chinaxivxiv_http_responses_total", "HTTP responses by host and status code", ("host", "code"))
+TASKS = REGISTRY.counter("chinaxivxiv_tasks_total", "Task status transitions written to Mongo", ("status",))
+QUEUE_DEPTH = REGISTRY.gauge("chinaxivxiv_queue_depth", "Items waiting in an in-process queue", ("queue",))
+IN_FLIGHT = REGISTRY.gauge("chinaxivxiv_in_flight", "Items currently being worked on", ("queue",))
+TASK_FAILURES = REGISTRY.counter("chinaxivxiv_task_failures_total", "Task failures by classification", ("kind", "error"))
+CONCURRENCY_LIMIT = REGISTRY.gauge("chinaxivxiv_concurrency_limit", "Current AIMD concurrency limit per upstream", ("upstream",))
+CONCURRENCY_CHANGES = REGISTRY.counter("chinaxivxiv_concurrency_changes_total", "AIMD limit increases and decreases",
+                                       ("upstream", "direction"))
+IA_MULTIPART_PARTS = REGISTRY.counter("chinaxivxiv_ia_multipart_parts_total",
+                                      "IA S3 multipart parts by outcome (uploaded, resumed, retried)", ("result",))
+SPOOL_BYTES = REGISTRY.gauge("chinaxivxiv_spool_bytes", "Bytes held in the local prefetch spool")
+HTTP_CONNECTIONS = REGISTRY.counter("chinaxivxiv_http_connections_total",
+                                    "HTTP requests by host and whether they opened a new connection or reused one",
+                                    ("host", "connection", "http_version"))
+HTTP_HANDSHAKE_SECONDS = REGISTRY.histogram("chinaxivxiv_http_handshake_seconds",
+                                            "TCP connect / TLS handshake time of new connections", ("host", "phase"))
+
+
+@contextlib.contextmanager
+def step(name: str) -> Iterator[None]:
+    """ with step("pdf_download"): ... 记录耗时，出异常按类型计数（异常照常抛出） """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        STEP_ERRORS.inc(step=name, error=type(e).__name__)
+        raise
+    finally:
+        STEP_SECONDS.observe(time.perf_counter() - start, step=name)
+
+
+async def record_response(response):
+    """ httpx event hook """
+    HTTP_RESPONSES.inc(host=response.request.url.host, code=response.status_code)
+
+
+async def serve_metrics(port: int, host: str = "0.0.0.0", registry: Registry = REGISTRY) -> asyncio.AbstractServer:
+    """ GET /metrics -> Prometheus 文本格式 """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.split()
+            if len(parts) >= 2 and parts[1].split(b"?")[0] == b"/metrics":
+                status, body = "200 OK", registry.render().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\n"
+                         "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(body)}\r\n"
+                         "Connection: close\r\n\r\n".encode("ascii") + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    print(f"metrics on http://{host}:{port}/metrics")
+    return server
+
+
+async def jsonl_sink_worker(path: str, interval: float = 60, registry: Registry = REGISTRY):
+    """ 每 interval 秒追加一行 {"ts", "pid", "metrics"}，多进程可以写同一个文件 """
+    while not os.path.exists("stop"):
+        await asyncio.sleep(interval)
+        line = json.dumps({"ts": time.time(), "pid": os.getpid(), "metrics": registry.snapshot()},
+                          ensure_ascii=False, default=str) + "\n"
+        try:
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(line)
+        except OSError as e:
+            print(f"jsonl_sink_worker: {e!r}")
+
+
+if __name__ == "__main__":
+    import httpx
+
+    async def test_metrics():
+        registry = Registry()
+        latency = registry.histogram("t_seconds", "test", ("step",), buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.5, 5):
+            latency.observe(value, step="a")
+        assert latency.quantile(0.5, step="a") == 1 and latency.quantile(0.99, step="a") == math.inf
+        registry.counter("t_total", "test", ("code",)).inc(code=200)
+        depth = registry.gauge("t_depth", "test", ("queue",))
+        unregister = registry.add_collector(lambda: depth.set(3, queue="q"))
+        text = registry.render()
+        assert 't_seconds_bucket{step="a",le="0.1"} 1' in text, text
+        assert 't_seconds_bucket{step="a",le="+Inf"} 4' in text, text
+        assert 't_seconds_count{step="a"} 4' in text and 't_total{code="200"} 1' in text, text
+        assert 't_depth{queue="q"} 3' in text, text
+        unregister()
+        assert not registry.collectors
+
+        # 线程池里更新 (分块上传)，不丢计数，导出时也不会撞上插入
+        import concurrent.futures
+        parts = registry.counter("t_parts_total", "test", ("result",))
+        with concurrent.futures.ThreadPoolExecutor(8) as pool:
+            list(pool.map(lambda i: [parts.inc(result=str(j % 3)) for j in range(10_000)] and registry.render(), range(8)))
+        assert sum(value for _, value in parts.items()) == 80_000, parts.items()
+
+        server = await serve_metrics(0, host="127.0.0.1", registry=registry)
+        port = server.sockets[0].getsockname()[1]
+        async with httpx.AsyncClient() as client:
+            r = await client.get(f"http://127.0.0.1:{port}/metrics")
+            assert r.status_code == 200 and 't_total{code="200"} 1' in r.text
+            assert (await client.get(f"http://127.0.0.1:{port}/")).status_code == 404
+        server.close()
+        await server.wait_closed()
+
+        # 开销: 热路径上的一次 observe
+        n = 100_000
+        start = time.perf_counter()
+        for _ in range(n):
+            with step("bench"):
+                pass
+        print(f"step(): {(time.perf_counter() - start) / n * 1e6:.2f} us/op")
+        print("ok")
+
+    asyncio.run(test_metrics())
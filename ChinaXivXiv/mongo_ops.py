@@ -1,44 +1,350 @@
-from typing import Optional
+import asyncio
+import datetime
+import os
+import socket
+import time
+import uuid
+import zlib
+from typing import Dict, Iterable, List, Optional, Tuple
 import motor.motor_asyncio
+from pymongo import ReturnDocument, UpdateOne
 
-from ChinaXivXiv.defines import Status, Task
+from ChinaXivXiv.defines import LEASE_DURATION, LEASED_STATUSES, SPOOL_STALE_AFTER, STATUSES, Status, Task
+from ChinaXivXiv.metrics import TASKS
 
+TASK_PROJECTION = {"_id": 1, "identifier": 1, "status": 1, "datestamp": 1, "attempts": 1, "worker_id": 1}
+""" 领取任务时只取这几个字段。整个 OAI metadata 不跟着领取走，要用时再 load_tasks_metadata """
+
+
+SHARD_BUCKETS = 64
+""" 任务按 crc32(identifier) % SHARD_BUCKETS 分桶（bucket 字段），每个进程只领自己那几个桶里的任务 """
+
+
+def task_bucket(identifier: str) -> int:
+    """ 不能用 hash()，它每个进程加的盐不一样 """
+    return zlib.crc32(identifier.encode("utf-8")) % SHARD_BUCKETS
+
+def shard_buckets(shard_index: int, shard_count: int) -> Optional[List[int]]:
+    """ 第 shard_index 个分片（共 shard_count 个）负责的桶。只有一个分片时返回 None，查询不加 bucket 条件 """
+    assert 0 < shard_count <= SHARD_BUCKETS, f"shard_count must be in 1..{SHARD_BUCKETS}"
+    assert 0 <= shard_index < shard_count
+    if shard_count == 1:
+        return None
+    return [bucket for bucket in range(SHARD_BUCKETS) if bucket % shard_count == shard_index]
+
+def status_filter(status: str, buckets: Optional[List[int]] = None) -> dict:
+    if buckets is None:
+        return {"status": status}
+    return {"status": status, "bucket": {"$in": buckets}}
+
+def due_filter(now: Optional[datetime.datetime] = None) -> dict:
+    """ 失败退避中、next_attempt_at 还没到的任务不领。没有这个字段的 (从没失败过) 也匹配 """
+    return {"next_attempt_at": {"$not": {"$gt": now or utcnow()}}}
+
+async def backfill_buckets(queue: motor.motor_asyncio.AsyncIOMotorCollection, batch_size: int = 1000) -> int:
+    """ 给还没有 bucket 字段的老任务补上，分片运行前调用一次 """
+    filled = 0
+    while True:
+        docs = await queue.find({"bucket": {"$exists": False}}, projection={"_id": 1, "identifier": 1},
+                                limit=batch_size).to_list(length=batch_size)
+        if not docs:
+            break
+        await queue.bulk_write([
+            UpdateOne({"_id": doc["_id"]}, {"$set": {"bucket": task_bucket(doc["identifier"])}}) for doc in docs
+        ], ordered=False)
+        filled += len(docs)
+    if filled:
+        print(f"backfilled bucket on {filled} tasks")
+    return filled
+
+
+def make_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+def utcnow() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+def lease_fields(worker_id: Optional[str], lease: datetime.timedelta = LEASE_DURATION) -> dict:
+    now = utcnow()
+    return {
+        "claim_at": now,
+        "lease_until": now + lease,
+        "worker_id": worker_id,
+    }
 
 
 async def claim_task(queue: motor.motor_asyncio.AsyncIOMotorCollection,
                      status_from: str = Status.TODO,
-                     status_to: str=Status.PROCESSING) -> Optional[Task]:
-    assert status_from in Status.__dict__.values()
-    assert status_to in Status.__dict__.values()
+                     status_to: str=Status.PROCESSING,
+                     worker_id: Optional[str] = None,
+                     buckets: Optional[List[int]] = None,
+                     projection: Dict = TASK_PROJECTION,
+                     extra_filter: Optional[Dict] = None) -> Optional[Task]:
+    """ extra_filter: 额外的条件，例如只领本机 spool 里的任务 """
+    assert status_from in STATUSES
+    assert status_to in STATUSES
 
     TASK = await queue.find_one_and_update(
-        filter={"status": status_from},
+        filter={**status_filter(status_from, buckets), **due_filter(), **(extra_filter or {})},
         update={"$set": {
             "status": status_to,
+            **lease_fields(worker_id),
             }},
         sort=[("_id", -1)],
+        projection=projection,
+        return_document=ReturnDocument.AFTER, # 领到之后的 status 和 worker_id，提交时用
     )
-    return Task(**TASK) if TASK else None
+    return Task.from_doc(TASK) if TASK else None
+
+async def claim_tasks(queue: motor.motor_asyncio.AsyncIOMotorCollection, n: int, worker_id: str,
+                      status_from: str = Status.TODO,
+                      status_to: str = Status.PROCESSING,
+                      buckets: Optional[List[int]] = None,
+                      projection: Dict = TASK_PROJECTION) -> List[Task]:
+    """ 一次领取至多 n 个任务: 先给候选任务盖上本次的 lease_token，再按 token 取回。
+    update_many 的 filter 带着 status_from，被别的 worker 抢先领走的候选不会被重复领取。
+    几个 worker 同时领会拿到同一批候选，没抢满就跳过已经看过的候选再查一轮，直到领满或者查不到候选。
+    -> [] 只表示真的没有可领的任务 """
+    assert status_from in STATUSES
+    assert status_to in STATUSES
+
+    lease_token = uuid.uuid4().hex
+    seen: List = []
+    claimed = 0
+    while claimed < n:
+        query = {**status_filter(status_from, buckets), **due_filter()}
+        if seen:
+            query["_id"] = {"$nin": seen}
+        candidates = await queue.find(
+            query, projection={"_id": 1}, sort=[("_id", -1)], limit=n - claimed,
+        ).to_list(length=n - claimed)
+        if not candidates:
+            break
+        candidate_ids = [doc["_id"] for doc in candidates]
+        seen += candidate_ids
+        result = await queue.update_many(
+            {"_id": {"$in": candidate_ids}, "status": status_from},
+            {"$set": {
+                "status": status_to,
+                "lease_token": lease_token,
+                **lease_fields(worker_id),
+            }},
+        )
+        claimed += result.modified_count
+    if not claimed:
+        return []
+    TASKS = await queue.find({"lease_token": lease_token}, projection=projection).to_list(length=n)
+    return [Task.from_doc(TASK) for TASK in TASKS]
+
+async def load_tasks_metadata(queue: motor.motor_asyncio.AsyncIOMotorCollection, TASKS: List[Task],
+                              fields: Iterable[str]):
+    """ 给 metadata 还是 None 的任务一次查询补上 metadata 里的这些字段（只取这些，不取整个 OAI 记录） """
+    pending = {TASK._id: TASK for TASK in TASKS if TASK.metadata is None}
+    if not pending:
+        return
+    projection = {f"metadata.{name}": 1 for name in fields}
+    async for doc in queue.find({"_id": {"$in": list(pending)}}, projection=projection):
+        pending[doc["_id"]].metadata = doc.get("metadata", {})
+    for TASK in pending.values():
+        if TASK.metadata is None: # 文档已被删除
+            TASK.metadata = {}
+
+def commit_filter(TASK: Task) -> dict:
+    """ 领取来的任务: 还得是这个 worker 领的、还在领取时的状态。租约过期被 reaper 收回、又被别的 worker 领走之后，
+    卡住的老 worker 再提交就匹配不上，不会把别人已经推进的任务改回去 """
+    if TASK.worker_id is None or TASK.status not in LEASED_STATUSES:
+        return {"_id": TASK._id}
+    return {"_id": TASK._id, "status": TASK.status, "worker_id": TASK.worker_id}
 
-async def update_task(queue: motor.motor_asyncio.AsyncIOMotorCollection, TASK: Task, status: str|int):
+async def update_task(queue: motor.motor_asyncio.AsyncIOMotorCollection, TASK: Task, status: str|int, **fields) -> bool:
+    """ -> 是否写进去了。租约已经不在自己手上时打日志、放弃这次写入 """
     # assert status in Status.__dict__.values()
     update = {"$set": {
             "status": status,
+            **fields,
         }}
 
-    await queue.update_one(
-        filter={"_id": TASK._id},
+    result = await queue.update_one(
+        filter=commit_filter(TASK),
         update=update
     )
+    if not result.matched_count:
+        print(f"lease on {TASK.identifier} lost, dropped update to {status}")
+        return False
+    TASK.status = status # type: ignore
+    TASKS.inc(status=status)
+    return True
+
+async def update_tasks(queue: motor.motor_asyncio.AsyncIOMotorCollection, updates: List[Tuple[Task, str|int, dict]]):
+    """ updates: [(TASK, status, fields), ...]，一次 unordered bulk_write。租约已经丢了的那几条匹配不上，打日志 """
+    if not updates:
+        return
+    result = await queue.bulk_write([
+        UpdateOne(commit_filter(TASK), {"$set": {"status": status, **fields}})
+        for TASK, status, fields in updates
+    ], ordered=False)
+    if result.matched_count < len(updates):
+        print(f"update_tasks: {len(updates) - result.matched_count} of {len(updates)} tasks no longer leased by us, dropped")
+    for TASK, status, _ in updates:
+        TASK.status = status # type: ignore
+        TASKS.inc(status=status)
+
+
+class TaskUpdateBuffer:
+    """ 攒够 max_size 条或最早一条等了 max_delay 秒就 flush 一次 update_tasks """
+    def __init__(self, queue: motor.motor_asyncio.AsyncIOMotorCollection, max_size: int = 100, max_delay: float = 1.0):
+        self.queue = queue
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.pending: List[Tuple[Task, str|int, dict]] = []
+        self._first_at = 0.0
+        self._timer: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    async def update_task(self, TASK: Task, status: str|int, **fields):
+        if not self.pending:
+            self._first_at = time.monotonic()
+        self.pending.append((TASK, status, fields))
+        if len(self.pending) >= self.max_size:
+            await self.flush()
+        elif self._timer is None or self._timer.done():
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(max(0.0, self._first_at + self.max_delay - time.monotonic()))
+        try:
+            await self.flush()
+        except Exception as e: # 没人 await 这个定时器，异常要自己处理: 这批已放回 pending，过 max_delay 再试
+            print(f"TaskUpdateBuffer: failed to write {len(self.pending)} updates, retrying in {self.max_delay}s: {e!r}")
+            self._first_at = time.monotonic()
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def flush(self):
+        async with self._lock:
+            pending, self.pending = self.pending, []
+            try:
+                await update_tasks(self.queue, pending)
+            except BaseException:
+                self.pending[:0] = pending # $set 重放是幂等的，整批放回去下次再写
+                raise
+
+    async def close(self):
+        """ 还有写不进去的更新就抛出来 """
+        try:
+            await self.flush() # 先拿锁 flush，保证定时器手里的那批已经写完再取消它
+        finally:
+            if self._timer is not None and not self._timer.done():
+                self._timer.cancel()
+
+
+async def extend_leases(queue: motor.motor_asyncio.AsyncIOMotorCollection, task_ids: Iterable,
+                        lease: datetime.timedelta = LEASE_DURATION, worker_id: Optional[str] = None):
+    """ worker_id: 只续自己领的，已经被别人重新领走的不碰 """
+    task_ids = list(task_ids)
+    if not task_ids:
+        return
+    await queue.update_many(
+        {"_id": {"$in": task_ids}, "status": {"$in": list(LEASED_STATUSES)}, **({"worker_id": worker_id} if worker_id else {})},
+        {"$set": {"lease_until": utcnow() + lease}},
+    )
+
+
+class LeaseKeeper:
+    """ 心跳: 定期给本 worker 手上的任务续租。任务结束（无论成败）后要 release，否则会一直续下去 """
+    def __init__(self, queue: motor.motor_asyncio.AsyncIOMotorCollection, worker_id: Optional[str] = None,
+                 lease: datetime.timedelta = LEASE_DURATION):
+        self.queue = queue
+        self.worker_id = worker_id or make_worker_id()
+        self.lease = lease
+        self.held = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def hold(self, TASK: Task):
+        self.held.add(TASK._id)
+
+    def release(self, TASK: Task):
+        self.held.discard(TASK._id)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.lease.total_seconds() / 3)
+            try:
+                await extend_leases(self.queue, self.held, self.lease, self.worker_id)
+            except Exception as e:
+                print(f"LeaseKeeper: failed to extend {len(self.held)} leases: {e!r}")
+
+    def start(self) -> "LeaseKeeper":
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+        return self
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+async def reap_expired_leases(queue: motor.motor_asyncio.AsyncIOMotorCollection, buckets: Optional[List[int]] = None) -> int:
+    """ 把租约过期（worker 崩了/卡死）的任务放回队列 """
+    reaped = 0
+    now = utcnow()
+    for status_leased, status_back in LEASED_STATUSES.items():
+        result = await queue.update_many(
+            {**status_filter(status_leased, buckets), "lease_until": {"$lt": now}},
+            {
+                "$set": {"status": status_back},
+                "$unset": {"lease_until": "", "lease_token": "", "worker_id": ""},
+            },
+        )
+        reaped += result.modified_count
+    return reaped
+
+async def requeue_stale_spooled(queue: motor.motor_asyncio.AsyncIOMotorCollection, stale_after: datetime.timedelta = SPOOL_STALE_AFTER,
+                                buckets: Optional[List[int]] = None) -> int:
+    """ UPLOADTOIA_SPOOLED 不带租约，只有 spool.id 那台机器会去领，机器没了就永远卡住。
+    放太久的放回 TODO 重新下载；那台机器如果还在，本地留下的文件下次启动时 reconcile_spool 会清掉 """
+    result = await queue.update_many(
+        {**status_filter(Status.UPLOADTOIA_SPOOLED, buckets), "spool.spooled_at": {"$lt": utcnow() - stale_after}},
+        {"$set": {"status": Status.TODO, "spool": None}},
+    )
+    return result.modified_count
+
+async def migrate_legacy_statuses(queue: motor.motor_asyncio.AsyncIOMotorCollection) -> int:
+    """ 以前 abstract 404 写的是整数 status 404 """
+    result = await queue.update_many({"status": 404}, {"$set": {"status": Status.UPLOADTOIA_EMPTY}})
+    if result.modified_count:
+        print(f"migrated {result.modified_count} tasks from status 404 to {Status.UPLOADTOIA_EMPTY}")
+    return result.modified_count
+
+async def lease_reaper_worker(queue: motor.motor_asyncio.AsyncIOMotorCollection, interval: float = 60,
+                              buckets: Optional[List[int]] = None):
+    while not os.path.exists("stop"):
+        try:
+            reaped = await reap_expired_leases(queue, buckets)
+            if reaped:
+                print(f"reaped {reaped} tasks with expired leases")
+            requeued = await requeue_stale_spooled(queue, buckets=buckets)
+            if requeued:
+                print(f"requeued {requeued} tasks stuck in a spool for over {SPOOL_STALE_AFTER}")
+        except Exception as e: # reaper 停了过期的租约就永远回不到队列，下一轮再试
+            print(f"lease_reaper_worker: {e!r}")
+        await asyncio.sleep(interval)
 
 
 async def create_fileids_queue_index(collection: motor.motor_asyncio.AsyncIOMotorCollection):
     await collection.create_index("status")
     await collection.create_index("id", unique=True)
 
+async def find_max_datestamp(collection: motor.motor_asyncio.AsyncIOMotorCollection) -> Optional[str]:
+    doc = await collection.find_one({"datestamp": {"$exists": True}}, projection={"datestamp": 1}, sort=[("datestamp", -1)])
+    if doc:
+        return doc["datestamp"]
+    else:
+        return None
+
 async def find_max_id(collection: motor.motor_asyncio.AsyncIOMotorCollection):
     doc = await collection.find_one(sort=[("id", -1)])
     if doc:
         return doc["id"]
     else:
-        return 0
\ No newline at end of file
+        return 0
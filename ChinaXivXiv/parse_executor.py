@@ -0,0 +1,70 @@
+import asyncio
+import concurrent.futures
+import multiprocessing
+from typing import Optional, Tuple
+
+from ChinaXivXiv.defines import PARSE_MODE, PARSE_WORKERS, ChinaXivHtmlMetadata
+from ChinaXivXiv.metrics import step
+from ChinaXivXiv.workers.metadata_scraper import parse_abs_page
+
+PARSE_MODES = ("inline", "thread", "process")
+
+
+class ParseExecutor:
+    """ 把 CPU 密集的 abstract 页面解析挪出 event loop。只传 bytes 进去，只拿可 pickle 的结果出来 """
+    def __init__(self, mode: str = PARSE_MODE, max_workers: int = PARSE_WORKERS):
+        assert mode in PARSE_MODES, f"unknown parse mode: {mode}"
+        self.mode = mode
+        self.max_workers = max_workers
+        self._executor: Optional[concurrent.futures.Executor] = None
+
+    @property
+    def executor(self) -> Optional[concurrent.futures.Executor]:
+        if self._executor is None and self.mode == "thread":
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="parse")
+        elif self._executor is None and self.mode == "process":
+            # spawn: 不继承父进程里 motor/httpx 的线程和 socket
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    async def parse_abs_page(self, html: bytes, url: str, backend: Optional[str] = None) -> Tuple[ChinaXivHtmlMetadata, str]:
+        """ -> (html_metadata, core_html) """
+        with step("parse"):
+            if self.mode == "inline":
+                return parse_abs_page(html, url, backend)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, parse_abs_page, bytes(html), url, backend)
+
+    def shutdown(self, wait: bool = True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+
+
+_default_parse_executor: Optional[ParseExecutor] = None
+
+def get_parse_executor() -> ParseExecutor:
+    global _default_parse_executor
+    if _default_parse_executor is None:
+        _default_parse_executor = ParseExecutor()
+    return _default_parse_executor
+
+
+if __name__ == "__main__":
+    from ChinaXivXiv.bench.fixtures import make_abs_page
+
+    async def test_parse_executor():
+        html = make_abs_page(1041)
+        url = "https://chinaxiv.org/abs/synthetic1041v1"
+        expected = parse_abs_page(html, url)
+        for mode in PARSE_MODES:
+            executor = ParseExecutor(mode=mode, max_workers=2)
+            try:
+                assert await executor.parse_abs_page(html, url) == expected, mode
+            finally:
+                executor.shutdown()
+        print("ok")
+
+    asyncio.run(test_parse_executor())
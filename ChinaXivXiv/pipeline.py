@@ -0,0 +1,140 @@
+import asyncio
+import traceback
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+_STOP = object()
+""" 哨兵: 上游已结束 """
+
+Handler = Callable[[Any], Awaitable[Optional[Any]]]
+
+
+class Stage:
+    """ 一个流水线阶段: concurrency 个协程从 inbox 取 item，handler 返回值放入下一阶段的 inbox。
+    handler 返回 None 表示 item 在本阶段结束（已提交或已丢弃）。
+    inbox 有界，下游慢时上游 put 会阻塞 —— 反压 """
+    def __init__(self, name: str, handler: Handler, concurrency: int = 1, queue_size: int = 4,
+                 on_error: Optional[Callable[[Any, BaseException], Awaitable[None]]] = None):
+        assert concurrency >= 1
+        self.name = name
+        self.handler = handler
+        self.concurrency = concurrency
+        self.inbox: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.on_error = on_error
+        self.in_flight = 0
+        self.processed = 0
+        self.failed = 0
+
+    async def _run_one(self, outbox: Optional[asyncio.Queue]):
+        while True:
+            item = await self.inbox.get()
+            if item is _STOP:
+                return
+            self.in_flight += 1
+            try:
+                result = await self.handler(item)
+            except Exception as e:
+                self.failed += 1
+                print(f"[{self.name}] failed: {e!r}")
+                traceback.print_exc()
+                if self.on_error is not None:
+                    await self.on_error(item, e)
+                continue
+            finally:
+                self.in_flight -= 1
+            self.processed += 1
+            if result is not None and outbox is not None:
+                await outbox.put(result)
+
+    async def run(self, outbox: Optional[asyncio.Queue], downstream_concurrency: int):
+        await asyncio.gather(*[self._run_one(outbox) for _ in range(self.concurrency)])
+        # 本阶段所有协程都退出了，通知下游
+        if outbox is not None:
+            for _ in range(downstream_concurrency):
+                await outbox.put(_STOP)
+
+
+class Pipeline:
+    def __init__(self, source: Callable[[], AsyncIterator[Any]], stages: List[Stage],
+                 finalizers: Optional[List[Callable[[], Awaitable[None]]]] = None):
+        """ source: 异步生成器，产出进入第一个阶段的 item
+        finalizers: 所有阶段都结束后依次调用，例如 flush 缓冲的写入 """
+        assert stages
+        self.source = source
+        self.stages = stages
+        self.finalizers = finalizers or []
+
+    async def _feed(self):
+        first = self.stages[0]
+        async for item in self.source():
+            await first.inbox.put(item)
+        for _ in range(first.concurrency):
+            await first.inbox.put(_STOP)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {stage.name: {
+            "queued": stage.inbox.qsize(),
+            "in_flight": stage.in_flight,
+            "processed": stage.processed,
+            "failed": stage.failed,
+        } for stage in self.stages}
+
+    async def run(self):
+        runs = []
+        for idx, stage in enumerate(self.stages):
+            nxt = self.stages[idx + 1] if idx + 1 < len(self.stages) else None
+            runs.append(stage.run(nxt.inbox if nxt else None, nxt.concurrency if nxt else 0))
+        try:
+            await asyncio.gather(self._feed(), *runs)
+        finally:
+            for finalizer in self.finalizers:
+                await finalizer()
+
+
+def parse_concurrency(spec: str, defaults: Dict[str, int]) -> Dict[str, int]:
+    """ "pdf=3,upload=8" -> 覆盖 defaults 里对应阶段的并发数 """
+    concurrency = dict(defaults)
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        name, _, value = part.partition("=")
+        assert name in concurrency, f"unknown stage: {name}"
+        concurrency[name] = int(value)
+    return concurrency
+
+
+if __name__ == "__main__":
+    async def test_pipeline():
+        max_in_flight = 0
+        in_flight = 0
+        results = []
+
+        async def source():
+            for i in range(50):
+                yield i
+
+        async def double(x):
+            return x * 2
+
+        async def slow(x):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.001)
+            in_flight -= 1
+            if x == 10:
+                raise ValueError("bad item")
+            return x
+
+        async def sink(x):
+            results.append(x)
+
+        pipeline = Pipeline(source, [
+            Stage("double", double, concurrency=4),
+            Stage("slow", slow, concurrency=2, queue_size=1),
+            Stage("sink", sink),
+        ])
+        await pipeline.run()
+        assert sorted(results) == [x * 2 for x in range(50) if x != 5], results
+        assert max_in_flight <= 2
+        assert pipeline.stats()["slow"]["failed"] == 1
+        print("ok")
+
+    asyncio.run(test_pipeline())
@@ -0,0 +1,138 @@
+import asyncio
+import time
+from typing import Dict, Optional
+
+import httpx
+import motor.motor_asyncio
+from pymongo import ReturnDocument
+
+
+class TokenBucket:
+    """ 异步令牌桶。遇到 429/503 或延迟明显上升时乘性降速，之后每个正常响应加性恢复到 rate """
+    def __init__(self, rate: float, burst: float = 1, min_rate: Optional[float] = None):
+        assert rate > 0
+        self.rate = rate
+        """ 配置的速率上限 (q/s) """
+        self.current_rate = rate
+        self.min_rate = min_rate or rate / 16
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.latency_ewma: Optional[float] = None
+        self.latency_baseline: Optional[float] = None
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock: # 排队，先到先得，保证均匀
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.current_rate)
+                self.updated_at = now
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.current_rate)
+                if wait <= 0:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep(wait)
+
+    def slow_down(self, factor: float = 0.5, retry_after: Optional[float] = None):
+        self.current_rate = max(self.min_rate, self.current_rate * factor)
+        self.tokens = min(self.tokens, 0)
+        if retry_after:
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+    def feedback(self, status_code: int, latency: float, retry_after: Optional[float] = None):
+        if status_code in (429, 503):
+            self.slow_down(retry_after=retry_after)
+            return
+        self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+        if self.latency_baseline is None or self.latency_ewma < self.latency_baseline:
+            self.latency_baseline = self.latency_ewma
+        if self.latency_ewma > 3 * self.latency_baseline + 0.1: # 对面开始吃力了
+            self.slow_down(0.8)
+            self.latency_ewma = None # 重新观察
+        elif self.current_rate < self.rate:
+            self.current_rate = min(self.rate, self.current_rate + self.rate / 20)
+
+
+class MongoRateCoordinator:
+    """ 多进程/多机共享同一个速率预算: 每次请求在 Mongo 里原子地预约下一个时间片 (用服务器时钟 $$NOW)。
+    各进程的令牌桶仍然生效，这里只负责把所有进程的请求错开 """
+    def __init__(self, collection: motor.motor_asyncio.AsyncIOMotorCollection):
+        self.collection = collection
+
+    async def acquire(self, key: str, rate: float):
+        interval_ms = int(1000 / rate)
+        doc = await self.collection.find_one_and_update(
+            {"_id": key},
+            [{"$set": {
+                "server_now": {"$toLong": "$$NOW"},
+                "next_at": {"$add": [{"$max": [{"$ifNull": ["$next_at", 0]}, {"$toLong": "$$NOW"}]}, interval_ms]},
+            }}],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        wait_ms = doc["next_at"] - interval_ms - doc["server_now"]
+        if wait_ms > 0:
+            await asyncio.sleep(wait_ms / 1000)
+
+
+def parse_retry_after(response: httpx.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    if value and value.isdigit():
+        return float(value)
+    return None
+
+
+class RateLimitedTransport(httpx.AsyncBaseTransport):
+    """ 包一层 transport，按 host 限速。hosts 把 host 映射到 bucket 名，多个 host 可以共享一个 bucket """
+    def __init__(self, transport: httpx.AsyncBaseTransport, buckets: Dict[str, TokenBucket], hosts: Dict[str, str],
+                 coordinator: Optional[MongoRateCoordinator] = None):
+        self.transport = transport
+        self.buckets = buckets
+        self.hosts = hosts
+        self.coordinator = coordinator
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        bucket_name = self.hosts.get(request.url.host)
+        if bucket_name is None:
+            return await self.transport.handle_async_request(request)
+        bucket = self.buckets[bucket_name]
+        await bucket.acquire()
+        if self.coordinator is not None:
+            await self.coordinator.acquire(bucket_name, bucket.current_rate)
+        start = time.monotonic()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except httpx.TimeoutException:
+            bucket.slow_down()
+            raise
+        bucket.feedback(response.status_code, time.monotonic() - start, parse_retry_after(response))
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+if __name__ == "__main__":
+    async def test_token_bucket():
+        calls = []
+
+        def handler(request: httpx.Request):
+            if request.url.host == "archive.org":
+                return httpx.Response(200)
+            calls.append(time.monotonic())
+            return httpx.Response(429 if len(calls) == 3 else 200)
+
+        transport = RateLimitedTransport(httpx.MockTransport(handler), {"origin": TokenBucket(rate=20)},
+                                         {"chinaxiv.org": "origin", "global.chinaxiv.org": "origin"})
+        async with httpx.AsyncClient(transport=transport) as client:
+            await asyncio.gather(*[client.get(f"https://{host}/") for host in ["chinaxiv.org", "global.chinaxiv.org"] * 5],
+                                 client.get("https://archive.org/")) # 不限速
+        gaps = [b - a for a, b in zip(calls, calls[1:])]
+        assert min(gaps) >= 1 / 20 * 0.9, gaps
+        assert gaps[2] >= 1 / 10 * 0.9, gaps # 429 之后减半
+        assert gaps[-1] < gaps[2], gaps # 然后逐步恢复
+        print("ok")
+
+    asyncio.run(test_token_bucket())
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import mmap
+import os
+import shutil
+import socket
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from ChinaXivXiv.metrics import SPOOL_BYTES
+
+""" runner=spool 的本地下载缓冲。下载阶段把 browse_db 记录、abstract 页面和 PDF 存进来，上传阶段从这里读，
+两边各按各的上游速度跑，IA 慢的时候 chinaxiv 的配额照样用满，磁盘就是中间的缓冲。
+每个任务一个目录 {task _id}/: abs.html、PDF、manifest.json (、multipart.json)。manifest 最后原子写入，有 manifest 才算下载完整 """
+
+MANIFEST = "manifest.json"
+ABS_PAGE = "abs.html"
+MULTIPART_STATE = "multipart.json"
+""" 大 PDF 分块上传的断点记录，上传中断后下次从这里接着传 """
+
+
+@dataclass
+class SpoolEntry:
+    directory: str
+    manifest: Dict
+    """ {"task", "abs_url", "browse_db", "upload": asdict(IAUpload), "pdf": {"size", "md5", "sha256"}} """
+
+    @property
+    def pdf_path(self) -> str:
+        return os.path.join(self.directory, self.manifest["upload"]["file_name"])
+
+    def read_abs_page(self) -> bytes:
+        with open(os.path.join(self.directory, ABS_PAGE), "rb") as f:
+            return f.read()
+
+    def open_pdf(self) -> mmap.mmap:
+        """ 只读 mmap。上传线程按块 read，直接从 page cache 拷出来，不经过文件对象的缓冲 """
+        with open(self.pdf_path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) # mmap 自己 dup 了 fd，这里可以关
+
+
+def _dir_size(directory: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+
+class PdfSpool:
+    """ 超过 max_bytes 时 wait_for_space 挂起下载，直到上传完的条目被 remove。
+    id = 主机名:绝对路径，写进任务的 spool.id，上传阶段只领 spool.id 是自己的任务 """
+    def __init__(self, directory: str, max_bytes: int = 20 * 1024 ** 3):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.id = f"{socket.gethostname()}:{self.directory}"
+        os.makedirs(self.directory, exist_ok=True)
+        self.sizes: Dict[str, int] = {}
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir():
+                continue
+            if os.path.exists(os.path.join(entry.path, MANIFEST)):
+                self.sizes[entry.name] = _dir_size(entry.path)
+            else: # 上次下载到一半
+                shutil.rmtree(entry.path, ignore_errors=True)
+        self.used_bytes = sum(self.sizes.values())
+        self._freed = asyncio.Event()
+        SPOOL_BYTES.set(self.used_bytes)
+
+    def __len__(self) -> int:
+        return len(self.sizes)
+
+    def __contains__(self, task_id: str) -> bool:
+        return task_id in self.sizes
+
+    def task_ids(self) -> List[str]:
+        return list(self.sizes)
+
+    def entry_dir(self, task_id: str) -> str:
+        return os.path.join(self.directory, task_id)
+
+    def create(self, task_id: str) -> str:
+        """ -> 空目录，往里写 abs.html 和 PDF，写完调 commit """
+        self.remove(task_id)
+        directory = self.entry_dir(task_id)
+        os.makedirs(directory)
+        return directory
+
+    def commit(self, task_id: str, manifest: Dict) -> int:
+        """ 原子写入 manifest，-> 条目的字节数 """
+        directory = self.entry_dir(task_id)
+        tmp_path = os.path.join(directory, f"{MANIFEST}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(directory, MANIFEST))
+        size = _dir_size(directory)
+        self.sizes[task_id] = size
+        self.used_bytes += size
+        SPOOL_BYTES.set(self.used_bytes)
+        return size
+
+    def get(self, task_id: str) -> Optional[SpoolEntry]:
+        directory = self.entry_dir(task_id)
+        try:
+            with open(os.path.join(directory, MANIFEST), "r", encoding="utf-8") as f:
+                return SpoolEntry(directory, json.load(f))
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def adopt(self, other: "PdfSpool", task_id: str) -> int:
+        """ 把 other 里的条目整个目录挪过来 (同一个文件系统，rename)，-> 条目的字节数 """
+        self.remove(task_id)
+        os.rename(other.entry_dir(task_id), self.entry_dir(task_id))
+        size = other.sizes.pop(task_id)
+        other.used_bytes -= size
+        self.sizes[task_id] = size
+        self.used_bytes += size
+        SPOOL_BYTES.set(self.used_bytes)
+        return size
+
+    def remove(self, task_id: str):
+        shutil.rmtree(self.entry_dir(task_id), ignore_errors=True)
+        self.used_bytes -= self.sizes.pop(task_id, 0)
+        SPOOL_BYTES.set(self.used_bytes)
+        self._freed.set()
+
+    async def wait_for_space(self):
+        while self.used_bytes >= self.max_bytes:
+            self._freed.clear()
+            await self._freed.wait()
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    async def test_pdf_spool():
+        with tempfile.TemporaryDirectory() as directory:
+            spool = PdfSpool(directory, max_bytes=1024)
+            entry_dir = spool.create("a")
+            with open(os.path.join(entry_dir, "a.pdf"), "wb") as f:
+                f.write(b"%PDF" + b"x" * 2000)
+            spool.commit("a", {"upload": {"file_name": "a.pdf"}})
+            os.makedirs(os.path.join(directory, "half")) # 没有 manifest
+            assert spool.used_bytes > spool.max_bytes
+
+            waiter = asyncio.create_task(spool.wait_for_space())
+            await asyncio.sleep(0.01)
+            assert not waiter.done() # 满了，下载暂停
+
+            reopened = PdfSpool(directory, max_bytes=1024) # 重启: 完整的留下，下载到一半的清掉
+            assert reopened.task_ids() == ["a"] and not os.path.exists(os.path.join(directory, "half"))
+            entry = reopened.get("a")
+            assert entry is not None
+            pdf = entry.open_pdf()
+            assert pdf.read(4) == b"%PDF" and pdf.seek(0, os.SEEK_END) is None and pdf.tell() == 2004
+            pdf.close()
+
+            spool.remove("a")
+            await asyncio.wait_for(waiter, 1)
+            assert spool.used_bytes == 0 and spool.get("a") is None
+
+            other = PdfSpool(os.path.join(directory, "other"))
+            with open(os.path.join(other.create("b"), "b.pdf"), "wb") as f:
+                f.write(b"%PDF")
+            size = other.commit("b", {"upload": {"file_name": "b.pdf"}})
+            assert spool.adopt(other, "b") == size and spool.used_bytes == size and other.used_bytes == 0
+            entry = spool.get("b")
+            assert entry is not None and os.path.exists(entry.pdf_path) and other.get("b") is None
+        print("ok")
+
+    asyncio.run(test_pdf_spool())
@@ -0,0 +1,200 @@
+import asyncio
+import os
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import httpx
+import motor.motor_asyncio
+
+from ChinaXivXiv.browse_db import BrowseDbCoalescer
+from ChinaXivXiv.defines import PIPELINE_CONCURRENCY, ChinaXivHtmlMetadata, Status, Task
+from ChinaXivXiv.failures import failure_task_fields
+from ChinaXivXiv.ia_client import IAClient
+from ChinaXivXiv.ia_index import IAItemIndex
+from ChinaXivXiv.indexes import ArticleVersions
+from ChinaXivXiv.metrics import IN_FLIGHT, QUEUE_DEPTH, REGISTRY, STEP_SECONDS
+from ChinaXivXiv.mongo_ops import LeaseKeeper, TaskUpdateBuffer, claim_tasks, load_tasks_metadata
+from ChinaXivXiv.parse_executor import ParseExecutor, get_parse_executor
+from ChinaXivXiv.pipeline import Pipeline, Stage, parse_concurrency
+from ChinaXivXiv.workers.IA_uploader import (UPLOAD_METADATA_FIELDS, DownloadedPDF, IAUpload, archived_task_fields,
+                                             build_ia_upload, count_versions, do_upload, download_pdf, fetch_abs_page,
+                                             find_archived, get_browse_db, uploaded_task_fields)
+from ChinaXivXiv.workers.IA_verifier import IA_verify_worker
+
+DEFAULT_STAGE_CONCURRENCY = {
+    "metadata": 10, # 大多在等 BrowseDbCoalescer 的合并 POST，并发低了就合并不起来
+    "page": 2,
+    "pdf": 3,
+    "upload": 5,
+    "commit": 1,
+}
+
+
+@dataclass
+class UploadJob:
+    """ 在各阶段间传递的一篇论文 """
+    TASK: Task
+    metadata_from_browse_db: Optional[Dict] = None
+    html_metadata: Optional[ChinaXivHtmlMetadata] = None
+    core_html: Optional[str] = None
+    upload: Optional[IAUpload] = None
+    pdf: Optional[DownloadedPDF] = None
+    ia_files: Optional[List[Dict]] = None
+    claimed_at: float = field(default_factory=time.perf_counter)
+
+
+def IA_upload_pipeline(client: httpx.AsyncClient, collection: motor.motor_asyncio.AsyncIOMotorCollection,
+                       parse_executor: Optional[ParseExecutor] = None,
+                       concurrency: Optional[Dict[str, int]] = None, queue_size: int = 4,
+                       claim_batch_size: int = 10, lease_keeper: Optional[LeaseKeeper] = None,
+                       article_versions: Optional[ArticleVersions] = None,
+                       browse_db: Optional[BrowseDbCoalescer] = None,
+                       ia_client: Optional[IAClient] = None,
+                       ia_index: Optional[IAItemIndex] = None,
+                       buckets: Optional[List[int]] = None) -> Pipeline:
+    """ claim -> metadata (get_browse_db) -> page (abstract 页面抓取+解析) -> pdf -> upload -> commit，
+    verify 由 IA_verify_worker 批量轮询。与 IA_upload_worker 使用相同的任务文档和状态。
+    buckets: 只领这些桶里的任务（分片运行），None 表示不限 """
+    parse_executor = parse_executor or get_parse_executor()
+    concurrency = concurrency or parse_concurrency(PIPELINE_CONCURRENCY, DEFAULT_STAGE_CONCURRENCY)
+    # metadata 阶段的并发查询合并成批量 POST。一批按队列里预计积压的量开: 一次领的任务数 + 阶段队列长度，
+    # 实际同时在查的不会超过 metadata 并发，凑不满由 max_wait 兜底
+    browse_db = browse_db or BrowseDbCoalescer(client, max_batch=claim_batch_size + queue_size)
+    own_lease_keeper = lease_keeper is None
+    lease_keeper = lease_keeper or LeaseKeeper(collection)
+    updates = TaskUpdateBuffer(collection)
+
+    async def claim():
+        lease_keeper.start()
+        while not os.path.exists("stop"):
+            try:
+                TASKS = await claim_tasks(collection, claim_batch_size, lease_keeper.worker_id,
+                                          status_from=Status.TODO, status_to=Status.UPLOADTOIA_PROCESSING,
+                                          buckets=buckets)
+            except Exception as e: # Mongo 暂时不可用 (AutoReconnect、选不到 server)，等一会再领
+                print(f"failed to claim tasks: {e!r}, retrying...")
+                await asyncio.sleep(random.uniform(3, 10))
+                continue
+            if not TASKS:
+                print("no task to claim, waiting...")
+                await asyncio.sleep(random.randint(3, 10))
+                continue
+            # 领到就整批续租: 后面的任务可能要在阶段队列前等很久，等的时候租约也不能过期
+            for TASK in TASKS:
+                lease_keeper.hold(TASK)
+            # 整批一次查询，只取 article-id
+            try:
+                await load_tasks_metadata(collection, TASKS, UPLOAD_METADATA_FIELDS)
+            except Exception as e: # 这批不续租了，租约过期后 reaper 放回 TODO
+                print(f"failed to load metadata of {len(TASKS)} claimed tasks: {e!r}, leaving them to the reaper")
+                for TASK in TASKS:
+                    lease_keeper.release(TASK)
+                await asyncio.sleep(random.uniform(3, 10))
+                continue
+            for TASK in TASKS:
+                print(f"PROCESSING id: {TASK.identifier}")
+                yield UploadJob(TASK=TASK)
+
+    async def skip_archived(job: UploadJob, version: Optional[str] = None) -> bool:
+        archived = await find_archived(ia_index, job.TASK, version)
+        if archived is None:
+            return False
+        await updates.update_task(job.TASK, **archived_task_fields(archived))
+        lease_keeper.release(job.TASK)
+        STEP_SECONDS.observe(time.perf_counter() - job.claimed_at, step="task")
+        return True
+
+    async def metadata(job: UploadJob):
+        if await skip_archived(job):
+            return None
+        job.metadata_from_browse_db = await get_browse_db(client, job.TASK, browse_db)
+        if await skip_archived(job, job.metadata_from_browse_db["version"]):
+            return None
+        await count_versions(collection, job.TASK, job.metadata_from_browse_db["version"], article_versions)
+        return job
+
+    async def page(job: UploadJob):
+        assert job.metadata_from_browse_db is not None
+        url, html = await fetch_abs_page(client, job.TASK, job.metadata_from_browse_db["version"])
+        job.html_metadata, job.core_html = await parse_executor.parse_abs_page(html=html, url=url)
+        return job
+
+    async def pdf(job: UploadJob):
+        assert job.metadata_from_browse_db is not None and job.html_metadata is not None and job.core_html is not None
+        job.upload = build_ia_upload(job.metadata_from_browse_db, job.html_metadata, job.core_html)
+        job.pdf = await download_pdf(client, job.upload.pdf_url)
+        return job
+
+    async def upload(job: UploadJob):
+        assert job.upload is not None and job.pdf is not None
+        try:
+            await do_upload(job.upload.identifier, job.upload.metadata,
+                            job.upload.core_html, job.upload.core_html_filename,
+                            job.pdf, job.upload.file_name, ia_client)
+            job.ia_files = [{"name": job.upload.file_name, "md5": job.pdf.md5}]
+        finally:
+            job.pdf.close()
+            job.pdf = None
+        print(f"uploaded to IA: {job.upload.identifier}")
+        return job
+
+    async def commit(job: UploadJob):
+        assert job.upload is not None
+        # 交给 IA_verify_worker 批量确认 item 已创建
+        await updates.update_task(job.TASK, **uploaded_task_fields(job.upload.identifier, job.ia_files))
+        lease_keeper.release(job.TASK)
+        STEP_SECONDS.observe(time.perf_counter() - job.claimed_at, step="task")
+        return None
+
+    async def on_error(job: UploadJob, e: BaseException):
+        lease_keeper.release(job.TASK)
+        if job.pdf is not None:
+            job.pdf.close()
+        # 按失败类型记 EMPTY / FAIL，或者放回 TODO 等退避到点；写不进去的话租约过期后 reaper 会放回 TODO
+        fields = failure_task_fields(job.TASK, e)
+        print(f"FAILED id: {job.TASK.identifier}, {fields['failure']}: {e!r} -> {fields['status']}")
+        await updates.update_task(job.TASK, **fields)
+
+    def collect_metrics():
+        for name, stats in pipeline.stats().items():
+            QUEUE_DEPTH.set(stats["queued"], queue=f"pipeline_{name}")
+            IN_FLIGHT.set(stats["in_flight"], queue=f"pipeline_{name}")
+
+    async def close():
+        unregister_metrics()
+        try:
+            await updates.close()
+        finally:
+            if own_lease_keeper:
+                lease_keeper.stop()
+
+    pipeline = Pipeline(claim, [
+        Stage(name, handler, concurrency=concurrency[name], queue_size=queue_size, on_error=on_error)
+        for name, handler in (
+            ("metadata", metadata),
+            ("page", page),
+            ("pdf", pdf),
+            ("upload", upload),
+            ("commit", commit),
+        )
+    ], finalizers=[close])
+    unregister_metrics = REGISTRY.add_collector(collect_metrics)
+    return pipeline
+
+
+async def run_IA_upload_pipeline(client: httpx.AsyncClient, collection: motor.motor_asyncio.AsyncIOMotorCollection,
+                                 parse_executor: Optional[ParseExecutor] = None, lease_keeper: Optional[LeaseKeeper] = None,
+                                 article_versions: Optional[ArticleVersions] = None,
+                                 browse_db: Optional[BrowseDbCoalescer] = None,
+                                 ia_client: Optional[IAClient] = None,
+                                 ia_index: Optional[IAItemIndex] = None,
+                                 buckets: Optional[List[int]] = None):
+    pipeline = IA_upload_pipeline(client, collection, parse_executor=parse_executor, lease_keeper=lease_keeper,
+                                  article_versions=article_versions, browse_db=browse_db, ia_client=ia_client,
+                                  ia_index=ia_index, buckets=buckets)
+    await asyncio.gather(
+        pipeline.run(),
+        IA_verify_worker(client=client, collection=collection, ia_index=ia_index, buckets=buckets),
+    )
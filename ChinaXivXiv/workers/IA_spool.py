@@ -0,0 +1,246 @@
+import asyncio
+import os
+import random
+import shutil
+import time
+from dataclasses import asdict
+from typing import Dict, List, Optional
+
+import httpx
+import motor.motor_asyncio
+from bson import ObjectId
+
+from ChinaXivXiv.browse_db import BrowseDbCoalescer
+from ChinaXivXiv.defines import Status, Task
+from ChinaXivXiv.failures import failure_task_fields
+from ChinaXivXiv.ia_client import IAClient
+from ChinaXivXiv.ia_index import IAItemIndex
+from ChinaXivXiv.indexes import ArticleVersions
+from ChinaXivXiv.metrics import step
+from ChinaXivXiv.mongo_ops import LeaseKeeper, claim_task, load_tasks_metadata, update_task, utcnow
+from ChinaXivXiv.parse_executor import ParseExecutor, get_parse_executor
+from ChinaXivXiv.spool import ABS_PAGE, MULTIPART_STATE, PdfSpool
+from ChinaXivXiv.workers.IA_uploader import (UPLOAD_METADATA_FIELDS, DownloadedPDF, IAUpload, archived_task_fields,
+                                             build_ia_upload, count_versions, do_upload, download_pdf, fetch_abs_page,
+                                             find_archived, get_browse_db, record_task_failure, uploaded_task_fields)
+
+""" runner=spool: IA_prefetch_worker 只管从 chinaxiv 下载到本机 PdfSpool (TODO -> UPLOADTOIA_SPOOLED)，
+IA_spool_upload_worker 只管把 spool 里的上传到 IA (UPLOADTOIA_SPOOLED -> UPLOADTOIA_VERIFYING)。
+任务的 spool 字段记着在哪台机器的哪个 spool 里: {"id", "size", "spooled_at"} """
+
+LEASE_UNSET = {"lease_until": "", "lease_token": "", "worker_id": ""}
+
+
+def spool_filter(spool: PdfSpool) -> Dict:
+    return {"spool.id": spool.id}
+
+
+async def IA_prefetch_worker(client: httpx.AsyncClient, collection: motor.motor_asyncio.AsyncIOMotorCollection,
+                             spool: PdfSpool, parse_executor: Optional[ParseExecutor] = None,
+                             lease_keeper: Optional[LeaseKeeper] = None,
+                             article_versions: Optional[ArticleVersions] = None,
+                             browse_db: Optional[BrowseDbCoalescer] = None,
+                             ia_index: Optional[IAItemIndex] = None,
+                             buckets: Optional[List[int]] = None):
+    """ spool 满了就停下来等上传腾地方 """
+    parse_executor = parse_executor or get_parse_executor()
+    own_lease_keeper = lease_keeper is None
+    lease_keeper = (lease_keeper or LeaseKeeper(collection)).start()
+    try:
+        while not os.path.exists("stop"):
+            await spool.wait_for_space()
+            try:
+                TASK = await claim_task(collection, status_from=Status.TODO, status_to=Status.UPLOADTOIA_PROCESSING,
+                                        worker_id=lease_keeper.worker_id, buckets=buckets)
+            except Exception as e:
+                print(f"failed to claim a task to prefetch: {e!r}, retrying...")
+                await asyncio.sleep(random.uniform(3, 10))
+                continue
+            if not TASK:
+                print("no task to prefetch, waiting...")
+                await asyncio.sleep(random.randint(3, 10))
+                continue
+            lease_keeper.hold(TASK)
+            try:
+                with step("prefetch"):
+                    await prefetch_task(client, collection, spool, parse_executor, TASK, article_versions, browse_db, ia_index)
+            except Exception as e:
+                spool.remove(str(TASK._id))
+                await record_task_failure(collection, TASK, e)
+            finally:
+                lease_keeper.release(TASK)
+    finally:
+        if own_lease_keeper:
+            lease_keeper.stop()
+
+
+async def prefetch_task(client: httpx.AsyncClient, collection: motor.motor_asyncio.AsyncIOMotorCollection,
+                        spool: PdfSpool, parse_executor: ParseExecutor, TASK: Task,
+                        article_versions: Optional[ArticleVersions] = None,
+                        browse_db: Optional[BrowseDbCoalescer] = None,
+                        ia_index: Optional[IAItemIndex] = None):
+    print(f"PREFETCHING id: {TASK.identifier}")
+    if archived := await find_archived(ia_index, TASK):
+        await update_task(collection, TASK, **archived_task_fields(archived))
+        return
+    await load_tasks_metadata(collection, [TASK], UPLOAD_METADATA_FIELDS)
+
+    metadata_from_browse_db = await get_browse_db(client, TASK, browse_db)
+    version: str = metadata_from_browse_db["version"]
+    if archived := await find_archived(ia_index, TASK, version):
+        await update_task(collection, TASK, **archived_task_fields(archived))
+        return
+    await count_versions(collection, TASK, version, article_versions)
+
+    abs_url, abs_html = await fetch_abs_page(client, TASK, version)
+    html_metadata, core_html = await parse_executor.parse_abs_page(html=abs_html, url=abs_url)
+    upload = build_ia_upload(metadata_from_browse_db, html_metadata, core_html)
+
+    task_id = str(TASK._id)
+    directory = spool.create(task_id)
+    with open(os.path.join(directory, ABS_PAGE), "wb") as f:
+        f.write(abs_html)
+    with open(os.path.join(directory, upload.file_name), "w+b") as f:
+        pdf = await download_pdf(client, upload.pdf_url, file=f)
+    size = spool.commit(task_id, {
+        "task": {"_id": task_id, "identifier": TASK.identifier},
+        "abs_url": abs_url,
+        "browse_db": metadata_from_browse_db,
+        "upload": asdict(upload),
+        "pdf": {"size": pdf.size, "md5": pdf.md5, "sha256": pdf.sha256},
+        "spooled_at": time.time(),
+    })
+    await update_task(collection, TASK, Status.UPLOADTOIA_SPOOLED,
+                      spool={"id": spool.id, "size": size, "spooled_at": utcnow()})
+    print(f"spooled: {TASK.identifier} ({size} bytes, spool {len(spool)} items / {spool.used_bytes} bytes)")
+
+
+async def IA_spool_upload_worker(collection: motor.motor_asyncio.AsyncIOMotorCollection, spool: PdfSpool,
+                                 ia_client: Optional[IAClient] = None, lease_keeper: Optional[LeaseKeeper] = None):
+    """ 只领 spool.id 是本机这个 spool 的任务，不看 bucket: 文件在哪个 spool 就得由哪个进程传，
+    分片方式改了也不能卡住。临时失败放回 UPLOADTOIA_SPOOLED 等退避，spool 里的文件留着 """
+    own_lease_keeper = lease_keeper is None
+    lease_keeper = (lease_keeper or LeaseKeeper(collection)).start()
+    try:
+        while not os.path.exists("stop"):
+            try:
+                TASK = await claim_task(collection, status_from=Status.UPLOADTOIA_SPOOLED, status_to=Status.UPLOADTOIA_UPLOADING,
+                                        worker_id=lease_keeper.worker_id, extra_filter=spool_filter(spool))
+            except Exception as e:
+                print(f"failed to claim a spooled task: {e!r}, retrying...")
+                await asyncio.sleep(random.uniform(3, 10))
+                continue
+            if not TASK:
+                await asyncio.sleep(random.uniform(1, 3))
+                continue
+            lease_keeper.hold(TASK)
+            try:
+                with step("spool_upload"):
+                    await upload_spooled_task(collection, spool, TASK, ia_client)
+            except Exception as e:
+                await record_spool_upload_failure(collection, spool, TASK, e)
+            finally:
+                lease_keeper.release(TASK)
+    finally:
+        if own_lease_keeper:
+            lease_keeper.stop()
+
+
+async def upload_spooled_task(collection: motor.motor_asyncio.AsyncIOMotorCollection, spool: PdfSpool, TASK: Task,
+                              ia_client: Optional[IAClient] = None):
+    task_id = str(TASK._id)
+    entry = spool.get(task_id)
+    if entry is None: # spool 目录被清掉了，重新下载
+        print(f"{TASK.identifier} is not in spool {spool.id}, back to {Status.TODO}")
+        await update_task(collection, TASK, Status.TODO, spool=None)
+        return
+    upload = IAUpload(**entry.manifest["upload"])
+    pdf_info = entry.manifest["pdf"]
+    pdf = DownloadedPDF(file=entry.open_pdf(), size=pdf_info["size"], md5=pdf_info["md5"], sha256=pdf_info["sha256"], # type: ignore
+                        resume_path=os.path.join(entry.directory, MULTIPART_STATE))
+    try:
+        await do_upload(upload.identifier, upload.metadata,
+                        upload.core_html, upload.core_html_filename,
+                        pdf, upload.file_name, ia_client)
+    finally:
+        pdf.close()
+    print(f"uploaded to IA: {upload.identifier}")
+    # 交给 IA_verify_worker 批量确认 item 已创建
+    await update_task(collection, TASK, **uploaded_task_fields(upload.identifier, [{"name": upload.file_name, "md5": pdf.md5}]),
+                      spool=None)
+    spool.remove(task_id)
+
+
+async def record_spool_upload_failure(collection: motor.motor_asyncio.AsyncIOMotorCollection, spool: PdfSpool,
+                                      TASK: Task, e: Exception):
+    fields = failure_task_fields(TASK, e, retry_status=Status.UPLOADTOIA_SPOOLED)
+    print(f"FAILED id: {TASK.identifier}, {fields['failure']}: {e!r} -> {fields['status']}")
+    if fields["status"] != Status.UPLOADTOIA_SPOOLED: # 不再重试，spool 里的也不要了
+        fields["spool"] = None
+    try:
+        await update_task(collection, TASK, **fields)
+    except Exception as write_error: # 租约过期后 reaper 会放回 UPLOADTOIA_SPOOLED
+        print(f"failed to record failure of {TASK.identifier}: {write_error!r}")
+        return
+    if fields["status"] != Status.UPLOADTOIA_SPOOLED:
+        spool.remove(str(TASK._id))
+
+
+async def reconcile_spool(collection: motor.motor_asyncio.AsyncIOMotorCollection, spool: PdfSpool) -> Dict[str, int]:
+    """ 启动时把 spool 目录和 Mongo 里的 spool 状态对齐，要在本 spool 的 worker 开始之前调用:
+    - Mongo 记着在本 spool、本地也有: 留着；上次上传到一半的放回 UPLOADTOIA_SPOOLED
+    - Mongo 记着在本 spool、本地没了: 放回 TODO 重新下载
+    - 本地有、Mongo 不知道 (写完 spool 还没来得及记 SPOOLED 进程就退出了): 任务还没被别人领走就直接收下，否则删掉 """
+    stats = {"kept": 0, "requeued": 0, "adopted": 0, "removed": 0}
+    local = set(spool.task_ids())
+    async for doc in collection.find({"status": {"$in": [Status.UPLOADTOIA_SPOOLED, Status.UPLOADTOIA_UPLOADING]},
+                                      **spool_filter(spool)}, projection={"_id": 1, "status": 1}):
+        task_id = str(doc["_id"])
+        if task_id in local:
+            local.discard(task_id)
+            stats["kept"] += 1
+            if doc["status"] == Status.UPLOADTOIA_UPLOADING:
+                await collection.update_one({"_id": doc["_id"], "status": Status.UPLOADTOIA_UPLOADING},
+                                            {"$set": {"status": Status.UPLOADTOIA_SPOOLED}, "$unset": LEASE_UNSET})
+        else:
+            await collection.update_one({"_id": doc["_id"], "status": doc["status"]},
+                                        {"$set": {"status": Status.TODO, "spool": None}, "$unset": LEASE_UNSET})
+            stats["requeued"] += 1
+    for task_id in local:
+        result = await collection.update_one(
+            {"_id": ObjectId(task_id), "$or": [
+                {"status": Status.TODO},
+                {"status": Status.UPLOADTOIA_PROCESSING, "lease_until": {"$lt": utcnow()}},
+            ]},
+            {"$set": {"status": Status.UPLOADTOIA_SPOOLED,
+                      "spool": {"id": spool.id, "size": spool.sizes[task_id], "spooled_at": utcnow()}},
+             "$unset": LEASE_UNSET},
+        )
+        if result.modified_count:
+            stats["adopted"] += 1
+        else:
+            spool.remove(task_id)
+            stats["removed"] += 1
+    print(f"reconciled spool {spool.id}: {stats}")
+    return stats
+
+
+async def merge_spool(collection: motor.motor_asyncio.AsyncIOMotorCollection, spool: PdfSpool, orphan: PdfSpool) -> int:
+    """ 没有进程再用的 spool 子目录 (--processes 调小了) 并进 spool，要在 reconcile_spool(spool) 之前调用:
+    先按 orphan 对齐一遍，剩下的任务都是 UPLOADTOIA_SPOOLED 且本地有文件，改指向 spool 再挪目录，最后删掉 orphan。
+    中途退出也不会丢任务: 指向和文件对不上的，下次启动 reconcile_spool 放回 TODO 重新下载 """
+    await reconcile_spool(collection, orphan)
+    merged = 0
+    for task_id in orphan.task_ids():
+        result = await collection.update_one(
+            {"_id": ObjectId(task_id), "status": Status.UPLOADTOIA_SPOOLED, **spool_filter(orphan)},
+            {"$set": {"spool.id": spool.id}},
+        )
+        if result.modified_count:
+            spool.adopt(orphan, task_id)
+            merged += 1
+        else:
+            orphan.remove(task_id)
+    shutil.rmtree(orphan.directory, ignore_errors=True)
+    print(f"merged {merged} tasks from spool {orphan.id} into {spool.id}")
+    return merged
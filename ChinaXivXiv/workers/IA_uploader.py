@@ -1,17 +1,31 @@
 import asyncio
+import datetime
+import hashlib
 import os
 import random
-import time
+import tempfile
 import io
-from typing import Dict, Optional
+from dataclasses import dataclass
+from typing import IO, Dict, List, Optional, Tuple
 import httpx
 
-import internetarchive
+from internetarchive.session import ArchiveSession
 
 import motor.motor_asyncio
-from ChinaXivXiv.defines import ChinaXivGlobalMetadata, ChinaXivHtmlMetadata, Status
-from ChinaXivXiv.mongo_ops import claim_task, update_task
-from ChinaXivXiv.workers.metadata_scraper import get_chinaxivhtmlmetadata_from_html, get_core_html
+from ChinaXivXiv.browse_db import BrowseDbCoalescer, post_browse_db
+from ChinaXivXiv.defines import IA_MULTIPART_THRESHOLD, PDF_SPOOL_MAX_SIZE, ChinaXivHtmlMetadata, Status, Task
+from ChinaXivXiv.exceptions import EmptyContent, PermanentFailure
+from ChinaXivXiv.failures import failure_task_fields
+from ChinaXivXiv.ia_client import IAClient, get_ia_client
+from ChinaXivXiv.ia_index import IAItemIndex, archived_pdf, ia_identifier_of, pdf_name_of
+from ChinaXivXiv.ia_multipart import multipart_upload
+from ChinaXivXiv.indexes import ArticleVersions
+from ChinaXivXiv.metrics import BYTES, step
+from ChinaXivXiv.mongo_ops import LeaseKeeper, claim_task, load_tasks_metadata, update_task
+from ChinaXivXiv.parse_executor import ParseExecutor, get_parse_executor
+
+UPLOAD_METADATA_FIELDS = ("article-id",)
+""" 上传流程只用到 OAI metadata 的这些字段 """
 
 NOTES = """\
 - 元数据由脚本提取，仅供参考，以 ChinaXiv.org 官网为准。（如元数据识别有误/需要更新，请留言）
@@ -20,71 +34,171 @@ NOTES = """\
 - “版本历史”的“下载全文”按钮链接到的是 ChinaXiv.org 的原始链接，未来可能会失效。
 """
 
-async def IA_upload_worker(client: httpx.AsyncClient, collection: motor.motor_asyncio.AsyncIOMotorCollection):
-    while not os.path.exists("stop"):
-        # 1. claim a task
-        TASK = await claim_task(collection, status_from=Status.TODO, status_to=Status.UPLOADTOIA_PROCESSING)
-        if not TASK:
-            print("no task to claim, waiting...")
-            await asyncio.sleep(random.randint(3, 10))
-            continue
-        # 2. process task
-        print(f"PROCESSING id: {TASK.identifier}")
-
-        # curl 'https://global.chinaxiv.org/api/get_browse_db' -X POST -H 'Accept: application/json, text/plain, */*' -H 'Content-Type: application/json; charset=UTF-8' --data-raw '{"domains":[{"value":"chinaxiv_48172","select_value":"id"}],"dbs":["chinaxiv"]}' | jq
-
-        r_global_chinaxiv_metadata_from_get_browse_db = await client.post("https://global.chinaxiv.org/api/get_browse_db", json={
-            "domains": [{"value": TASK.identifier.removeprefix("localIdentifier:"), "select_value": "id"}], # chinaxiv_34185
-            "dbs": ["chinaxiv"]
-        })
-        metadata_from_browse_db_dblist = r_global_chinaxiv_metadata_from_get_browse_db.json()["dbList"]
-        assert len(metadata_from_browse_db_dblist) == 1
-        metadata_from_browse_db = metadata_from_browse_db_dblist[0]
-        assert metadata_from_browse_db["id"] == TASK.identifier.removeprefix("localIdentifier:")
-        version: str = metadata_from_browse_db["version"]
-        assert isinstance(version, str) and version.isdigit()
-
-        print(metadata_from_browse_db)
-
-        chinaxiv_global_metadata = ChinaXivGlobalMetadata(
-            title=TASK.metadata["title"],
-            author=TASK.metadata["author"] if "author" in TASK.metadata else None,
-            keyword=TASK.metadata["keyword"] if "keyword" in TASK.metadata else None,
-            article_id=TASK.metadata["article-id"],
-        )
-        print(chinaxiv_global_metadata.article_id)
-        versions = await collection.count_documents({"metadata.article-id": chinaxiv_global_metadata.article_id})
-        print(f"{TASK.identifier}, {TASK.metadata['article-id'][0]} has {versions} versions, this is version {version}")
-
-
-        chinaxiv_permanent_with_version_url = f"https://chinaxiv.org/abs/{TASK.metadata['article-id'][0]}v{version}"
-        print("CURL", chinaxiv_permanent_with_version_url)
-        headers = {
-            'Connection': 'close', # 对面服务器有点奇葩，HEAD 不会关闭连接……
-        }
-        r_html = await client.get(chinaxiv_permanent_with_version_url, headers=headers, follow_redirects=False)
-        if r_html.status_code == 404:
-            print(f"404, skipping {chinaxiv_permanent_with_version_url}")
-            await update_task(collection, TASK, status=404)
-            continue
-        assert r_html.status_code == 200
-
-        html_metadata = get_chinaxivhtmlmetadata_from_html(html=r_html.content, url=chinaxiv_permanent_with_version_url)
-        core_html = get_core_html(html=r_html.content, url=chinaxiv_permanent_with_version_url)
-
-
-        ia_identifier = await async_upload(client, metadata_from_browse_db, html_metadata, core_html)
-        print(f"uploaded to IA: {ia_identifier}")
-
-        await update_task(collection, TASK, status=Status.UPLOADTOIA_DONE)
-
-def load_ia_keys():
-    """ key_acc, key_sec """
-    with open(".ia_keys", "r") as f:
-        keys = f.read().splitlines()
-    if len(keys) > 2:
-        print("load_ia_keys:", keys[2])
-    return (keys[0], keys[1])
+async def IA_upload_worker(client: httpx.AsyncClient, collection: motor.motor_asyncio.AsyncIOMotorCollection,
+                           parse_executor: Optional[ParseExecutor] = None, lease_keeper: Optional[LeaseKeeper] = None,
+                           article_versions: Optional[ArticleVersions] = None,
+                           browse_db: Optional[BrowseDbCoalescer] = None,
+                           ia_client: Optional[IAClient] = None,
+                           ia_index: Optional[IAItemIndex] = None,
+                           buckets: Optional[List[int]] = None):
+    """ buckets: 只领这些桶里的任务（分片运行），None 表示不限 """
+    parse_executor = parse_executor or get_parse_executor()
+    own_lease_keeper = lease_keeper is None
+    lease_keeper = (lease_keeper or LeaseKeeper(collection)).start()
+    try:
+        while not os.path.exists("stop"):
+            # 1. claim a task
+            try:
+                TASK = await claim_task(collection, status_from=Status.TODO, status_to=Status.UPLOADTOIA_PROCESSING,
+                                        worker_id=lease_keeper.worker_id, buckets=buckets)
+            except Exception as e: # Mongo 暂时不可用 (AutoReconnect、选不到 server)，等一会再领
+                print(f"failed to claim a task: {e!r}, retrying...")
+                await asyncio.sleep(random.uniform(3, 10))
+                continue
+            if not TASK:
+                print("no task to claim, waiting...")
+                await asyncio.sleep(random.randint(3, 10))
+                continue
+            lease_keeper.hold(TASK)
+            try:
+                with step("task"):
+                    await process_upload_task(client, collection, parse_executor, TASK, article_versions, browse_db, ia_client, ia_index)
+            except Exception as e:
+                # 一篇论文出错只影响这一个任务，worker 继续领下一个
+                await record_task_failure(collection, TASK, e)
+            finally:
+                lease_keeper.release(TASK)
+    finally:
+        if own_lease_keeper:
+            lease_keeper.stop()
+
+
+async def record_task_failure(collection: motor.motor_asyncio.AsyncIOMotorCollection, TASK: Task, e: Exception):
+    fields = failure_task_fields(TASK, e)
+    print(f"FAILED id: {TASK.identifier}, {fields['failure']}: {e!r} -> {fields['status']}")
+    try:
+        await update_task(collection, TASK, **fields)
+    except Exception as write_error: # Mongo 也出问题了: 租约过期后 reaper 会把任务放回去
+        print(f"failed to record failure of {TASK.identifier}: {write_error!r}")
+
+
+async def process_upload_task(client: httpx.AsyncClient, collection: motor.motor_asyncio.AsyncIOMotorCollection,
+                              parse_executor: ParseExecutor, TASK: Task,
+                              article_versions: Optional[ArticleVersions] = None,
+                              browse_db: Optional[BrowseDbCoalescer] = None,
+                              ia_client: Optional[IAClient] = None,
+                              ia_index: Optional[IAItemIndex] = None):
+    # 2. process task
+    print(f"PROCESSING id: {TASK.identifier}")
+
+    if archived := await find_archived(ia_index, TASK):
+        await update_task(collection, TASK, **archived_task_fields(archived))
+        return
+    await load_tasks_metadata(collection, [TASK], UPLOAD_METADATA_FIELDS)
+
+    metadata_from_browse_db = await get_browse_db(client, TASK, browse_db)
+    version: str = metadata_from_browse_db["version"]
+    if archived := await find_archived(ia_index, TASK, version):
+        await update_task(collection, TASK, **archived_task_fields(archived))
+        return
+    await count_versions(collection, TASK, version, article_versions)
+
+    chinaxiv_permanent_with_version_url, abs_html = await fetch_abs_page(client, TASK, version)
+
+    html_metadata, core_html = await parse_executor.parse_abs_page(html=abs_html, url=chinaxiv_permanent_with_version_url)
+
+
+    ia_identifier, ia_files = await async_upload(client, metadata_from_browse_db, html_metadata, core_html, ia_client)
+    print(f"uploaded to IA: {ia_identifier}")
+
+    # 交给 IA_verify_worker 批量确认 item 已创建
+    await update_task(collection, TASK, **uploaded_task_fields(ia_identifier, ia_files))
+
+
+async def find_archived(ia_index: Optional[IAItemIndex], TASK: Task, version: Optional[str] = None,
+                        md5: Optional[str] = None) -> Optional[Dict]:
+    """ 查本地 IA item 索引，item 里有这个版本的 PDF (见 archived_pdf) 才算已归档，返回索引条目。
+    不带 version 时按 chinaxiv_id 查（不请求任何上游），带 version 时按 IA identifier 查 """
+    if ia_index is None:
+        return None
+    if version is None:
+        item = await ia_index.find_by_chinaxiv_id(TASK.identifier)
+    else:
+        item = await ia_index.find_by_identifier(ia_identifier_of(TASK.metadata["article-id"][0], version))
+    if item is None:
+        return None
+    if archived_pdf(item, md5) is None:
+        print(f"{item['_id']} exists on IA but without {pdf_name_of(item['_id'])}, not skipping {TASK.identifier}")
+        return None
+    print(f"already archived: {TASK.identifier} -> {item['_id']}, skipping")
+    return item
+
+
+async def get_browse_db(client: httpx.AsyncClient, TASK: Task, browse_db: Optional[BrowseDbCoalescer] = None) -> Dict:
+    chinaxiv_id = TASK.identifier.removeprefix("localIdentifier:") # chinaxiv_34185
+    with step("browse_db"):
+        if browse_db is not None:
+            metadata_from_browse_db = await browse_db.get(chinaxiv_id)
+        else:
+            metadata_from_browse_db_dblist = await post_browse_db(client, [chinaxiv_id])
+            if not metadata_from_browse_db_dblist:
+                raise EmptyContent(f"{chinaxiv_id} not in get_browse_db dbList")
+            metadata_from_browse_db = metadata_from_browse_db_dblist[0]
+    if metadata_from_browse_db.get("id") != chinaxiv_id:
+        raise PermanentFailure(f"get_browse_db returned {metadata_from_browse_db.get('id')!r} for {chinaxiv_id}")
+    version = metadata_from_browse_db.get("version")
+    if not (isinstance(version, str) and version.isdigit()):
+        raise PermanentFailure(f"get_browse_db returned version {version!r} for {chinaxiv_id}")
+
+    print(metadata_from_browse_db)
+    return metadata_from_browse_db
+
+
+async def count_versions(collection: motor.motor_asyncio.AsyncIOMotorCollection, TASK: Task, version: str,
+                         article_versions: Optional[ArticleVersions] = None) -> int:
+    assert TASK.metadata is not None
+    article_id = TASK.metadata["article-id"]
+    print(article_id)
+    if article_versions is not None:
+        versions = await article_versions.count(article_id)
+    else:
+        versions = await collection.count_documents({"metadata.article-id": article_id})
+    print(f"{TASK.identifier}, {TASK.metadata['article-id'][0]} has {versions} versions, this is version {version}")
+    return versions
+
+
+async def fetch_abs_page(client: httpx.AsyncClient, TASK: Task, version: str) -> Tuple[str, bytes]:
+    """ -> (url, html)，404 抛 EmptyContent """
+    chinaxiv_permanent_with_version_url = f"https://chinaxiv.org/abs/{TASK.metadata['article-id'][0]}v{version}"
+    print("CURL", chinaxiv_permanent_with_version_url)
+    with step("abs_page"): # 复用连接；HEAD 的 Connection: close 由 http_client.HostProfileTransport 处理
+        r_html = await client.get(chinaxiv_permanent_with_version_url, follow_redirects=False)
+    if r_html.status_code == 404:
+        raise EmptyContent(f"404: {chinaxiv_permanent_with_version_url}")
+    r_html.raise_for_status()
+    BYTES.inc(len(r_html.content), step="abs_page", direction="in")
+    return chinaxiv_permanent_with_version_url, r_html.content
+
+
+def uploaded_task_fields(ia_identifier: str, ia_files: Optional[List[Dict]] = None) -> Dict:
+    """ ia_files: [{"name", "md5"}]，确认上传成功后由 IA_verify_worker 记入 IAItemIndex """
+    fields = {
+        "status": Status.UPLOADTOIA_VERIFYING,
+        "ia_identifier": ia_identifier,
+        "uploaded_at": datetime.datetime.now(datetime.timezone.utc),
+    }
+    if ia_files is not None:
+        fields["ia_files"] = ia_files
+    return fields
+
+
+def archived_task_fields(item: Dict) -> Dict:
+    """ item: IAItemIndex 条目，IA 上早就有了，不用再验证 """
+    return {
+        "status": Status.UPLOADTOIA_DONE,
+        "ia_identifier": item["_id"],
+        "already_archived": True,
+    }
 
 """
 {
@@ -111,7 +225,31 @@ def load_ia_keys():
 """
 
 
-async def async_upload(client: httpx.AsyncClient, metadata_from_browse_db: Dict, html_metadata: ChinaXivHtmlMetadata, core_html: str):
+@dataclass
+class IAUpload:
+    identifier: str
+    metadata: Dict
+    pdf_url: str
+    file_name: str
+    core_html: Optional[str]
+    core_html_filename: Optional[str]
+
+
+async def async_upload(client: httpx.AsyncClient, metadata_from_browse_db: Dict, html_metadata: ChinaXivHtmlMetadata, core_html: str,
+                       ia_client: Optional[IAClient] = None) -> Tuple[str, List[Dict]]:
+    """ -> (IA identifier, [{"name", "md5"}]) """
+    upload = build_ia_upload(metadata_from_browse_db, html_metadata, core_html)
+    pdf = await download_pdf(client, upload.pdf_url)
+    try:
+        await do_upload(upload.identifier, upload.metadata,
+                        upload.core_html, upload.core_html_filename,
+                        pdf, upload.file_name, ia_client)
+    finally:
+        pdf.close()
+    return upload.identifier, [{"name": upload.file_name, "md5": pdf.md5}]
+
+
+def build_ia_upload(metadata_from_browse_db: Dict, html_metadata: ChinaXivHtmlMetadata, core_html: str) -> IAUpload:
     assert html_metadata, "metadata is None"
     assert f'{html_metadata.csoaid}v{html_metadata.version}.pdf'
     
@@ -153,7 +291,7 @@ async def async_upload(client: httpx.AsyncClient, metadata_from_browse_db: Dict,
         # vvvv custom metadata field vvvv
 
         "chinaxiv": html_metadata.csoaid, # == chinaxiv_csoaid, so we can just search "chinaxiv:yyyymm.nnnnnn" to get the item on IA
-        "chinaxiv_id": html_metadata.chinaxiv_id, # each version has a unique id, even if they have the same csoaid
+        "chinaxiv_id": str(html_metadata.chinaxiv_id), # S3 元数据头只能是 str | each version has a unique id, even if they have the same csoaid
         "chinaxiv_copyQuotation": html_metadata.copyQuotation, # 推荐引用格式 | suggested citation format
     }
     if html_metadata.journal:
@@ -168,95 +306,85 @@ async def async_upload(client: httpx.AsyncClient, metadata_from_browse_db: Dict,
     # https://chinaxiv.org/businessFile/201601/201601.00051v1/201601.00051v1.pdf
     # https://chinaxiv.org/businessFile/202406/202406.00122v1/202406.00122v1.pdf
     url = f"https://chinaxiv.org/businessFile/{html_metadata.csoaid.split('.')[0]}/{html_metadata.csoaid}v{html_metadata.version}/{html_metadata.csoaid}v{html_metadata.version}.pdf"
+    return IAUpload(identifier=identifier, metadata=metadata, pdf_url=url, file_name=file_name,
+                    core_html=core_html, core_html_filename=core_html_filename)
+
+
+@dataclass
+class DownloadedPDF:
+    file: IO[bytes]
+    """ SpooledTemporaryFile，小于 PDF_SPOOL_MAX_SIZE 时在内存里，否则落盘 """
+    size: int
+    md5: str
+    sha256: str
+    resume_path: Optional[str] = None
+    """ multipart 上传的断点记录。只有 spool 里的 PDF 重启后还在，才值得记 """
+
+    def close(self):
+        self.file.close()
+
+async def download_pdf(client: httpx.AsyncClient, url: str, spool_max_size: int = PDF_SPOOL_MAX_SIZE,
+                       file: Optional[IO[bytes]] = None) -> DownloadedPDF:
+    """ 流式下载，边写边算 MD5/SHA-256，内存占用与 PDF 大小无关。
+    file: 写进这个文件 (PdfSpool 里的)，默认写 SpooledTemporaryFile """
     print(f"downloading {url}")
-    r = await client.get(url)
-    print(f"downloaded {url}, status_code: {r.status_code}, content_length: {len(r.content)}")
-    assert r.status_code == 200
-    file_content = r.content
-    # pprint(metadata)
-    # asset it's pdf
-    assert file_content[:4] == b'%PDF'
-
-    await do_upload(identifier, metadata,
-                    core_html, core_html_filename,
-                    file_content, file_name)
-    await wait_until_ia_item_is_ready(identifier)
-    return identifier
+    spool = file if file is not None else tempfile.SpooledTemporaryFile(max_size=spool_max_size)
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    size = 0
+    head = b''
+    try:
+        with step("pdf_download"):
+            async with client.stream("GET", url) as r:
+                if r.status_code == 404:
+                    raise EmptyContent(f"404: {url}")
+                r.raise_for_status()
+                async for chunk in r.aiter_bytes():
+                    if len(head) < 4:
+                        head += chunk[:4 - len(head)]
+                        # asset it's pdf
+                        if len(head) == 4 and head != b'%PDF':
+                            raise PermanentFailure(f"not a PDF: {head!r}")
+                    md5.update(chunk)
+                    sha256.update(chunk)
+                    spool.write(chunk)
+                    size += len(chunk)
+        if head != b'%PDF':
+            raise PermanentFailure(f"not a PDF: {head!r}")
+        spool.seek(0)
+    except BaseException:
+        spool.close()
+        raise
+    BYTES.inc(size, step="pdf_download", direction="in")
+    print(f"downloaded {url}, status_code: {r.status_code}, content_length: {size}")
+    return DownloadedPDF(file=spool, size=size, md5=md5.hexdigest(), sha256=sha256.hexdigest())
 
 async def do_upload(identifier: str, metadata: Dict,
                     core_html: Optional[str], core_html_filename: Optional[str],
-                    file_content: bytes, file_name: str):
-    loop = asyncio.get_running_loop()
-    task = loop.run_in_executor(None, _do_upload,
-                                identifier, metadata,
-                                core_html, core_html_filename,
-                                file_content, file_name)
-    await task
-    return task.result()
-                    
-
-
-def _do_upload(identifier: str, metadata: Dict,
+                    pdf: DownloadedPDF, file_name: str, ia_client: Optional[IAClient] = None):
+    with step("ia_upload"):
+        result = await (ia_client or get_ia_client()).run(_do_upload,
+                                                          identifier, metadata,
+                                                          core_html, core_html_filename,
+                                                          pdf, file_name)
+    BYTES.inc(pdf.size + (len(core_html.encode("utf-8")) if core_html and core_html_filename else 0),
+              step="ia_upload", direction="out")
+    return result
+
+
+def _do_upload(ia: ArchiveSession, identifier: str, metadata: Dict,
                core_html: Optional[str], core_html_filename: Optional[str],
-               file_content: bytes, file_name: str):
-    ia = internetarchive.get_session()
-    ia.access_key, ia.secret_key = load_ia_keys()
+               pdf: DownloadedPDF, file_name: str):
     item = ia.get_item(identifier)
-    files = {
-        file_name: io.BytesIO(file_content),
-    }
+    if IA_MULTIPART_THRESHOLD and pdf.size >= IA_MULTIPART_THRESHOLD:
+        # 大文件分块并发上传，失败只重传失败的块
+        resps = [multipart_upload(ia, identifier, file_name, pdf.file, pdf.size, pdf.md5, metadata=metadata,
+                                  state_path=pdf.resume_path)]
+    else:
+        # Content-MD5: 让 IA 那边校验收到的文件
+        resps = item.upload({file_name: pdf.file}, metadata=metadata, headers={"Content-MD5": pdf.md5}, verbose=True)
     if core_html_filename:
         assert core_html is not None
-        files[core_html_filename] = io.BytesIO(core_html.encode("utf-8"))
-    resps = item.upload(files, metadata=metadata, verbose=True)
+        resps += item.upload({core_html_filename: io.BytesIO(core_html.encode("utf-8"))}, verbose=True)
     print(resps)
     return resps
-
-async def wait_until_ia_item_is_ready(identifier: str):
-    loop = asyncio.get_running_loop()
-    task = loop.run_in_executor(None, _wait_until_ia_item_is_ready, identifier)
-    await task
-    return task.result()
-
-def _wait_until_ia_item_is_ready(identifier: str):
-
-    # for testing
-    if identifier.startswith("//RETURN_TRUE/"):
-        return True
-    if identifier.startswith("//RETURN_FALSE/"):
-        return False
-    if identifier.startswith("//RAISE_EXCEPTION/"):
-        raise NotImplementedError("test exception")
-    
-    
-    ia = internetarchive.get_session()
-    item = ia.get_item(identifier) # refresh item
-    tries = 400
-    for tries_left in range(tries, 0, -1):
-        if item.exists:
-            break
-
-        print(f"Waiting for item to be created ({tries_left} tries left)  ...", end='\r')
-        if tries < 395:
-            print(f"IA overloaded, still waiting for item to be created ({tries_left} tries left)  ...", end='\r')
-        time.sleep(30)
-        item = ia.get_item(identifier)
-
-    if not item.exists:
-        raise TimeoutError(f"IA overloaded, item still not created after {400 * 30} seconds")
-
-    print(f"item {identifier} is ready")
-    return True
-
-if __name__ == "__main__":
-    async def tese_wait_until_ia_item_is_ready():
-        assert await wait_until_ia_item_is_ready("//RETURN_TRUE/STWP") is True
-        assert await wait_until_ia_item_is_ready("//RETURN_FALSE/STWP") is False
-        try:
-            await wait_until_ia_item_is_ready("//RAISE_EXCEPTION/STWP")
-        except NotImplementedError:
-            pass
-        else:
-            raise AssertionError("test failed")
-
-    asyncio.run(tese_wait_until_ia_item_is_ready())
\ No newline at end of file
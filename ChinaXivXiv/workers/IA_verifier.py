@@ -0,0 +1,226 @@
+import asyncio
+import datetime
+import os
+from typing import Dict, Iterable, List, Optional, Set
+
+import httpx
+import motor.motor_asyncio
+
+from ChinaXivXiv.defines import IA_METADATA_URL, IA_SEARCH_URL, Status, Task
+from ChinaXivXiv.exceptions import ItemNotCreated
+from ChinaXivXiv.failures import failure_task_fields
+from ChinaXivXiv.ia_index import IAItemIndex
+from ChinaXivXiv.metrics import STEP_SECONDS, TASKS, step
+from ChinaXivXiv.mongo_ops import status_filter
+
+VERIFY_TIMEOUT = datetime.timedelta(seconds=400 * 30)
+""" 上传后这么久 /metadata 里仍然没有 item，按临时失败重新排队 (failure_task_fields 退避，超过 MAX_ATTEMPTS 才 FAIL) """
+METADATA_CHECK_AFTER = datetime.timedelta(minutes=10)
+""" 上传后这么久还搜不到，就逐个查 /metadata 确认。IA 过载时搜索索引比建 item 慢得多 """
+
+
+def check_test_hook(identifier: str) -> Optional[bool]:
+    # for testing
+    if identifier.startswith("//RETURN_TRUE/"):
+        return True
+    if identifier.startswith("//RETURN_FALSE/"):
+        return False
+    if identifier.startswith("//RAISE_EXCEPTION/"):
+        raise NotImplementedError("test exception")
+    return None
+
+
+async def find_ready_items(client: httpx.AsyncClient, identifiers: Iterable[str], search_url: str = IA_SEARCH_URL) -> Set[str]:
+    """ 一次 advancedsearch 查询一批 identifier，返回其中 IA 上已存在的 """
+    ready = set()
+    to_query = []
+    for identifier in identifiers:
+        hook = check_test_hook(identifier)
+        if hook is None:
+            to_query.append(identifier)
+        elif hook:
+            ready.add(identifier)
+    if not to_query:
+        return ready
+
+    q = "identifier:(" + " OR ".join(f'"{identifier}"' for identifier in to_query) + ")"
+    r = await client.get(search_url, params={
+        "q": q,
+        "fl[]": "identifier",
+        "rows": len(to_query),
+        "output": "json",
+    })
+    r.raise_for_status()
+    ready.update(doc["identifier"] for doc in r.json()["response"]["docs"])
+    return ready
+
+
+async def find_existing_items(client: httpx.AsyncClient, identifiers: Iterable[str],
+                              metadata_url: str = IA_METADATA_URL, concurrency: int = 8) -> Dict[str, Optional[bool]]:
+    """ 逐个查 /metadata/{identifier}，不经过搜索索引。-> {identifier: 是否存在}，查询出错的是 None """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def check(identifier: str) -> Optional[bool]:
+        try:
+            async with semaphore:
+                r = await client.get(f"{metadata_url}/{identifier}")
+            r.raise_for_status()
+            return bool(r.json().get("metadata")) # 不存在的 item 返回 {}
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"find_existing_items: {identifier}: {e!r}")
+            return None
+
+    identifiers = list(identifiers)
+    return dict(zip(identifiers, await asyncio.gather(*(check(identifier) for identifier in identifiers))))
+
+
+async def IA_verify_worker(client: httpx.AsyncClient, collection: motor.motor_asyncio.AsyncIOMotorCollection,
+                           batch_size: int = 100, min_interval: float = 10, max_interval: float = 300,
+                           search_url: str = IA_SEARCH_URL, metadata_url: str = IA_METADATA_URL, run_once: bool = False,
+                           ia_index: Optional[IAItemIndex] = None,
+                           buckets: Optional[List[int]] = None):
+    """ 单个协程轮询所有 UPLOADTOIA_VERIFYING 任务。
+    本轮有 item 就绪就缩短间隔，全都没就绪（IA 过载）就翻倍退避。
+    先用 advancedsearch 一批查；上传超过 METADATA_CHECK_AFTER 还搜不到的再查 /metadata，以它为准。
+    确认就绪的 item 记入 ia_index，之后重跑时直接跳过 """
+    interval = min_interval
+    while not os.path.exists("stop"):
+        try:
+            # 最久没检查过的排前面，避免卡住的 item 一直占着 batch
+            pending = await collection.find(
+                status_filter(Status.UPLOADTOIA_VERIFYING, buckets),
+                projection={"_id": 1, "identifier": 1, "ia_identifier": 1, "uploaded_at": 1, "ia_files": 1,
+                            "metadata.article-id": 1, "datestamp": 1, "attempts": 1},
+                sort=[("verify_checked_at", 1)],
+                limit=batch_size,
+            ).to_list(length=batch_size)
+            if pending:
+                with step("ia_verify"):
+                    ready = await find_ready_items(client, (doc["ia_identifier"] for doc in pending), search_url=search_url)
+                now = datetime.datetime.now(datetime.timezone.utc)
+                for doc in pending:
+                    uploaded_at = doc.get("uploaded_at") or now
+                    if uploaded_at.tzinfo is None: # pymongo 默认返回 naive UTC
+                        uploaded_at = uploaded_at.replace(tzinfo=datetime.timezone.utc)
+                    doc["uploaded_at"] = uploaded_at
+                existing: Dict[str, Optional[bool]] = {}
+                to_check = [doc["ia_identifier"] for doc in pending
+                            if doc["ia_identifier"] not in ready and now - doc["uploaded_at"] > METADATA_CHECK_AFTER
+                            and check_test_hook(doc["ia_identifier"]) is None]
+                if to_check:
+                    with step("ia_verify_metadata"):
+                        existing = await find_existing_items(client, to_check, metadata_url=metadata_url)
+                    ready.update(identifier for identifier, exists in existing.items() if exists)
+                existing.update((doc["ia_identifier"], False) for doc in pending
+                                if check_test_hook(doc["ia_identifier"]) is False)
+                done_ids, fail_docs, waiting_ids = [], [], []
+                archived = []
+                for doc in pending:
+                    uploaded_at = doc["uploaded_at"]
+                    if doc["ia_identifier"] in ready:
+                        done_ids.append(doc["_id"])
+                        # 上传完到 IA 上能搜到的等待时间（精度受轮询间隔限制）
+                        STEP_SECONDS.observe((now - uploaded_at).total_seconds(), step="ia_ready")
+                        archived.append({
+                            "identifier": doc["ia_identifier"],
+                            "chinaxiv": doc.get("metadata", {}).get("article-id", [None])[0],
+                            "chinaxiv_id": doc.get("identifier"),
+                            "files": doc.get("ia_files"),
+                        })
+                    elif now - uploaded_at > VERIFY_TIMEOUT and existing.get(doc["ia_identifier"]) is False:
+                        print(f"IA overloaded, item {doc['ia_identifier']} still not created after {VERIFY_TIMEOUT}")
+                        fail_docs.append(doc)
+                    else:
+                        waiting_ids.append(doc["_id"])
+                for doc in fail_docs:
+                    await record_verify_timeout(collection, doc)
+                for ids, update in (
+                    (done_ids, {"status": Status.UPLOADTOIA_DONE}),
+                    (waiting_ids, {"verify_checked_at": now}),
+                ):
+                    if ids:
+                        await collection.update_many({"_id": {"$in": ids}}, {"$set": update})
+                        if "status" in update:
+                            TASKS.inc(len(ids), status=update["status"])
+                if ia_index is not None:
+                    await ia_index.record_many(archived)
+                print(f"verified {len(pending)} items: {len(done_ids)} ready, {len(fail_docs)} timed out, {len(waiting_ids)} waiting")
+                interval = max(min_interval, interval / 2) if done_ids else min(max_interval, interval * 2)
+            else:
+                interval = min(max_interval, interval * 2)
+        except Exception as e: # advancedsearch 5xx/超时 (IA 过载时常见) 或 Mongo 出错: 按没就绪处理，退避
+            interval = min(max_interval, interval * 2)
+            print(f"IA_verify_worker: {e!r}, retrying in {interval}s")
+
+        if run_once:
+            return
+        await asyncio.sleep(interval)
+
+
+async def record_verify_timeout(collection: motor.motor_asyncio.AsyncIOMotorCollection, doc: Dict):
+    """ 和上传失败一样分类、退避: 放回 TODO 重新上传，失败 MAX_ATTEMPTS 次后才 FAIL """
+    TASK = Task(_id=doc["_id"], identifier=doc.get("identifier", ""), status=Status.UPLOADTOIA_VERIFYING,
+                datestamp=doc.get("datestamp", ""), attempts=doc.get("attempts", 0))
+    fields = failure_task_fields(TASK, ItemNotCreated(f"{doc['ia_identifier']} not created after {VERIFY_TIMEOUT}"))
+    result = await collection.update_one({"_id": doc["_id"], "status": Status.UPLOADTOIA_VERIFYING}, {"$set": fields})
+    if result.modified_count:
+        TASKS.inc(status=fields["status"])
+
+
+if __name__ == "__main__":
+    from ChinaXivXiv.bench.fake_ia import FakeIA
+
+    async def test_find_ready_items():
+        fake_ia = FakeIA().start()
+        try:
+            fake_ia.add_item("ChinaXiv-202311.00077V1")
+            async with httpx.AsyncClient() as client:
+                search_url = f"{fake_ia.base_url}/advancedsearch.php"
+                ready = await find_ready_items(client, [
+                    "//RETURN_TRUE/STWP", "//RETURN_FALSE/STWP",
+                    "ChinaXiv-202311.00077V1", "ChinaXiv-202311.00078V1",
+                ], search_url=search_url)
+                assert ready == {"//RETURN_TRUE/STWP", "ChinaXiv-202311.00077V1"}, ready
+                assert fake_ia.requests["/advancedsearch.php"] == 1 # 一批只查一次
+                try:
+                    await find_ready_items(client, ["//RAISE_EXCEPTION/STWP"], search_url=search_url)
+                except NotImplementedError:
+                    pass
+                else:
+                    raise AssertionError("test failed")
+        finally:
+            fake_ia.stop()
+
+    async def test_verify_worker():
+        from bson import ObjectId
+        from mongomock_motor import AsyncMongoMockClient
+
+        fake_ia = FakeIA(search_lag=3600).start() # 建好了，但搜索索引还没跟上
+        try:
+            fake_ia.add_item("created")
+            collection = AsyncMongoMockClient()["chinaxiv"]["global_chinaxiv"]
+            now = datetime.datetime.now(datetime.timezone.utc)
+            docs = {
+                "created": now - METADATA_CHECK_AFTER * 2,
+                "missing": now - VERIFY_TIMEOUT * 2,
+                "recent": now,
+            }
+            for identifier, uploaded_at in docs.items():
+                await collection.insert_one({"_id": ObjectId(), "identifier": identifier, "ia_identifier": identifier,
+                                             "status": Status.UPLOADTOIA_VERIFYING, "uploaded_at": uploaded_at,
+                                             "datestamp": "2020-01-01"})
+            async with httpx.AsyncClient() as client:
+                await IA_verify_worker(client, collection, run_once=True,
+                                       search_url=f"{fake_ia.base_url}/advancedsearch.php",
+                                       metadata_url=f"{fake_ia.base_url}/metadata")
+            result = {doc["identifier"]: doc async for doc in collection.find()}
+            assert result["created"]["status"] == Status.UPLOADTOIA_DONE
+            assert result["missing"]["status"] == Status.TODO and result["missing"]["attempts"] == 1 # 退避后重传，不是 FAIL
+            assert result["recent"]["status"] == Status.UPLOADTOIA_VERIFYING
+            assert fake_ia.requests.get("/metadata/recent") is None # 还在宽限期内，只看搜索
+        finally:
+            fake_ia.stop()
+
+    asyncio.run(test_find_ready_items())
+    asyncio.run(test_verify_worker())
+    print("ok")
@@ -1,8 +1,12 @@
+import re
+from typing import List, Optional, Tuple
+from urllib.parse import urljoin
+
 from bs4 import BeautifulSoup, element
 
 import httpx
 
-from ChinaXivXiv.defines import ChinaXivHtmlMetadata
+from ChinaXivXiv.defines import HTML_PARSER, ChinaXivHtmlMetadata
 
 
 
@@ -26,6 +30,10 @@ def parse_info_from_html(html: bytes):
     version = form.find("input", {"id": "version"}).get("value") # type: ignore
     csoaid = form.find("input", {"id": "csoaid"}).get("value") # type: ignore
 
+    return check_info(fileid, title, version, csoaid)
+
+
+def check_info(fileid, title, version, csoaid):
     assert fileid is not None and isinstance(fileid, str) and fileid.isdigit()
     assert title is not None and isinstance(title, str)
     assert version is not None and isinstance(version, str) and version.isdigit()
@@ -108,10 +116,53 @@ def parse_authors_from_copyQuotation(copyQuotation: str):
         prefer_identifier = None
 
     return authors, pubyear, title, journal, prefer_identifier
-    
+
+
+_AUTHOR_SEPARATOR = re.compile(r",(?! )")
+""" 逗号后面有空格的是人名的一部分 (Crawford, D. F.)，不分割 """
+
+def parse_copyQuotation(copyQuotation: str):
+    """ 与 parse_authors_from_copyQuotation 结果一致，但只用 find 定位一次各个分隔符，不逐字符拼字符串、不反复 split。
+    -> (authors, pubyear, title, journal, prefer_identifier) """
+    start = copyQuotation.find(".(")
+    authors_text = copyQuotation if start < 0 else copyQuotation[:start]
+
+    authors: Optional[List[str]] = []
+    if authors_text:
+        authors = _AUTHOR_SEPARATOR.split(authors_text[:-1] if authors_text.endswith(",") else authors_text)
+        if not authors[-1]:
+            authors.pop()
+        if not authors:
+            authors = None
+
+    if start < 0:
+        return authors, None, None, None, None
+
+    rest = copyQuotation[start + 2:]
+    # pubyear 只在下一个 ".(" 之前找
+    year_end = rest.find(".(")
+    if year_end < 0:
+        year_end = len(rest)
+    close = rest.find(").", 0, year_end)
+    digits = "".join(char for char in rest[:year_end if close < 0 else close] if char.isdigit())
+    try:
+        pubyear = int(digits) if digits else None
+    except ValueError: # "²" 之类 isdigit() 为真但 int() 不认的字符
+        pubyear = None
+
+    close = rest.find(").")
+    text_after_pubyear = "" if close < 0 else rest[close + 2:]
+    dot1 = text_after_pubyear.find(".")
+    if dot1 < 0:
+        return authors, pubyear, text_after_pubyear or None, None, None
+    dot2 = text_after_pubyear.find(".", dot1 + 1)
+    title = text_after_pubyear[:dot1] or None
+    journal = text_after_pubyear[dot1 + 1:] if dot2 < 0 else text_after_pubyear[dot1 + 1:dot2]
+    prefer_identifier = None if dot2 < 0 else text_after_pubyear[dot2 + 1:]
+    return authors, pubyear, title, journal or None, prefer_identifier or None
+
 
 def get_core_html(html: bytes, url: str):
-    from urllib.parse import urljoin
     soup = BeautifulSoup(html, "html.parser")
     # .paper > .flex_item content > .hd
     core_html = soup.find("div", {"class": "paper"}).find("div", {"class": "flex_item content"}).find("div", {"class": "hd"}) # type: ignore
@@ -133,10 +184,8 @@ def get_core_html(html: bytes, url: str):
     for a in core_html.find_all("a"):
         if a.get("href", "").startswith("/"):
             a["href"] = urljoin(url, a["href"])
-        with open("core.html", "w") as f:
-            # 最小化输出
-            f.write(core_html.prettify(formatter="minimal"))
-            
+
+    # 最小化输出
     return core_html.prettify(formatter="minimal")
 
 
@@ -162,27 +211,168 @@ def parse_keywords(html: bytes):
             keywords.append(a.text.strip())
     return keywords            
 
+PARSER_BACKENDS = ("lxml", "selectolax", "html.parser")
+
+def resolve_parser_backend(backend: Optional[str] = None) -> str:
+    """ auto: 优先 lxml，没装就退回 html.parser。selectolax 输出的 core_html 未 prettify，需显式指定 """
+    backend = backend or HTML_PARSER
+    if backend == "auto":
+        try:
+            import lxml # noqa: F401
+            return "lxml"
+        except ImportError:
+            return "html.parser"
+    assert backend in PARSER_BACKENDS, f"unknown html parser backend: {backend}"
+    return backend
+
+
+CORE_INFO_INPUT_IDS = ("id", "title", "version", "csoaid")
+
+class AbsPage:
+    """ abstract 页面只解析一次，一并取出 ChinaXivHtmlMetadata 所需字段和清理后的 core_html """
+    def __init__(self, html: bytes, url: str, backend: Optional[str] = None, with_core_html: bool = True):
+        """ with_core_html=False: 只要元数据（回填时），跳过 core_html 的清理和序列化 """
+        self.url = url
+        self.backend = resolve_parser_backend(backend)
+        self.with_core_html = with_core_html
+        self.info: dict = {}
+        """ form1 里的 id/title/version/csoaid """
+        self.copyQuotation: Optional[str] = None
+        self.subjects: List[str] = []
+        self.keywords: List[str] = []
+        self.core_html: Optional[str] = None
+
+        if self.backend == "selectolax":
+            self._parse_selectolax(html)
+        else:
+            self._parse_bs4(html)
+
+    def _collect_a(self, href: str, text: str):
+        if "field=subject" in href or "field=domain" in href:
+            self.subjects.append(text.strip())
+        if "field=keywords" in href:
+            self.keywords.append(text.strip())
+
+    def _parse_bs4(self, html: bytes):
+        soup = BeautifulSoup(html, self.backend)
+        paper = None
+        for tag in soup.find_all(True): # 只遍历一次 DOM
+            if tag.name == "a":
+                if tag.get("href", ""):
+                    self._collect_a(tag["href"], tag.text)
+            elif tag.name == "input":
+                input_id = tag.get("id")
+                if input_id in CORE_INFO_INPUT_IDS and input_id not in self.info \
+                    and tag.find_parent("form", {"id": "form1"}) is not None:
+                    self.info[input_id] = tag.get("value")
+            elif tag.name == "span":
+                if self.copyQuotation is None and tag.get("id") == "copyQuotation":
+                    self.copyQuotation = tag.text.strip()
+            elif tag.name == "div":
+                if paper is None and "paper" in tag.get("class", []):
+                    paper = tag
+
+        assert paper is not None
+        if not self.with_core_html:
+            return
+        # .paper > .flex_item content > .hd
+        core_html = paper.find("div", {"class": "flex_item content"}).find("div", {"class": "hd"}) # type: ignore
+        assert isinstance(core_html, element.Tag)
+        # 删带有 "相关论文推荐" 字样的 ft
+        for ft in core_html.find_all("div", {"class": "ft"}):
+            if "相关论文推荐" in ft.text:
+                ft.decompose()
+        # 删“点击复制”span copyBtn
+        for copyBtn in core_html.find_all("span", {"id": "copyBtn"}):
+            copyBtn.decompose()
+        # 删除 div id="journalSelect"
+        for journalSelect in core_html.find_all("div", {"id": "journalSelect"}):
+            journalSelect.decompose()
+        # 将相对链接转换为绝对链接
+        for a in core_html.find_all("a"):
+            if a.get("href", "").startswith("/"):
+                a["href"] = urljoin(self.url, a["href"])
+
+        self.core_html = core_html.prettify(formatter="minimal")
+
+    def _parse_selectolax(self, html: bytes):
+        from selectolax.lexbor import LexborHTMLParser
+        tree = LexborHTMLParser(html)
+
+        form = tree.css_first("form#form1")
+        assert form is not None
+        for input_id in CORE_INFO_INPUT_IDS:
+            node = form.css_first(f'input[id="{input_id}"]')
+            self.info[input_id] = node.attributes.get("value") if node is not None else None
+
+        copyQuotation = tree.css_first("span#copyQuotation")
+        if copyQuotation is not None:
+            self.copyQuotation = copyQuotation.text().strip()
+
+        for a in tree.css("a[href]"):
+            self._collect_a(a.attributes.get("href") or "", a.text())
+
+        if not self.with_core_html:
+            return
+        core_html = tree.css_first('div.paper div[class="flex_item content"] div.hd')
+        assert core_html is not None
+        for ft in core_html.css("div.ft"):
+            if "相关论文推荐" in ft.text():
+                ft.decompose()
+        for node in core_html.css("span#copyBtn, div#journalSelect"):
+            node.decompose()
+        for a in core_html.css("a[href]"):
+            href = a.attributes.get("href") or ""
+            if href.startswith("/"):
+                a.attrs["href"] = urljoin(self.url, href)
+
+        self.core_html = core_html.html
+
+    def metadata(self) -> ChinaXivHtmlMetadata:
+        fileid, _, version, csoaid = check_info(*(self.info.get(k) for k in CORE_INFO_INPUT_IDS))
+        assert self.copyQuotation is not None
+        authors, pubyear, title, journal, prefer_identifier = parse_copyQuotation(self.copyQuotation)
+        return ChinaXivHtmlMetadata(
+            chinaxiv_id=int(fileid),
+            title=title,
+            authors=authors,
+            journal=journal,
+            pubyear=pubyear,
+            version=version,
+            csoaid=csoaid,
+            copyQuotation=self.copyQuotation,
+            subjects=self.subjects,
+            keywords=self.keywords,
+            prefer_identifier=prefer_identifier
+        )
+
+
+def parse_abs_page(html: bytes, url: str, backend: Optional[str] = None) -> Tuple[ChinaXivHtmlMetadata, str]:
+    """ -> (html_metadata, core_html) """
+    page = AbsPage(html, url, backend=backend)
+    metadata = page.metadata()
+    assert page.core_html is not None
+    return metadata, page.core_html
+
 def get_chinaxivhtmlmetadata_from_html(html: bytes, url: str):
-    fileid, title, version, csoaid = parse_info_from_html(html)
-    copyQuotation = get_copyQuotation(html)
-    authors, pubyear, title, journal, prefer_identifier = parse_authors_from_copyQuotation(copyQuotation)
-    core_html = get_core_html(html, url)
-    metadata = ChinaXivHtmlMetadata(
-        chinaxiv_id=int(fileid),
-        title=title,
-        authors=authors,
-        journal=journal,
-        pubyear=pubyear,
-        version=version,
-        csoaid=csoaid,
-        copyQuotation=copyQuotation,
-        subjects=parse_subjects(html),
-        keywords=parse_keywords(html),
-        prefer_identifier=prefer_identifier
-    )
-    return metadata
+    return parse_abs_page(html, url)[0]
 
 if __name__ == '__main__':
+    def test_parse_copyQuotation():
+        import random
+        cases = [
+            "薛康佳,张玉亮,王林,吴煊,李明涛,何泳成,朱鹏.(2023).CSNS EPICS PV信息平台的设计与实现.原子核物理评论.doi:10.12074/202311.00062V1",
+            "Debbie F. Crawford,Michael H. O'Connor,Tom Jovanovic,Alexander Herr,Robert John Raison,Deborah A. O'Connell,Tim Baynes.(2016).A spatial assessment of potential biomass for bioenergy in Australia in 2010, and possible expansion by 2030 and 2050.GCB Bioenergy.[ChinaXiv:201605.00524]",
+            ".(2024).快速射电暴观测数据干扰缓解方法研究.天文学报.doi:10.15940/j.cnki.0001-5245.2024.02.010",
+            "", ",", ",,", "a,", "a,,b,", ",a", "Crawford, D. F.,Baynes, T..(2016).t.j", "a.(", "a.(2020)", "a.(2020).", "a.(2020).t",
+            "a.(2020).t.", "a.(20.(21).t.j.x", "a.(.(2020).t.j", "a.(x²).t.j.k", "a.(2020).t.j.doi:1.2.3", "no citation at all",
+        ]
+        rnd = random.Random(0)
+        cases += ["".join(rnd.choice(".(),2a ²") for _ in range(rnd.randint(0, 16))) for _ in range(20000)]
+        for case in cases:
+            assert parse_copyQuotation(case) == parse_authors_from_copyQuotation(case), case
+        print(f"parse_copyQuotation: {len(cases)} cases ok")
+
     def test_parse_info_from_html():
         client = httpx.Client()
         from ChinaXivXiv.defines import DEFAULT_HEADERS
@@ -191,5 +381,8 @@ if __name__ == '__main__':
         assert r.status_code == 200
         metadata = get_chinaxivhtmlmetadata_from_html(r.content, str(r.url))
         print(metadata)
+        for backend in PARSER_BACKENDS:
+            assert parse_abs_page(r.content, str(r.url), backend=backend)[0] == metadata, backend
 
-    test_parse_info_from_html()
\ No newline at end of file
+    test_parse_copyQuotation()
+    test_parse_info_from_html()
@@ -1,18 +1,31 @@
+import asyncio
 import datetime
+import math
 import os
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
-import oaipmh_scythe.exceptions
-import pymongo.errors
-from tqdm import tqdm
+import httpx
+from lxml import etree
+from pymongo import UpdateOne
 
 import motor.motor_asyncio
 
-from oaipmh_scythe import Scythe
 import oaipmh_scythe.client
 from oaipmh_scythe.models import Record
 from oaipmh_scythe.utils import xml_to_dict
 
-oaipmh_scythe.client.USER_AGENT = "ChinaXiv Archive Mirror Project/0.1.0 (STW; SaveTheWeb; +github.com/saveweb; saveweb@saveweb.org) (qos-rate-limit: 3q/s)"
+from ChinaXivXiv.defines import Status
+from ChinaXivXiv.exceptions import OAIError
+from ChinaXivXiv.http_client import build_client
+from ChinaXivXiv.mongo_ops import find_max_datestamp, task_bucket, utcnow
+
+OAI_USER_AGENT = "ChinaXiv Archive Mirror Project/0.1.0 (STW; SaveTheWeb; +github.com/saveweb; saveweb@saveweb.org) (qos-rate-limit: 3q/s)"
+oaipmh_scythe.client.USER_AGENT = OAI_USER_AGENT
+OAI_URL = 'https://global.chinaxiv.org/oaiapi/getdata'
+OAI_NAMESPACE = '{http://www.openarchives.org/OAI/2.0/}'
+HARVEST_EPOCH = datetime.datetime(2016, 1, 1, tzinfo=datetime.timezone.utc)
+""" 库里还没有任何记录时从这里开始收割 """
 
 class ChinaXivRecord(Record):
     def get_metadata(self):
@@ -28,44 +41,198 @@ def generate_dates(start_date: datetime.datetime, m: int):
         yield start_date.strftime("%Y-%m-%dT00:00:00Z"), (start_date + delta).strftime("%Y-%m-%dT00:00:00Z")
         start_date += delta
 
+def generate_dates_until_now(start_date: datetime.datetime):
+    m = math.ceil((utcnow() - start_date) / datetime.timedelta(days=31))
+    return generate_dates(start_date, max(m, 1))
+
+def datestamp_to_datetime(datestamp: str) -> datetime.datetime:
+    """ 2024-01-02 / 2024-01-02T03:04:05Z -> 当天 00:00 (UTC) """
+    return datetime.datetime.strptime(datestamp[:10], "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc)
+
+
+def parse_list_records(content: bytes) -> Tuple[List[Dict], Optional[str]]:
+    """ 解析一页 ListRecords -> (docs, resumptionToken)。在线程里跑，不占 event loop """
+    root = etree.fromstring(content)
+    error = root.find(OAI_NAMESPACE + 'error')
+    if error is not None:
+        if error.get('code') == 'noRecordsMatch':
+            return [], None
+        raise OAIError(error.get('code'), error.text)
+    docs = []
+    for record_element in root.iter(OAI_NAMESPACE + 'record'):
+        record = ChinaXivRecord(record_element)
+        if record.deleted:
+            continue
+        docs.append({
+            "identifier": record.header.identifier,
+            "datestamp": record.header.datestamp,
+            "metadata": record.metadata
+        })
+    token = root.find(f'.//{OAI_NAMESPACE}resumptionToken')
+    return docs, (token.text if token is not None and token.text else None)
+
+
+async def list_records(client: httpx.AsyncClient, start: str, end: str,
+                       resumption_token: Optional[str] = None) -> AsyncIterator[Tuple[List[Dict], Optional[str]]]:
+    """ 异步逐页翻 resumptionToken，每次 yield (一页的 docs, 下一页的 token) """
+    if resumption_token:
+        params = {"verb": "ListRecords", "resumptionToken": resumption_token}
+    else:
+        params = {"verb": "ListRecords", "metadataPrefix": "oai_dc", "source": "chinaxiv", "startTime": start, "endTime": end}
+    while True:
+        r = await client.get(OAI_URL, params=params, headers={"User-Agent": OAI_USER_AGENT})
+        r.raise_for_status()
+        docs, token = await asyncio.to_thread(parse_list_records, r.content)
+        yield docs, token
+        if not token:
+            return
+        params = {"verb": "ListRecords", "resumptionToken": token}
+
+
+@dataclass
+class Checkpoint:
+    """ 夹在 docs 之间送进 BulkInserter: 前面的 docs 都写入后才持久化这个进度 """
+    window_id: str
+    start: str
+    end: str
+    resumption_token: Optional[str]
+    """ 下一页从哪继续，None 表示从窗口开头 """
+    records: int
+    done: bool
+
+
+class HarvestState:
+    """ oai_harvest_state 集合: 每个日期窗口一条，记录进行中的 resumptionToken / 是否完成 """
+    def __init__(self, collection: motor.motor_asyncio.AsyncIOMotorCollection):
+        self.collection = collection
+
+    async def in_progress(self) -> List[Dict]:
+        return await self.collection.find({"status": "in_progress"}).to_list(length=None)
+
+    async def save(self, checkpoint: Checkpoint):
+        await self.collection.update_one({"_id": checkpoint.window_id}, {"$set": {
+            "start": checkpoint.start,
+            "end": checkpoint.end,
+            "status": "done" if checkpoint.done else "in_progress",
+            "resumption_token": checkpoint.resumption_token,
+            "records": checkpoint.records,
+            "updated_at": utcnow(),
+        }}, upsert=True)
+
+
+class BulkInserter:
+    """ 从有界队列里取 docs，攒满 batch_size 就 unordered bulk upsert（按 identifier），内存占用与窗口大小无关。
+    重复收割同一条记录只会更新 datestamp/metadata，不会动 status 等任务字段 """
+    def __init__(self, collection: motor.motor_asyncio.AsyncIOMotorCollection, batch_size: int = 500,
+                 state: Optional[HarvestState] = None):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.state = state
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=batch_size * 2)
+        self.inserted = 0
+        self.updated = 0
+
+    async def put(self, doc: Dict | Checkpoint):
+        await self.queue.put(doc)
+
+    async def _upsert(self, docs: List[Dict]):
+        result = await self.collection.bulk_write([
+            UpdateOne(
+                {"identifier": doc["identifier"]},
+                {
+                    "$set": {"datestamp": doc["datestamp"], "metadata": doc["metadata"]},
+                    "$setOnInsert": {"status": Status.TODO, "bucket": task_bucket(doc["identifier"])},
+                },
+                upsert=True,
+            ) for doc in docs
+        ], ordered=False)
+        self.inserted += result.upserted_count
+        self.updated += result.modified_count
+        print(f"inserted {self.inserted}, updated {self.updated}")
+
+    async def run(self):
+        docs = []
+        while True:
+            doc = await self.queue.get()
+            if doc is None:
+                break
+            if isinstance(doc, Checkpoint):
+                if docs:
+                    await self._upsert(docs)
+                    docs = []
+                if self.state is not None:
+                    await self.state.save(doc)
+                continue
+            docs.append(doc)
+            if len(docs) >= self.batch_size:
+                await self._upsert(docs)
+                docs = []
+        if docs:
+            await self._upsert(docs)
+
+    async def close(self):
+        await self.queue.put(None)
+
+
+async def harvest(client: httpx.AsyncClient, collection: motor.motor_asyncio.AsyncIOMotorCollection,
+                  windows, window_concurrency: int = 3, batch_size: int = 500,
+                  state: Optional[HarvestState] = None):
+    """ 并发收割多个日期窗口，请求速率由 client 的限速 transport 控制。
+    有 state 时先续上次没收割完的窗口（从保存的 resumptionToken 继续），每页写完后保存进度 """
+    inserter = BulkInserter(collection, batch_size=batch_size, state=state)
+    semaphore = asyncio.Semaphore(window_concurrency)
+
+    async def harvest_window(start: str, end: str, resumption_token: Optional[str] = None, records: int = 0):
+        window_id = f"{start}~{end}"
+        async with semaphore:
+            while True:
+                print(start, end, f"(resuming from {resumption_token})" if resumption_token else "")
+                # 先登记，这样并发的其他窗口把 max datestamp 推过去之后，这个窗口崩了也能续上
+                await inserter.put(Checkpoint(window_id, start, end, resumption_token, records, done=False))
+                try:
+                    async for docs, token in list_records(client, start, end, resumption_token):
+                        for doc in docs:
+                            await inserter.put(doc)
+                        records += len(docs)
+                        await inserter.put(Checkpoint(window_id, start, end, token, records, done=token is None))
+                    break
+                except OAIError as e:
+                    if not resumption_token or e.code != "badResumptionToken":
+                        raise
+                    # 不能递归调用 harvest_window: 还拿着 semaphore，window_concurrency 个窗口同时过期就全卡死
+                    print(f"{window_id}: resumptionToken expired, restarting window")
+                    resumption_token, records = None, 0
+            print(f"{start} ~ {end}: {records} records")
+
+    windows = [(start, end, None, 0) for start, end in windows]
+    if state is not None:
+        windows = [(w["start"], w["end"], w["resumption_token"], w.get("records", 0)) for w in await state.in_progress()] + windows
+
+    writer = asyncio.create_task(inserter.run())
+    try:
+        await asyncio.gather(*[harvest_window(*window) for window in windows])
+    finally:
+        await inserter.close()
+        await writer
+    return inserter
+
+
+async def incremental_harvest(client: httpx.AsyncClient, collection: motor.motor_asyncio.AsyncIOMotorCollection,
+                              state_collection: motor.motor_asyncio.AsyncIOMotorCollection, **kwargs):
+    """ 从库里最新的 datestamp 收割到现在（像 find_max_id 之于 id）。每天跑一次只会拉到新增的几条 """
+    max_datestamp = await find_max_datestamp(collection)
+    start = datestamp_to_datetime(max_datestamp) if max_datestamp else HARVEST_EPOCH
+    print(f"harvesting since {start} (max datestamp: {max_datestamp})")
+    return await harvest(client, collection, generate_dates_until_now(start), state=HarvestState(state_collection), **kwargs)
+
 
 async def main():
     m_client = motor.motor_asyncio.AsyncIOMotorClient(os.getenv("MONGODB_URI"))
     db = m_client["chinaxiv"]
     collection = db["global_chinaxiv"]
 
-
-    scythe = Scythe('https://global.chinaxiv.org/oaiapi/getdata')
-    scythe.class_mapping["ListRecords"] = ChinaXivRecord
-
-    for start, end in generate_dates(datetime.datetime(2024, 1, 1), 12):
-        print(start, end)
-        records = scythe.list_records(metadata_prefix='oai_dc', source="chinaxiv", startTime=start ,endTime=end)
-        
-        docs = []
-        try:
-            for record in records:
-                print(record.header.identifier, record.header.datestamp, record.header.setSpecs)
-                # print(record.metadata)
-
-                docs.append({
-                    "identifier": record.header.identifier,
-                    "datestamp": record.header.datestamp,
-                    "metadata": record.metadata
-                })
-        except oaipmh_scythe.exceptions.NoRecordsMatch:
-            print("NoRecordsMatch")
-            continue
-        if not docs:
-            continue
-        print("inserting...")
-        try:
-            await collection.insert_many(docs, ordered=False)
-        except pymongo.errors.BulkWriteError as e:
-            print(e.details)
-            print("inserted")
-        print("inserted")
+    async with build_client() as client:
+        await incremental_harvest(client, collection, db["oai_harvest_state"])
 
 if __name__ == "__main__":
-    import asyncio
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())